@@ -0,0 +1,247 @@
+import atexit
+import fcntl
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+import codec
+from metrics import metrics, SIZE_BUCKETS
+
+# Nhật ký (append-only) các sự kiện của chuỗi hành động để khôi phục nhiệm vụ đang dở
+# sau khi server khởi động lại hoặc robot kết nối lại.
+# - Mỗi bản ghi là một dòng JSON: begin, add, drop, dispatch, ack, progress, cancel (kèm tiến độ "p" và seq kế tiếp "n");
+#   progress chỉ cập nhật "p"/"n" (bước không làm gì được bỏ qua và tính là đã hoàn thành)
+# - Event loop chỉ đưa bản ghi vào hàng đợi; một thread riêng ghi và fsync theo lô (group commit):
+#   mọi bản ghi dồn lại trong lúc fsync lô trước được ghi chung một lần fsync
+# - Sau mỗi ACTION_JOURNAL_SNAPSHOT_EVERY bản ghi, trạng thái hiện tại được ghi ra snapshot
+#   và journal được bắt đầu lại (generation mới) để file không lớn mãi
+# - Việc khôi phục và ghi snapshot đầu tiên chạy trong lifespan (startup.PHASE_ACTION_JOURNAL),
+#   không chạy khi import module
+
+ACTION_JOURNAL_ENABLED = os.getenv("ACTION_JOURNAL", "0") == "1"
+ACTION_JOURNAL_PATH = os.getenv("ACTION_JOURNAL_PATH", "action_journal.log")
+ACTION_JOURNAL_SNAPSHOT_EVERY = int(os.getenv("ACTION_JOURNAL_SNAPSHOT_EVERY", "10000"))
+# Số bản ghi tối đa mỗi lần fsync
+ACTION_JOURNAL_MAX_BATCH = 1024
+# Chuỗi hành động dừng quá lâu (robot không quay lại) không được khôi phục
+ACTION_RESUME_TTL = float(os.getenv("ACTION_RESUME_TTL", "300"))
+
+JOURNAL_COMMIT_SECONDS = metrics.histogram(
+    "action_journal_commit_seconds", "Thời gian ghi và fsync một lô bản ghi journal")
+JOURNAL_BATCH_RECORDS = metrics.histogram(
+    "action_journal_batch_records", "Số bản ghi journal trong mỗi lần fsync", buckets=SIZE_BUCKETS)
+
+_STOP = object()
+
+
+def _apply(state: Dict[str, dict], record: dict):
+    """Áp dụng một bản ghi vào trạng thái journal. Dùng chung cho replay và snapshot."""
+    op = record["op"]
+    robot_id = record["r"]
+    if op == "cancel":
+        state.pop(robot_id, None)
+        return
+    robot = state.get(robot_id)
+    if op == "begin" or robot is None:
+        robot = state[robot_id] = {"actions": {}, "p": [0, 0], "n": 1, "t": 0.0}
+    actions = robot["actions"]
+    if op == "add":
+        action = record["a"]
+        actions[action["seq"]] = action
+    elif op == "drop":
+        actions.pop(record["seq"], None)
+    elif op == "dispatch":
+        for seq in record["seqs"]:
+            if seq in actions:
+                actions[seq]["dispatched"] = True
+    elif op == "ack":
+        for seq in record["seqs"]:
+            actions.pop(seq, None)
+    robot["p"] = record.get("p", robot["p"])
+    robot["n"] = record.get("n", robot["n"])
+    robot["t"] = record["t"]
+
+
+class ActionJournal:
+    """Ghi journal ở thread nền và đọc lại trạng thái khi khởi động."""
+    def __init__(self, path: str, snapshot_every: int = ACTION_JOURNAL_SNAPSHOT_EVERY):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.snapshot_every = snapshot_every
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._state: Dict[str, dict] = {}
+        self._generation = 0
+        self._records_since_snapshot = 0
+        self._file = None
+        self._lock_file = None
+        self._thread: Optional[threading.Thread] = None
+
+    def acquire(self) -> bool:
+        """Giữ khóa journal. Chỉ một tiến trình (worker) được ghi vào một file journal."""
+        self._lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            self._lock_file = None
+            return False
+        return True
+
+    def recover(self) -> Dict[str, dict]:
+        """
+        Đọc snapshot và journal, trả về các chuỗi hành động chưa xong theo robot_id:
+        {"actions": [action dict theo thứ tự seq gửi], "p": [đã xong, tổng], "n": seq kế tiếp, "t": thời điểm}.
+        Phải gọi trước start().
+        """
+        state: Dict[str, dict] = {}
+        snapshot_generation = 0
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = codec.loads(f.read())
+            snapshot_generation = snapshot["generation"]
+            for robot_id, robot in snapshot["robots"].items():
+                robot["actions"] = {action["seq"]: action for action in robot["actions"]}
+                state[robot_id] = robot
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            print(f"Snapshot journal không hợp lệ, bỏ qua: {e}")
+
+        replayed = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                header = f.readline()
+                generation = codec.loads(header).get("generation", 0) if header.strip() else 0
+                # Journal cũ hơn snapshot: server dừng sau khi ghi snapshot nhưng trước khi tạo journal mới
+                if generation >= snapshot_generation:
+                    for line in f:
+                        try:
+                            record = codec.loads(line)
+                        except ValueError:
+                            # Dòng cuối ghi dở khi server dừng đột ngột
+                            break
+                        _apply(state, record)
+                        replayed += 1
+                snapshot_generation = max(snapshot_generation, generation)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            print(f"Journal không hợp lệ, bỏ qua: {e}")
+
+        self._generation = snapshot_generation
+        self._state = state
+        print(f"Khôi phục journal: {replayed} bản ghi, {len(state)} robot có chuỗi hành động chưa xong")
+        return {
+            robot_id: {**robot, "actions": list(robot["actions"].values())}
+            for robot_id, robot in state.items() if robot["actions"]
+        }
+
+    def start(self):
+        """Ghi lại trạng thái đã khôi phục thành snapshot mới và bắt đầu thread ghi."""
+        if self._thread is not None:
+            return
+        self._compact()
+        self._thread = threading.Thread(target=self._run, name="action-journal", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, op: str, robot_id: str, **fields):
+        """Đưa bản ghi vào hàng đợi ghi (không chặn event loop)."""
+        fields["op"] = op
+        fields["r"] = robot_id
+        fields["t"] = time.time()
+        self._queue.put(fields)
+
+    def close(self):
+        """Ghi nốt các bản ghi còn trong hàng đợi rồi dừng thread."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout=5)
+        self._thread = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch: List[dict] = []
+            item = self._queue.get()
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= ACTION_JOURNAL_MAX_BATCH:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self._commit(batch)
+                except OSError as e:
+                    print(f"Lỗi khi ghi journal: {e}")
+
+    def _commit(self, batch: List[dict]):
+        started = time.perf_counter()
+        self._file.write("".join(codec.dumps(record) + "\n" for record in batch))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        JOURNAL_COMMIT_SECONDS.observe(time.perf_counter() - started)
+        JOURNAL_BATCH_RECORDS.observe(len(batch))
+
+        for record in batch:
+            _apply(self._state, record)
+            # Robot không còn action nào thì không cần giữ trong snapshot
+            robot = self._state.get(record["r"])
+            if robot is not None and not robot["actions"] and record["op"] == "ack":
+                del self._state[record["r"]]
+        self._records_since_snapshot += len(batch)
+        if self._records_since_snapshot >= self.snapshot_every:
+            self._compact()
+
+    def _compact(self):
+        """Ghi snapshot của trạng thái hiện tại rồi bắt đầu journal mới rỗng."""
+        self._generation += 1
+        snapshot = {
+            "generation": self._generation,
+            "robots": {
+                robot_id: {**robot, "actions": list(robot["actions"].values())}
+                for robot_id, robot in self._state.items() if robot["actions"]
+            },
+        }
+        _write_atomic(self.snapshot_path, codec.dumps(snapshot))
+        _write_atomic(self.path, codec.dumps({"generation": self._generation}) + "\n")
+        if self._file:
+            self._file.close()
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._records_since_snapshot = 0
+
+
+def _write_atomic(path: str, content: str):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def open_action_journal() -> Optional[ActionJournal]:
+    """Mở journal nếu được bật và giữ được khóa, ngược lại None (không ghi journal)."""
+    if not ACTION_JOURNAL_ENABLED:
+        return None
+    journal = ActionJournal(ACTION_JOURNAL_PATH)
+    if not journal.acquire():
+        print(f"Journal {ACTION_JOURNAL_PATH} đang được tiến trình khác dùng, worker này chạy không có journal")
+        return None
+    return journal
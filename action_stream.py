@@ -0,0 +1,98 @@
+import codec
+from typing import List
+
+# Bộ phân tích JSON tăng dần cho phản hồi dạng stream của Gemini.
+# Trả về từng phần tử của mảng "actions" ngay khi phần tử đó đã đầy đủ cú pháp,
+# không cần chờ đến khi model trả lời xong cả lượt.
+# Bỏ qua mọi ký tự trước mảng (kể cả ``` json do model thêm vào).
+
+_ACTIONS_KEY = '"actions"'
+
+
+class ActionStreamParser:
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0              # vị trí đã quét trong buffer
+        self._in_array = False     # đã gặp '[' của "actions"
+        self._done = False         # đã gặp ']' kết thúc mảng
+        self._depth = 0            # độ sâu ngoặc bên trong phần tử hiện tại
+        self._item_start = -1
+        self._in_string = False
+        self._escape = False
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def feed(self, chunk: str) -> List[dict]:
+        """Nạp thêm một đoạn văn bản, trả về các action đã hoàn chỉnh."""
+        if self._done:
+            return []
+        self._buffer += chunk
+        if not self._in_array and not self._find_array_start():
+            return []
+
+        completed = []
+        buffer = self._buffer
+        i = self._pos
+        n = len(buffer)
+        while i < n:
+            ch = buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                if self._depth == 0:
+                    self._item_start = i
+                self._depth += 1
+            elif ch in "}]":
+                if self._depth == 0:
+                    # ']' đóng mảng "actions"
+                    self._done = True
+                    i += 1
+                    break
+                self._depth -= 1
+                if self._depth == 0:
+                    item = self._decode(buffer[self._item_start:i + 1])
+                    if item is not None:
+                        completed.append(item)
+                    self._item_start = -1
+            i += 1
+
+        # Giữ lại phần chưa hoàn chỉnh để tránh buffer lớn dần
+        if self._item_start >= 0:
+            self._buffer = buffer[self._item_start:]
+            self._pos = i - self._item_start
+            self._item_start = 0
+        else:
+            self._buffer = ""
+            self._pos = 0
+        return completed
+
+    def _find_array_start(self) -> bool:
+        key_pos = self._buffer.find(_ACTIONS_KEY)
+        if key_pos < 0:
+            return False
+        bracket = self._buffer.find("[", key_pos + len(_ACTIONS_KEY))
+        if bracket < 0:
+            return False
+        self._in_array = True
+        self._buffer = self._buffer[bracket + 1:]
+        self._pos = 0
+        return True
+
+    @staticmethod
+    def _decode(raw: str):
+        try:
+            item = codec.loads(raw)
+        except codec.DecodeError as e:
+            print("JSON parse error:", e)
+            print("Raw action:", raw)
+            return None
+        return item if isinstance(item, dict) else None
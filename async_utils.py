@@ -0,0 +1,14 @@
+import asyncio
+from typing import Optional
+
+# Các hàm tiện ích asyncio dùng chung giữa các module.
+
+
+async def cancel_and_wait(task: Optional[asyncio.Future]):
+    """Hủy task nếu chưa xong và chờ nó kết thúc hẳn; bỏ qua kết quả hoặc lỗi của task."""
+    if task is not None and not task.done():
+        task.cancel()
+        try:
+            await task
+        except BaseException:
+            pass
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+from typing import List
+
+# Thay thế Gemini Live và Firebase bằng bản giả chạy cục bộ, độ trễ điều chỉnh được,
+# để benchmark chỉ đo phần code của server (ws_routes, connections, pending_actions...).
+# Các bản giả đi qua đúng đường code thật: stream_actions vẫn phân tích JSON theo từng chunk,
+# verify_firebase_token_async vẫn chạy cache/thread pool, chỉ lệnh gọi mạng bị thay.
+
+FAKE_ACTIONS = [
+    {"intent": "tien", "params": {"distance": 2, "unit": "m"}},
+    {"intent": "re_trai", "params": {"angle": 90, "unit": "deg"}},
+]
+
+
+def _chunks(text: str, size: int) -> List[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class FakeLiveSession:
+    """
+    Giả lập phiên Live: trả lời mọi câu lệnh bằng FAKE_ACTIONS, stream theo từng chunk.
+    Câu lệnh giọng nói (send_realtime_input) được trả lời khi nhận audio_stream_end.
+    """
+    def __init__(self, first_token_latency: float, chunk_latency: float, chunk_size: int = 16):
+        self.first_token_latency = first_token_latency
+        self.chunk_latency = chunk_latency
+        self.response = "```json\n" + json.dumps({"actions": FAKE_ACTIONS}) + "\n```"
+        self.chunk_size = chunk_size
+        self._turns: asyncio.Queue = asyncio.Queue()
+        self._ws = SimpleNamespace(close_code=None)
+        self.audio_bytes = 0
+
+    async def send_client_content(self, turns=None, turn_complete: bool = True):
+        if turn_complete:
+            await self._turns.put(turns)
+
+    async def send_realtime_input(self, *, audio=None, audio_stream_end=None, **kwargs):
+        if audio is not None:
+            self.audio_bytes += len(audio.data)
+        if audio_stream_end:
+            await self._turns.put(self.audio_bytes)
+            self.audio_bytes = 0
+
+    async def receive(self):
+        await self._turns.get()
+        await asyncio.sleep(self.first_token_latency)
+        for i, chunk in enumerate(_chunks(self.response, self.chunk_size)):
+            if i and self.chunk_latency:
+                await asyncio.sleep(self.chunk_latency)
+            yield SimpleNamespace(server_content=SimpleNamespace(
+                model_turn=SimpleNamespace(parts=[SimpleNamespace(text=chunk)]), turn_complete=False))
+        yield SimpleNamespace(server_content=SimpleNamespace(model_turn=None, turn_complete=True))
+
+
+def install_fake_gemini(connect_latency: float, first_token_latency: float, chunk_latency: float):
+    """Thay gemini.get_gemini bằng bản tạo GeminiLiveClient có phiên giả."""
+    import gemini
+
+    # Phiên giả không cần SDK client thật (tạo genai.Client tốn hàng chục ms CPU mỗi lần)
+    gemini.genai = SimpleNamespace(Client=lambda api_key=None: None)
+
+    class FakeGeminiLiveClient(gemini.GeminiLiveClient):
+        async def connect(self, prime: bool = False):
+            started = time.perf_counter()
+            await asyncio.sleep(connect_latency)
+            self.session = FakeLiveSession(first_token_latency, chunk_latency)
+            self.is_connected = True
+            self.connected_at = time.monotonic()
+            self.prompt_template_sent = prime
+            gemini.GEMINI_CONNECT_SECONDS.observe(time.perf_counter() - started, "ok")
+
+        async def disconnect(self):
+            self.is_connected = False
+            self.session = None
+
+    async def fake_get_gemini():
+        return FakeGeminiLiveClient(api_key=gemini.API_KEY or "bench")
+
+    gemini.get_gemini = fake_get_gemini
+
+
+def install_fake_firebase(verify_latency: float, token_ttl: float = 3600):
+    """Thay verify_firebase_token (lệnh gọi Firebase trong thread pool) bằng bản giả."""
+    import firebase
+
+    def fake_verify_firebase_token(id_token: str, check_revoked: bool = False):
+        time.sleep(verify_latency)
+        if not id_token.startswith("bench"):
+            return {"success": False, "error": "Token không hợp lệ", "error_code": "INVALID_TOKEN"}
+        return {"success": True, "uid": id_token, "exp": time.time() + token_ttl, "firebase": {}}
+
+    firebase.verify_firebase_token = fake_verify_firebase_token
@@ -0,0 +1,420 @@
+"""
+Benchmark tải cho Robot Server.
+
+Chạy app FastAPI trong cùng tiến trình (uvicorn trên cổng ngẫu nhiên), tạo hàng nghìn robot giả
+ack action sau độ trễ cấu hình được và client giả gửi câu lệnh theo tỉ lệ json/local/gemini.
+Gemini Live và Firebase được thay bằng bản giả cục bộ (bench/fakes.py).
+
+Báo cáo: throughput, p50/p99 từ lúc gửi câu lệnh đến action đầu tiên và đến khi hoàn thành,
+bộ nhớ mỗi kết nối. So sánh với baseline đã lưu (bench/baseline.json) và trả về mã lỗi 1 nếu chậm hơn.
+
+    python bench/run_bench.py                      # chạy và so sánh với baseline
+    python bench/run_bench.py --robots 200 --duration 5
+    python bench/run_bench.py --save-baseline      # ghi kết quả làm baseline mới
+
+Lưu ý: robot/client giả chạy chung event loop với server nên số liệu là tương đối,
+dùng để phát hiện thay đổi giữa các lần chạy trên cùng một máy, không phải giới hạn tuyệt đối.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import time
+from typing import Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+# Câu lệnh mẫu cho từng cách phân tích; số action mong đợi được tính khi khởi động
+LOCAL_COMMANDS = ["tiến 2 mét", "rẽ trái 90 độ", "lùi 1 mét rồi rẽ phải", "dừng lại", "nâng lên"]
+JSON_COMMANDS = ['{"intent": "tien", "params": {"distance": 1, "unit": "m"}}', '{"intent": "dung_lai", "params": {}}']
+GEMINI_COMMANDS = ["đi tới chỗ cái bàn", "ra cửa rồi quay lại", "đi vòng quanh phòng"]
+
+# Chỉ số so sánh với baseline: True nếu lớn hơn là tốt hơn
+COMPARED_METRICS = {
+    "throughput": True,
+    "first_action_p50_ms": False,
+    "first_action_p99_ms": False,
+    "completion_p50_ms": False,
+    "completion_p99_ms": False,
+    "memory_per_connection_kb": False,
+}
+# Các tham số phải giống nhau thì mới so sánh với baseline
+CONFIG_KEYS = ("robots", "window", "mix", "ack_delay", "think_time", "gemini_latency", "verify_latency", "duration", "warmup")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--robots", type=int, default=1000, help="Số cặp robot/client giả")
+    parser.add_argument("--duration", type=float, default=20.0, help="Thời gian đo tải (giây)")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Bỏ qua các câu lệnh bắt đầu trong khoảng này (giây)")
+    parser.add_argument("--window", type=int, default=1, help="Window robot khai báo khi kết nối")
+    parser.add_argument("--mix", default="json=1,local=6,gemini=3", help="Tỉ lệ câu lệnh json/local/gemini")
+    parser.add_argument("--ack-delay", default="0.005,0.02", help="Độ trễ robot thực hiện một action (min,max giây)")
+    parser.add_argument("--think-time", type=float, default=2.0, help="Thời gian nghỉ trung bình giữa hai câu lệnh của client")
+    parser.add_argument("--gemini-latency", type=float, default=0.15, help="Độ trễ token đầu tiên của Gemini giả")
+    parser.add_argument("--gemini-chunk-latency", type=float, default=0.005, help="Độ trễ giữa các chunk của Gemini giả")
+    parser.add_argument("--gemini-connect-latency", type=float, default=0.3, help="Thời gian mở phiên Gemini giả")
+    parser.add_argument("--verify-latency", type=float, default=0.05, help="Thời gian xác thực token Firebase giả")
+    parser.add_argument("--cacheable", action="store_true", help="Không thêm số thứ tự vào câu lệnh gemini (cho phép cache)")
+    parser.add_argument("--command-timeout", type=float, default=10.0)
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Lưu kết quả làm baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Mức chênh lệch cho phép so với baseline")
+    parser.add_argument("--verbose", action="store_true", help="Giữ log print của server")
+    return parser.parse_args(argv)
+
+
+def prepare_environment(args):
+    """Đặt biến môi trường trước khi import các module của server."""
+    sys.path.insert(0, ROOT_DIR)
+    os.environ.setdefault("API_GEMINI_KEY", "bench")
+    # Mỗi client giữ một phiên Gemini trong suốt kết nối
+    os.environ.setdefault("GEMINI_POOL_MAX_SIZE", str(args.robots + 8))
+    os.environ.setdefault("GEMINI_POOL_SIZE", str(min(args.robots, 64)))
+    # Ngân sách Gemini đủ cho tải của bench (như thể mọi câu lệnh đều cần Gemini) để bench đo hiệu năng
+    # server chứ không đo giới hạn tốc độ; mặc định của rate_limit dành cho fleet nhỏ
+    os.environ.setdefault("GEMINI_RATE_LIMIT", str(max(1.0, args.robots / max(args.think_time, 0.1))))
+    os.environ.setdefault("GEMINI_RATE_BURST", str(args.robots))
+    os.environ.setdefault("GEMINI_MAX_CONCURRENCY", str(args.robots))
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        source, _, weight = item.partition("=")
+        if source not in ("json", "local", "gemini"):
+            raise SystemExit(f"Loại câu lệnh không hợp lệ: {source}")
+        weights[source] = float(weight)
+    return weights
+
+
+def rss_kb() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class SimPair:
+    """Trạng thái dùng chung giữa một robot giả và client điều khiển nó."""
+    def __init__(self, robot_id: str):
+        self.robot_id = robot_id
+        self.first_action_at: Optional[float] = None
+
+
+class SimRobot:
+    """Robot giả: nhận action, thực hiện tuần tự (sleep) rồi ack như firmware."""
+    def __init__(self, pair: SimPair, window: int, ack_delay: tuple, rng: random.Random):
+        self.pair = pair
+        self.window = window
+        self.ack_delay = ack_delay
+        self.rng = rng
+        self.ws = None
+        self._actions: asyncio.Queue = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+
+    async def connect(self, base_url: str):
+        import websockets
+        self.ws = await websockets.connect(
+            f"{base_url}/api/ws/robot/{self.pair.robot_id}?window={self.window}", ping_interval=None)
+        self._tasks = [asyncio.create_task(self._receive_loop()), asyncio.create_task(self._execute_loop())]
+
+    async def _receive_loop(self):
+        with contextlib.suppress(Exception):
+            async for raw in self.ws:
+                try:
+                    message = json.loads(raw)
+                except ValueError:
+                    continue  # Tin thông báo dạng text
+                if not isinstance(message, dict):
+                    continue
+                if "action_id" in message:
+                    if self.pair.first_action_at is None:
+                        self.pair.first_action_at = time.perf_counter()
+                    self._actions.put_nowait(message)
+                elif message.get("type") == "flush":
+                    while not self._actions.empty():
+                        self._actions.get_nowait()
+                elif message.get("type") == "ping":
+                    await self.ws.send(json.dumps({"type": "pong", "id": message.get("id")}))
+
+    async def _execute_loop(self):
+        with contextlib.suppress(Exception):
+            while True:
+                action = await self._actions.get()
+                await asyncio.sleep(self.rng.uniform(*self.ack_delay))
+                ack = {"action_id": action["action_id"], "message": "ok"}
+                if self.window > 1:
+                    ack = {"ack_seq": action["seq"], "message": "ok"}
+                await self.ws.send(json.dumps(ack))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        if self.ws is not None:
+            await self.ws.close()
+
+
+class SimClient:
+    """Client giả: gửi câu lệnh, chờ đủ số tin hoàn thành robot chuyển về rồi nghỉ."""
+    def __init__(self, pair: SimPair, commands: Dict[str, List[tuple]], weights: Dict[str, float],
+                 think_time: float, timeout: float, cacheable: bool, rng: random.Random):
+        self.pair = pair
+        self.commands = commands
+        self.sources = list(weights)
+        self.weights = [weights[source] for source in self.sources]
+        self.think_time = think_time
+        self.timeout = timeout
+        self.cacheable = cacheable
+        self.rng = rng
+        self.ws = None
+        self.samples: List[tuple] = []  # (source, first_action, completion, started)
+        self.errors = 0
+        self.timeouts = 0
+        self._sent = 0
+
+    async def connect(self, base_url: str):
+        import websockets
+        self.ws = await websockets.connect(
+            f"{base_url}/api/ws/client/{self.pair.robot_id}?token=bench-{self.pair.robot_id}", ping_interval=None)
+
+    def _next_command(self) -> tuple:
+        source = self.rng.choices(self.sources, self.weights)[0]
+        text, expected = self.rng.choice(self.commands[source])
+        if source == "gemini" and not self.cacheable:
+            # Số thứ tự khác nhau để mọi câu lệnh đều đi tới Gemini giả thay vì trúng cache
+            text = f"{text} lần {self.pair.robot_id}-{self._sent}"
+        self._sent += 1
+        return source, text, expected
+
+    async def run(self, deadline: float):
+        while time.perf_counter() < deadline:
+            source, text, expected = self._next_command()
+            self.pair.first_action_at = None
+            started = time.perf_counter()
+            await self.ws.send(text)
+            try:
+                ok = await asyncio.wait_for(self._wait_completion(expected), self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                ok = False
+            if ok:
+                completed = time.perf_counter()
+                first = (self.pair.first_action_at or completed) - started
+                self.samples.append((source, first, completed - started, started))
+            await asyncio.sleep(self.rng.expovariate(1 / self.think_time) if self.think_time > 0 else 0)
+
+    async def _wait_completion(self, expected: int) -> bool:
+        done = 0
+        while done < expected:
+            raw = await self.ws.recv()
+            if raw == "ok":
+                done += 1
+            elif '"error"' in raw:
+                self.errors += 1
+                return False
+        return True
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+
+
+def build_commands() -> Dict[str, List[tuple]]:
+    """Câu lệnh mẫu kèm số action robot sẽ nhận cho mỗi câu."""
+    from command_parser import local_parser
+    from model import Action
+    from plan_optimizer import optimize_plan
+    from fakes import FAKE_ACTIONS
+
+    def dispatched(actions):
+        # Server gộp các bước liền nhau trước khi gửi, robot nhận số action sau khi gộp
+        return len(optimize_plan([Action(action_id="", intent=a["intent"], params=a["params"]) for a in actions]))
+
+    local = []
+    for text in LOCAL_COMMANDS:
+        actions = local_parser.parse(text)
+        if actions is None:
+            raise SystemExit(f"Bộ phân tích cục bộ không nhận dạng được câu mẫu: {text}")
+        local.append((text, dispatched(actions)))
+    return {
+        "json": [(text, 1) for text in JSON_COMMANDS],
+        "local": local,
+        "gemini": [(text, dispatched(FAKE_ACTIONS)) for text in GEMINI_COMMANDS],
+    }
+
+
+async def connect_all(sims, base_url: str, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect(sim):
+        async with semaphore:
+            await sim.connect(base_url)
+
+    await asyncio.gather(*(connect(sim) for sim in sims))
+
+
+async def run_benchmark(args) -> dict:
+    import uvicorn
+    import main
+    from fakes import install_fake_firebase, install_fake_gemini
+
+    install_fake_gemini(args.gemini_connect_latency, args.gemini_latency, args.gemini_chunk_latency)
+    install_fake_firebase(args.verify_latency)
+
+    port = free_port()
+    base_url = f"ws://127.0.0.1:{port}"
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning",
+                                           backlog=4096, ws_ping_interval=None))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    rng = random.Random(args.seed)
+    ack_delay = tuple(float(x) for x in args.ack_delay.split(","))
+    weights = parse_mix(args.mix)
+    commands = build_commands()
+    pairs = [SimPair(f"bench-robot-{i}") for i in range(args.robots)]
+    robots = [SimRobot(pair, args.window, ack_delay, random.Random(rng.random())) for pair in pairs]
+    clients = [SimClient(pair, commands, weights, args.think_time, args.command_timeout, args.cacheable,
+                         random.Random(rng.random())) for pair in pairs]
+
+    rss_before = rss_kb()
+    connect_started = time.perf_counter()
+    await connect_all(robots, base_url, args.connect_concurrency)
+    await connect_all(clients, base_url, args.connect_concurrency)
+    connect_seconds = time.perf_counter() - connect_started
+    rss_after = rss_kb()
+
+    load_started = time.perf_counter()
+    deadline = load_started + args.duration
+    await asyncio.gather(*(client.run(deadline) for client in clients))
+    elapsed = time.perf_counter() - load_started
+
+    for sim in clients + robots:
+        await sim.close()
+    server.should_exit = True
+    await server_task
+
+    # Lúc mọi client cùng gửi câu lệnh đầu tiên không phản ánh trạng thái ổn định
+    measured_from = load_started + min(args.warmup, args.duration / 2)
+    samples = [sample for client in clients for sample in client.samples if sample[3] >= measured_from]
+    first = [s[1] * 1000 for s in samples]
+    completion = [s[2] * 1000 for s in samples]
+    by_source = {}
+    for source in weights:
+        source_samples = [s for s in samples if s[0] == source]
+        by_source[source] = {
+            "commands": len(source_samples),
+            "first_action_p50_ms": round(percentile([s[1] * 1000 for s in source_samples], 50), 2),
+            "first_action_p99_ms": round(percentile([s[1] * 1000 for s in source_samples], 99), 2),
+        }
+
+    return {
+        "config": {
+            "robots": args.robots,
+            "window": args.window,
+            "mix": args.mix,
+            "ack_delay": args.ack_delay,
+            "think_time": args.think_time,
+            "gemini_latency": args.gemini_latency,
+            "verify_latency": args.verify_latency,
+            "duration": args.duration,
+            "warmup": args.warmup,
+        },
+        "commands": len(samples),
+        "errors": sum(client.errors for client in clients),
+        "timeouts": sum(client.timeouts for client in clients),
+        "throughput": round(len(samples) / (load_started + elapsed - measured_from), 2),
+        "first_action_p50_ms": round(percentile(first, 50), 2),
+        "first_action_p99_ms": round(percentile(first, 99), 2),
+        "completion_p50_ms": round(percentile(completion, 50), 2),
+        "completion_p99_ms": round(percentile(completion, 99), 2),
+        # Gồm cả phía robot/client giả vì chạy chung tiến trình
+        "memory_per_connection_kb": round((rss_after - rss_before) / (2 * args.robots), 2),
+        "connect_seconds": round(connect_seconds, 2),
+        "by_source": by_source,
+    }
+
+
+def compare_with_baseline(result: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Trả về danh sách chỉ số chậm/tệ hơn baseline quá mức cho phép."""
+    regressions = []
+    for name, higher_is_better in COMPARED_METRICS.items():
+        old, new = baseline.get(name), result.get(name)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        print(f"  {name:28} {old:>10} -> {new:>10} ({change:+.1%})")
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    prepare_environment(args)
+
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        result = asyncio.run(run_benchmark(args))
+
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"Đã lưu baseline vào {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("Chưa có baseline, chạy lại với --save-baseline để lưu")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if any(baseline.get("config", {}).get(key) != result["config"][key] for key in CONFIG_KEYS):
+        print("Cấu hình khác baseline, bỏ qua so sánh")
+        return 0
+
+    print(f"So sánh với baseline (cho phép {args.tolerance:.0%}):")
+    regressions = compare_with_baseline(result, baseline, args.tolerance)
+    if regressions or result["errors"] or result["timeouts"]:
+        print(f"Hiệu năng giảm so với baseline: {', '.join(regressions) or 'có lỗi/timeout'}")
+        return 1
+    print("Không có suy giảm so với baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
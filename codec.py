@@ -0,0 +1,140 @@
+import json
+import math
+import re
+from typing import Any, Callable, Dict, List, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # orjson không bắt buộc, dùng thư viện chuẩn
+    orjson = None
+
+# Lớp mã hóa JSON dùng chung cho mọi frame robot/client:
+# - dùng orjson nếu có cài, ngược lại json của thư viện chuẩn (cùng định dạng gọn, giữ nguyên Unicode)
+# - kiểm tra action theo schema đã biên dịch sẵn (intent hợp lệ, tham số là số, đúng đơn vị)
+#   để dữ liệu sai bị loại ngay ở đầu vào thay vì gây KeyError trong vòng xử lý
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+# orjson.JSONDecodeError kế thừa json.JSONDecodeError nên bắt một loại là đủ
+DecodeError = json.JSONDecodeError
+
+if orjson is not None:
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    _decoder = json.JSONDecoder()
+
+    def dumps(obj: Any) -> str:
+        return _encoder.encode(obj)
+
+    def loads(data: Union[str, bytes]) -> Any:
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode()
+        return _decoder.decode(data)
+
+
+class ActionSchemaError(ValueError):
+    """Action không đúng schema (intent lạ, tham số sai kiểu hoặc sai đơn vị)."""
+
+
+# Tham số của từng intent: (tên tham số số, đơn vị) hoặc None nếu intent không có tham số.
+# Intent có tham số vẫn chấp nhận params rỗng (robot dùng giá trị mặc định).
+ACTION_SCHEMA: Dict[str, Optional[tuple]] = {
+    "tien": ("distance", "m"),
+    "lui": ("distance", "m"),
+    "re_trai": ("angle", "deg"),
+    "re_phai": ("angle", "deg"),
+    "dung_lai": None,
+    "nang": None,
+    "ha": None,
+}
+
+
+def _compile(intent: str, spec: Optional[tuple]) -> Callable[[dict], dict]:
+    """Tạo hàm kiểm tra params cho một intent."""
+    if spec is None:
+        def check(params: dict) -> dict:
+            if params:
+                raise ActionSchemaError(f"Intent {intent} không có tham số: {params}")
+            return {}
+        return check
+
+    name, unit = spec
+    keys = {name, "unit"}
+
+    def check(params: dict) -> dict:
+        if not params:
+            return {}
+        if params.keys() != keys:
+            raise ActionSchemaError(f"Intent {intent} cần tham số {name} và unit: {params}")
+        value = params[name]
+        if type(value) not in (int, float) or not math.isfinite(value) or value < 0:
+            raise ActionSchemaError(f"Tham số {name} phải là số không âm: {value!r}")
+        if params["unit"] != unit:
+            raise ActionSchemaError(f"Đơn vị của {name} phải là {unit}: {params['unit']!r}")
+        return {name: value, "unit": unit}
+    return check
+
+
+_PARAM_CHECKS: Dict[str, Callable[[dict], dict]] = {
+    intent: _compile(intent, spec) for intent, spec in ACTION_SCHEMA.items()
+}
+
+
+def validate_action(item: Any) -> dict:
+    """
+    Kiểm tra một action dạng dict {"intent", "params"}.
+    Trả về bản sao đã chuẩn hóa (params thiếu -> {}), raise ActionSchemaError nếu không hợp lệ.
+    """
+    if not isinstance(item, dict):
+        raise ActionSchemaError(f"Action phải là object JSON: {item!r}")
+    intent = item.get("intent")
+    check = _PARAM_CHECKS.get(intent) if isinstance(intent, str) else None
+    if check is None:
+        raise ActionSchemaError(f"Intent không hợp lệ: {intent!r}")
+    params = item.get("params")
+    if params is None:
+        params = {}
+    elif not isinstance(params, dict):
+        raise ActionSchemaError(f"params phải là object JSON: {params!r}")
+    return {"intent": intent, "params": check(params)}
+
+
+def validate_actions(items: List[Any]) -> List[dict]:
+    """Kiểm tra danh sách action, bỏ (và ghi log) các phần tử không hợp lệ."""
+    valid = []
+    for item in items:
+        try:
+            valid.append(validate_action(item))
+        except ActionSchemaError as e:
+            print(f"Bỏ action không hợp lệ: {e}")
+    return valid
+
+
+_CODE_FENCE_RE = re.compile(r"^```[a-zA-Z]*\s*(.*?)\s*```$", re.DOTALL)
+
+
+def parse_actions_document(text: str) -> List[dict]:
+    """
+    Phân tích văn bản {"actions": [...]} (có thể nằm trong ```json ... ```) và kiểm tra từng action.
+    Trả về [] nếu văn bản không đúng định dạng.
+    """
+    raw_text = text.strip()
+    fenced = _CODE_FENCE_RE.match(raw_text)
+    if fenced:
+        raw_text = fenced.group(1)
+    try:
+        data = loads(raw_text)
+    except DecodeError as e:
+        print("JSON parse error:", e)
+        print("Raw text:", raw_text)
+        return []
+    actions = data.get("actions") if isinstance(data, dict) else None
+    if not isinstance(actions, list):
+        print("Phản hồi không có mảng actions:", raw_text)
+        return []
+    return validate_actions(actions)
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import re
+import sys
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+from metrics import metrics
+
+# Cache dùng chung cho cả tiến trình, lưu kết quả phân tích câu lệnh từ Gemini
+# theo câu lệnh đã chuẩn hóa. Giới hạn kích thước (LRU) và thời gian sống (TTL).
+
+DEFAULT_MAX_ENTRIES = int(os.getenv("COMMAND_CACHE_SIZE", "1024"))
+DEFAULT_TTL_SECONDS = float(os.getenv("COMMAND_CACHE_TTL", "3600"))
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+_DISTANCE_UNIT_RE = re.compile(r"(\d)\s*(?:mét|met|m)\b")
+_ANGLE_UNIT_RE = re.compile(r"(\d)\s*(?:độ|deg|°)")
+_EDGE_PUNCT = " \t\n.,!?;:\"'"
+
+
+def _canonical_number(match: re.Match) -> str:
+    value = float(match.group(0).replace(",", "."))
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def normalize_utterance(text: str) -> str:
+    """
+    Chuẩn hóa câu lệnh làm khóa cache: NFC (gộp các biến thể dấu),
+    chữ thường, gộp khoảng trắng, chuẩn hóa số ("2,0" -> "2", "2,5" -> "2.5")
+    và đơn vị ("2 mét" -> "2m", "90 độ" -> "90deg").
+    """
+    text = unicodedata.normalize("NFC", text).lower()
+    text = _WHITESPACE_RE.sub(" ", text).strip(_EDGE_PUNCT)
+    text = _NUMBER_RE.sub(_canonical_number, text)
+    text = _DISTANCE_UNIT_RE.sub(r"\1m", text)
+    return _ANGLE_UNIT_RE.sub(r"\1deg", text)
+
+
+def _copy_actions(actions: List[dict]) -> List[dict]:
+    return [{**action, "params": dict(action.get("params", {}))} for action in actions]
+
+
+def _entry_size(key: str, actions: List[dict]) -> int:
+    size = sys.getsizeof(key) + sys.getsizeof(actions)
+    for action in actions:
+        size += sys.getsizeof(action) + sys.getsizeof(action.get("params", {}))
+    return size
+
+
+class CommandCache:
+    """
+    Cache LRU + TTL cho danh sách actions đã phân tích.
+    Các yêu cầu giống nhau đồng thời chỉ tạo một lần gọi Gemini (single-flight).
+    """
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (thời điểm hết hạn, actions, kích thước ước lượng)
+        self._entries: "OrderedDict[str, Tuple[float, List[dict], int]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._memory_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    async def stream(self, text: str, producer: Callable[[], AsyncIterator[dict]]) -> AsyncIterator[dict]:
+        """
+        Lấy actions từ cache; nếu không có thì gọi producer và trả về từng action ngay khi được sinh ra.
+        Nếu đã có một lần gọi producer cho cùng câu lệnh đang chạy, chờ và nhận toàn bộ kết quả của lần đó.
+        """
+        key = normalize_utterance(text)
+        actions = self._lookup(key)
+        if actions is not None:
+            self.hits += 1
+            for action in _copy_actions(actions):
+                yield action
+            return
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            for action in _copy_actions(await asyncio.shield(inflight)):
+                yield action
+            return
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        collected: List[dict] = []
+        try:
+            async for action in producer():
+                collected.append(action)
+                yield {**action, "params": dict(action.get("params", {}))}
+        except BaseException as e:
+            if not isinstance(e, Exception):
+                e = ConnectionError("Yêu cầu phân tích câu lệnh đã bị hủy")
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            self._store(key, collected)
+            future.set_result(collected)
+        finally:
+            self._inflight.pop(key, None)
+
+    def _lookup(self, key: str) -> Optional[List[dict]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, actions, _ = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return actions
+
+    def _store(self, key: str, actions: List[dict]):
+        # Không cache kết quả rỗng (lỗi phân tích)
+        if not actions:
+            return
+        self._remove(key)
+        actions = _copy_actions(actions)
+        size = _entry_size(key, actions)
+        self._entries[key] = (time.monotonic() + self.ttl, actions, size)
+        self._memory_bytes += size
+        while len(self._entries) > self.max_entries:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= entry[2]
+
+    def clear(self):
+        self._entries.clear()
+        self._memory_bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_bytes": self._memory_bytes,
+            "inflight": len(self._inflight),
+        }
+
+
+# Singleton instance
+command_cache = CommandCache()
+
+metrics.counter_callback(
+    "command_cache_requests_total", "Số lần tra cache câu lệnh theo kết quả",
+    lambda: {(result,): command_cache.stats()[result] for result in ("hits", "misses", "coalesced")}, ["result"])
+metrics.gauge_callback("command_cache_entries", "Số câu lệnh đang được cache", lambda: command_cache.stats()["entries"])
@@ -0,0 +1,189 @@
+import re
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+from metrics import metrics
+
+# Bộ phân tích câu lệnh cục bộ, xử lý các lệnh đơn giản theo đúng ngữ pháp
+# mô tả trong TEMPLATE_PROMPT_ANALYZE mà không cần gọi Gemini.
+# Trả về None nếu câu lệnh có bất kỳ phần nào không nhận dạng được,
+# khi đó ws_routes sẽ chuyển câu lệnh cho Gemini.
+# Câu lệnh được so khớp giữ nguyên dấu (chỉ chuẩn hóa NFC, viết thường): bỏ dấu làm
+# "đừng" thành "dừng", "tiền" thành "tiến"... Câu không dấu cũng được chuyển cho Gemini.
+
+DEFAULT_TURN_ANGLE = 90
+
+# Cụm từ -> intent (viết thường, có dấu)
+_INTENT_PHRASES: List[Tuple[Tuple[str, ...], str]] = [
+    (("đi", "thẳng"), "tien"),
+    (("tiến", "tới"), "tien"),
+    (("tiến", "lên"), "tien"),
+    (("tiến", "thẳng"), "tien"),
+    (("tiến",), "tien"),
+    (("đi", "lùi"), "lui"),
+    (("lùi", "lại"), "lui"),
+    (("quay", "lại"), "lui"),
+    (("lùi",), "lui"),
+    (("dừng", "lại"), "dung_lai"),
+    (("ngừng", "lại"), "dung_lai"),
+    (("dừng",), "dung_lai"),
+    (("ngừng",), "dung_lai"),
+    (("rẽ", "trái"), "re_trai"),
+    (("quay", "trái"), "re_trai"),
+    (("quẹo", "trái"), "re_trai"),
+    (("rẽ", "phải"), "re_phai"),
+    (("quay", "phải"), "re_phai"),
+    (("quẹo", "phải"), "re_phai"),
+    (("nâng", "lên"), "nang"),
+    (("nâng",), "nang"),
+    (("hạ", "xuống"), "ha"),
+    (("hạ",), "ha"),
+]
+
+# Từ nối giữa các hành động ("rồi", "nữa", "và", "sau đó") và từ đệm
+_FILLER_PHRASES: List[Tuple[str, ...]] = [
+    ("sau", "đó"),
+    ("rồi",),
+    ("nữa",),
+    ("và",),
+    ("hãy",),
+    (",",),
+    (".",),
+]
+
+_DISTANCE_UNITS = {"m": "m", "mét": "m"}
+_ANGLE_UNITS = {"độ": "deg", "deg": "deg", "°": "deg"}
+
+_NUMBER_WORDS = {
+    "một": 1, "hai": 2, "ba": 3, "bốn": 4, "năm": 5,
+    "sáu": 6, "bảy": 7, "tám": 8, "chín": 9, "mười": 10,
+}
+
+# Tham số hợp lệ cho từng intent: (tên tham số, bảng đơn vị)
+_INTENT_PARAMS = {
+    "tien": ("distance", _DISTANCE_UNITS),
+    "lui": ("distance", _DISTANCE_UNITS),
+    "re_trai": ("angle", _ANGLE_UNITS),
+    "re_phai": ("angle", _ANGLE_UNITS),
+}
+
+# Token (số, từ, ký hiệu độ và dấu ngắt câu), dấu câu bỏ qua được, hoặc ký tự không nhận dạng được
+_TOKEN_RE = re.compile(r"(?P<token>\d+(?:[.,]\d+)?|[^\W\d_]+|[°,.])|(?P<ignored>[\s!?;:\"'…]+)|(?P<unknown>.)")
+
+
+def _index_phrases(phrases):
+    """Nhóm cụm từ theo token đầu tiên, cụm dài hơn được thử trước."""
+    index: Dict[str, list] = {}
+    for entry in phrases:
+        words = entry[0] if isinstance(entry[0], tuple) else entry
+        index.setdefault(words[0], []).append(entry)
+    for entries in index.values():
+        entries.sort(key=lambda e: -len(e[0] if isinstance(e[0], tuple) else e))
+    return index
+
+
+_INTENT_INDEX = _index_phrases(_INTENT_PHRASES)
+_FILLER_INDEX = _index_phrases(_FILLER_PHRASES)
+
+
+LOCAL_PARSER_RESULTS = metrics.counter(
+    "local_parser_total", "Kết quả bộ phân tích cục bộ: hit (tự xử lý) hoặc miss (chuyển cho Gemini)", ["result"])
+
+
+def normalize_text(text: str) -> str:
+    """Chuẩn hóa NFC (dấu gõ tổ hợp và dựng sẵn như nhau) và chuyển về chữ thường, giữ nguyên dấu."""
+    return unicodedata.normalize("NFC", text).lower()
+
+
+def tokenize(text: str) -> Optional[List[str]]:
+    """
+    Tách câu lệnh thành token. Trả về None nếu có ký tự không nhận dạng được (vd. "-" trong "tiến -2 mét"):
+    bỏ qua ký tự đó có thể đổi nghĩa câu lệnh, nên để Gemini xử lý.
+    """
+    tokens = []
+    for match in _TOKEN_RE.finditer(normalize_text(text)):
+        if match.lastgroup == "unknown":
+            return None
+        if match.lastgroup == "token":
+            tokens.append(match.group())
+    return tokens
+
+
+def _match(tokens: List[str], pos: int, words: Tuple[str, ...]) -> bool:
+    return tuple(tokens[pos:pos + len(words)]) == words
+
+
+def _match_filler(tokens: List[str], pos: int) -> int:
+    """Trả về số token của từ nối tại vị trí pos (0 nếu không khớp)."""
+    for words in _FILLER_INDEX.get(tokens[pos], ()):
+        if _match(tokens, pos, words):
+            return len(words)
+    return 0
+
+
+def _parse_number(token: str):
+    if token in _NUMBER_WORDS:
+        return _NUMBER_WORDS[token]
+    if not token[0].isdigit():
+        return None
+    value = float(token.replace(",", "."))
+    return int(value) if value.is_integer() else value
+
+
+class LocalCommandParser:
+    """
+    Phân tích câu lệnh di chuyển đơn giản ngay tại server.
+    Kết quả có cùng dạng với danh sách actions của normalize_response.
+    """
+    def parse(self, text: str) -> Optional[List[dict]]:
+        tokens = tokenize(text)
+        actions = self._parse_tokens(tokens) if tokens is not None else None
+        if actions:
+            LOCAL_PARSER_RESULTS.inc("hit")
+            return actions
+        LOCAL_PARSER_RESULTS.inc("miss")
+        return None
+
+    def _parse_tokens(self, tokens: List[str]) -> Optional[List[dict]]:
+        actions: List[dict] = []
+        pos = 0
+        n = len(tokens)
+        while pos < n:
+            skip = _match_filler(tokens, pos)
+            if skip:
+                pos += skip
+                continue
+
+            intent = None
+            for words, candidate in _INTENT_INDEX.get(tokens[pos], ()):
+                if _match(tokens, pos, words):
+                    intent = candidate
+                    pos += len(words)
+                    break
+            if intent is None:
+                return None
+
+            params: dict = {}
+            param_spec = _INTENT_PARAMS.get(intent)
+            # Số + đơn vị ngay sau hành động (bỏ qua nếu đó là từ nối "sau đó")
+            if pos < n and not _match_filler(tokens, pos):
+                value = _parse_number(tokens[pos])
+                if value is not None:
+                    if param_spec is None or pos + 1 >= n:
+                        return None
+                    name, units = param_spec
+                    unit = units.get(tokens[pos + 1])
+                    if unit is None:
+                        return None
+                    params = {name: value, "unit": unit}
+                    pos += 2
+
+            if not params and intent in ("re_trai", "re_phai"):
+                params = {"angle": DEFAULT_TURN_ANGLE, "unit": "deg"}
+
+            actions.append({"intent": intent, "params": params})
+
+        return actions or None
+
+
+# Singleton instance
+local_parser = LocalCommandParser()
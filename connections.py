@@ -1,87 +1,813 @@
-from typing import Dict, Optional
+import asyncio
+import bisect
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
 from fastapi import WebSocket
+from wire import WIRE_JSON
+from liveness import liveness_monitor
+from metrics import metrics
 
-# Lưu các kết nối hiện tại - Quan hệ 1:1 giữa robot và client
-robot_connections: Dict[str, WebSocket] = {}
-client_connections: Dict[str, WebSocket] = {}
-client_to_robot_mapping: Dict[WebSocket, str] = {}  # Ánh xạ ngược từ client websocket đến robot_id
+# Backend của registry: "memory" (mặc định, 1 worker) hoặc "sqlite" (nhiều worker/tiến trình dùng chung file)
+REGISTRY_BACKEND = os.getenv("CONNECTION_REGISTRY", "memory")
+REGISTRY_PATH = os.getenv("CONNECTION_REGISTRY_PATH", "/tmp/robot_registry.db")
+# Thời hạn lease của robot/client; worker gia hạn định kỳ, hết hạn nghĩa là worker đã chết
+LEASE_TTL = float(os.getenv("CONNECTION_LEASE_TTL", "10"))
+POLL_INTERVAL = float(os.getenv("CONNECTION_POLL_INTERVAL", "0.02"))
+# Chu kỳ đọc lại lease của các worker khác vào bộ nhớ (tra cứu lease không truy vấn SQLite)
+LEASE_REFRESH = float(os.getenv("CONNECTION_LEASE_REFRESH", "0.1"))
+# Số lệnh SQLite tối đa gộp vào một transaction của thread registry
+REGISTRY_MAX_BATCH = 256
+# Số thay đổi trạng thái gần nhất được giữ lại cho các feed delta
+FLEET_DELTA_HISTORY = int(os.getenv("FLEET_DELTA_HISTORY", "4096"))
 
-def register_robot(robot_id: str, ws: WebSocket) -> bool:
+ROLE_ROBOT = "robot"
+ROLE_CLIENT = "client"
+
+STATUS_AVAILABLE = "available"
+STATUS_CONTROLLED = "controlled"
+STATUS_STALE = "stale"
+ROBOT_STATUSES = (STATUS_AVAILABLE, STATUS_CONTROLLED, STATUS_STALE)
+
+# Handler xử lý frame của robot được chuyển tới worker đang giữ client điều khiển
+RobotFrameHandler = Callable[[str, dict], Awaitable[None]]
+
+
+class FleetStatusIndex:
     """
-    Đăng ký robot. Nếu robot đã tồn tại, trả về False
+    Trạng thái của mọi robot, cập nhật tăng dần khi robot/client kết nối hoặc ngắt.
+    - Bộ đếm theo trạng thái và danh sách robot_id đã sắp xếp (phân trang theo con trỏ) luôn sẵn,
+      không phải duyệt toàn bộ robot mỗi lần đọc.
+    - Mỗi thay đổi tăng version và được ghi vào nhật ký delta có giới hạn,
+      người theo dõi chờ version mới rồi chỉ đọc phần thay đổi.
     """
-    if robot_id in robot_connections:
-        return False  # Robot đã được kết nối
-    
-    robot_connections[robot_id] = ws
-    return True
+    def __init__(self, history: int = FLEET_DELTA_HISTORY):
+        self.version = 0
+        self._statuses: Dict[str, str] = {}
+        self._sorted_ids: List[str] = []
+        self._ids_by_status: Dict[str, List[str]] = {status: [] for status in ROBOT_STATUSES}
+        # (version, robot_id, trạng thái mới hoặc None nếu robot bị xóa)
+        self._deltas: deque = deque(maxlen=history)
+        self._changed = asyncio.Event()
 
-async def unregister_robot(robot_id: str):
+    def __len__(self) -> int:
+        return len(self._statuses)
+
+    def get(self, robot_id: str) -> Optional[str]:
+        return self._statuses.get(robot_id)
+
+    def set(self, robot_id: str, status: str):
+        old = self._statuses.get(robot_id)
+        if old == status:
+            return
+        if old is None:
+            bisect.insort(self._sorted_ids, robot_id)
+        else:
+            self._remove_sorted(self._ids_by_status[old], robot_id)
+        bisect.insort(self._ids_by_status[status], robot_id)
+        self._statuses[robot_id] = status
+        self._record(robot_id, status)
+
+    def remove(self, robot_id: str):
+        old = self._statuses.pop(robot_id, None)
+        if old is None:
+            return
+        self._remove_sorted(self._sorted_ids, robot_id)
+        self._remove_sorted(self._ids_by_status[old], robot_id)
+        self._record(robot_id, None)
+
+    @staticmethod
+    def _remove_sorted(ids: List[str], robot_id: str):
+        i = bisect.bisect_left(ids, robot_id)
+        if i < len(ids) and ids[i] == robot_id:
+            del ids[i]
+
+    def _record(self, robot_id: str, status: Optional[str]):
+        self.version += 1
+        self._deltas.append((self.version, robot_id, status))
+        # Đánh thức mọi người đang chờ, lần chờ sau dùng event mới
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def counts(self) -> Dict[str, int]:
+        counts = {status: len(ids) for status, ids in self._ids_by_status.items()}
+        counts["total"] = len(self._statuses)
+        return counts
+
+    def snapshot(self) -> Dict[str, str]:
+        return dict(self._statuses)
+
+    def page(self, after: Optional[str] = None, limit: Optional[int] = None,
+             status: Optional[str] = None) -> Tuple[Dict[str, str], Optional[str]]:
+        """
+        Lấy tối đa `limit` robot có robot_id > after (theo thứ tự robot_id), lọc theo trạng thái nếu có.
+        Trả về (robot_id -> trạng thái, con trỏ trang sau hoặc None).
+        """
+        ids = self._sorted_ids if status is None else self._ids_by_status.get(status, [])
+        start = bisect.bisect_right(ids, after) if after is not None else 0
+        end = len(ids) if limit is None else min(len(ids), start + limit)
+        robots = {robot_id: self._statuses[robot_id] for robot_id in ids[start:end]}
+        next_cursor = ids[end - 1] if end < len(ids) and end > start else None
+        return robots, next_cursor
+
+    def deltas_since(self, version: int) -> Optional[List[Tuple[int, str, Optional[str]]]]:
+        """Các thay đổi sau version, hoặc None nếu nhật ký không còn đủ (cần lấy lại snapshot)."""
+        if version >= self.version:
+            return []
+        if not self._deltas or self._deltas[0][0] > version + 1:
+            return None
+        start = version + 1 - self._deltas[0][0]
+        return [self._deltas[i] for i in range(start, len(self._deltas))]
+
+    async def wait_for_change(self, version: int, timeout: float) -> bool:
+        """Chờ đến khi version lớn hơn version đã biết. Trả về False nếu hết thời gian."""
+        if self.version != version:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.version != version
+
+
+class ConnectionRegistry:
     """
-    Hủy đăng ký robot và client đang điều khiển nó
+    Registry kết nối trong bộ nhớ - Quan hệ 1:1 giữa robot và client.
+    Chỉ đúng khi robot và client cùng nằm trong một tiến trình.
     """
-    robot_connections.pop(robot_id, None)
-    
-    # Hủy client đang điều khiển robot này
-    if robot_id in client_connections:
-        client_ws = client_connections.pop(robot_id)
-        client_to_robot_mapping.pop(client_ws, None)
+    def __init__(self):
+        # Lưu các kết nối hiện tại của tiến trình này
+        self.robot_connections: Dict[str, WebSocket] = {}
+        self.client_connections: Dict[str, WebSocket] = {}
+        self.client_to_robot_mapping: Dict[WebSocket, str] = {}  # Ánh xạ ngược từ client websocket đến robot_id
+        self.robot_wire_formats: Dict[str, str] = {}  # Giao thức robot đã chọn khi kết nối (json/bin)
+        self.robot_windows: Dict[str, int] = {}  # Kích thước cửa sổ action robot đã khai báo
+        self.fleet = FleetStatusIndex()
+        self._robot_frame_handler: Optional[RobotFrameHandler] = None
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def set_robot_frame_handler(self, handler: RobotFrameHandler):
+        self._robot_frame_handler = handler
+
+    async def register_robot(self, robot_id: str, ws: WebSocket, wire_format: str = WIRE_JSON, window: int = 1) -> bool:
+        if robot_id in self.robot_connections:
+            return False  # Robot đã được kết nối
+
+        self.robot_connections[robot_id] = ws
+        self.robot_wire_formats[robot_id] = wire_format
+        self.robot_windows[robot_id] = window
+        self._update_status(robot_id)
+        return True
+
+    async def unregister_robot(self, robot_id: str):
+        self.robot_connections.pop(robot_id, None)
+        self.robot_wire_formats.pop(robot_id, None)
+        self.robot_windows.pop(robot_id, None)
+        self.fleet.remove(robot_id)
+
+        # Hủy client đang điều khiển robot này
+        client_ws = self.client_connections.pop(robot_id, None)
+        if client_ws is not None:
+            self.client_to_robot_mapping.pop(client_ws, None)
+            try:
+                await client_ws.close(code=1000) # Đóng kết nối WebSocket của client
+            except RuntimeError:
+                # Có thể client đã bị ngắt kết nối
+                pass
+
+    async def register_client(self, robot_id: str, ws: WebSocket) -> bool:
+        # Kiểm tra robot có tồn tại không
+        if robot_id not in self.robot_connections:
+            return False
+
+        # Kiểm tra robot đã có client điều khiển chưa
+        if robot_id in self.client_connections:
+            return False  # Robot đã có client điều khiển
+
+        self.client_connections[robot_id] = ws
+        self.client_to_robot_mapping[ws] = robot_id
+        self._update_status(robot_id)
+        return True
+
+    def unregister_client(self, client_ws: WebSocket) -> Optional[str]:
+        robot_id = self.client_to_robot_mapping.pop(client_ws, None)
+        if robot_id:
+            self.client_connections.pop(robot_id, None)
+            self._update_status(robot_id)
+        return robot_id
+
+    def _update_status(self, robot_id: str):
+        """Cập nhật chỉ mục trạng thái sau khi robot/client của robot_id thay đổi."""
+        if robot_id in self.robot_connections:
+            self.fleet.set(robot_id, self.get_robot_status(robot_id))
+
+    def on_robot_stale(self, robot_id: str, stale: bool):
+        self._update_status(robot_id)
+
+    def get_robot(self, robot_id: str):
+        return self.robot_connections.get(robot_id)
+
+    def get_client(self, robot_id: str):
+        return self.client_connections.get(robot_id)
+
+    def is_client_local(self, robot_id: str) -> bool:
+        return True
+
+    def is_robot_local(self, robot_id: str) -> bool:
+        return robot_id in self.robot_connections
+
+    async def forward_robot_frame(self, robot_id: str, frame: dict):
+        """Chuyển frame của robot tới worker giữ client điều khiển (cùng tiến trình: gọi trực tiếp)."""
+        if self._robot_frame_handler:
+            await self._robot_frame_handler(robot_id, frame)
+
+    def get_robot_wire_format(self, robot_id: str) -> str:
+        return self.robot_wire_formats.get(robot_id, WIRE_JSON)
+
+    def get_robot_window(self, robot_id: str) -> int:
+        return self.robot_windows.get(robot_id, 1)
+
+    def get_robot_status(self, robot_id: str) -> str:
+        # Robot không trả lời heartbeat đúng hạn, sắp bị loại
+        if liveness_monitor.is_stale(robot_id):
+            return STATUS_STALE
+        if robot_id in self.client_connections:
+            return STATUS_CONTROLLED
+        else:
+            return STATUS_AVAILABLE
+
+    def get_all_robots_status(self) -> Dict[str, str]:
+        return self.fleet.snapshot()
+
+
+class RemoteWebSocket:
+    """
+    Đại diện cho WebSocket nằm ở worker khác.
+    Các lệnh gửi/đóng được ghi vào hộp thư của worker sở hữu kết nối.
+    """
+    def __init__(self, registry: "SqliteConnectionRegistry", robot_id: str, role: str, worker_id: str):
+        self._registry = registry
+        self.robot_id = robot_id
+        self.role = role
+        self.worker_id = worker_id
+
+    async def send_text(self, data: str, control: bool = False, coalesce_key: Optional[str] = None):
+        self._registry.post(self.worker_id, self.robot_id, self.role, "text", data.encode("utf-8"))
+
+    async def send_bytes(self, data: bytes, control: bool = False, coalesce_key: Optional[str] = None):
+        self._registry.post(self.worker_id, self.robot_id, self.role, "bytes", bytes(data))
+
+    async def close(self, code: int = 1000, reason: Optional[str] = None):
+        self._registry.post(self.worker_id, self.robot_id, self.role, "close", str(code).encode())
+
+
+_STOP = object()
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS leases (
+        robot_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        worker_id TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        wire_format TEXT NOT NULL DEFAULT 'json',
+        window INTEGER NOT NULL DEFAULT 1,
+        stale INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (robot_id, role)
+    );
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        worker_id TEXT NOT NULL,
+        robot_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        payload BLOB
+    );
+    CREATE INDEX IF NOT EXISTS messages_worker ON messages (worker_id, id);
+"""
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(path, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA busy_timeout=5000")
+    return db
+
+
+def _resolve(future: asyncio.Future, result, error: Optional[BaseException]):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class _SqliteWorker:
+    """
+    Thread riêng giữ kết nối SQLite của registry. Mọi truy vấn chạy ở đây theo thứ tự được gửi vào,
+    các lệnh xếp hàng cùng lúc được gộp vào một transaction; event loop không chờ khóa file.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="connection-registry", daemon=True)
+            self._thread.start()
+
+    def execute(self, func: Callable, *args):
+        """Xếp func(db, *args) vào hàng đợi, không chờ kết quả."""
+        self.start()
+        self._queue.put((func, args, None))
+
+    def call(self, func: Callable, *args) -> asyncio.Future:
+        """Xếp func(db, *args) vào hàng đợi, trả về future nhận kết quả trên event loop hiện tại."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put((func, args, future))
+        return future
+
+    def close(self):
+        """Chạy nốt các lệnh còn trong hàng đợi rồi dừng thread."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout=5)
+        self._thread = None
+
+    def _run(self):
+        db = _connect(self.path)
+        stopping = False
+        while not stopping:
+            batch: List[tuple] = []
+            item = self._queue.get()
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= REGISTRY_MAX_BATCH:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._commit(db, batch)
+        db.close()
+
+    def _commit(self, db: sqlite3.Connection, batch: List[tuple]):
+        results = []
         try:
-            await client_ws.close(code=1000) # Đóng kết nối WebSocket của client
+            db.execute("BEGIN IMMEDIATE")
+            for func, args, future in batch:
+                try:
+                    results.append((future, func(db, *args), None))
+                except sqlite3.Error as e:
+                    results.append((future, None, e))
+            db.execute("COMMIT")
+        except sqlite3.Error as e:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            results = [(future, None, e) for _, _, future in batch]
+
+        for future, result, error in results:
+            if future is None:
+                if error is not None:
+                    print(f"Lỗi khi ghi registry: {error}")
+                continue
+            try:
+                future.get_loop().call_soon_threadsafe(_resolve, future, result, error)
+            except RuntimeError:
+                # Event loop đã đóng
+                pass
+
+
+class SqliteConnectionRegistry(ConnectionRegistry):
+    """
+    Registry dùng chung giữa nhiều worker qua một file SQLite.
+    - Mỗi robot_id/client có một lease gắn với worker sở hữu WebSocket, được gia hạn định kỳ.
+    - Tin nhắn tới kết nối ở worker khác được ghi vào bảng messages, worker đích đọc và gửi đi.
+    - Lease của worker không còn gia hạn sẽ hết hạn và bị dọn, robot có thể kết nối lại ở worker khác.
+    - Chỉ thread registry (_SqliteWorker) truy cập SQLite. Lease của worker khác được đọc lại vào bộ nhớ
+      mỗi LEASE_REFRESH giây, nên việc tra cứu lease (mỗi frame của robot) không truy vấn file.
+    """
+    def __init__(self, path: str = REGISTRY_PATH, lease_ttl: float = LEASE_TTL, poll_interval: float = POLL_INTERVAL,
+                 lease_refresh: float = LEASE_REFRESH):
+        super().__init__()
+        self.path = path
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.lease_refresh = lease_refresh
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        db = _connect(path)
+        db.executescript(_SCHEMA)
+        try:
+            # File registry tạo bởi phiên bản trước chưa có cột stale
+            db.execute("ALTER TABLE leases ADD COLUMN stale INTEGER NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+        db.close()
+        self._worker = _SqliteWorker(path)
+        # Lease của worker này: (robot_id, role) -> (worker_id, wire_format, window)
+        self._own_leases: Dict[Tuple[str, str], tuple] = {}
+        # Lease của các worker khác, đọc lại định kỳ:
+        # (robot_id, role) -> (worker_id, wire_format, window, expires_at, stale)
+        self._remote_leases: Dict[Tuple[str, str], tuple] = {}
+        self._poll_task: Optional[asyncio.Task] = None
+        self._last_renew = 0.0
+        self._last_refresh = 0.0
+
+    async def start(self):
+        if self._poll_task is None or self._poll_task.done():
+            self._poll_task = asyncio.create_task(self._poll_loop())
+
+    async def close(self):
+        if self._poll_task:
+            self._poll_task.cancel()
+            self._poll_task = None
+        await self._worker.call(self._delete_worker)
+        await asyncio.to_thread(self._worker.close)
+        self._own_leases.clear()
+        self._remote_leases.clear()
+
+    def _ensure_started(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._poll_task is None or self._poll_task.done():
+            self._poll_task = asyncio.create_task(self._poll_loop())
+
+    # --- Các hàm dưới đây (tham số db) chỉ chạy trong thread registry ---
+
+    def _acquire_lease(self, db: sqlite3.Connection, robot_id: str, role: str,
+                       wire_format: str = WIRE_JSON, window: int = 1) -> bool:
+        """Lấy lease nếu chưa có ai giữ hoặc lease cũ đã hết hạn."""
+        now = time.time()
+        cursor = db.execute("""
+            INSERT INTO leases (robot_id, role, worker_id, expires_at, wire_format, window)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (robot_id, role) DO UPDATE SET
+                worker_id = excluded.worker_id, expires_at = excluded.expires_at,
+                wire_format = excluded.wire_format, window = excluded.window, stale = 0
+            WHERE leases.expires_at < ?
+        """, (robot_id, role, self.worker_id, now + self.lease_ttl, wire_format, window, now))
+        return cursor.rowcount == 1
+
+    def _acquire_client_lease(self, db: sqlite3.Connection, robot_id: str) -> Optional[tuple]:
+        """Lấy lease client nếu robot đang kết nối (ở bất kỳ worker nào). Trả về lease của robot nếu thành công."""
+        robot = db.execute(
+            "SELECT worker_id, wire_format, window, expires_at, stale FROM leases "
+            "WHERE robot_id = ? AND role = ? AND expires_at >= ?",
+            (robot_id, ROLE_ROBOT, time.time())).fetchone()
+        if robot is None or not self._acquire_lease(db, robot_id, ROLE_CLIENT):
+            return None
+        return robot
+
+    def _release_lease(self, db: sqlite3.Connection, robot_id: str, role: str):
+        db.execute("DELETE FROM leases WHERE robot_id = ? AND role = ? AND worker_id = ?",
+                   (robot_id, role, self.worker_id))
+
+    def _set_stale(self, db: sqlite3.Connection, robot_id: str, stale: bool):
+        db.execute("UPDATE leases SET stale = ? WHERE robot_id = ? AND role = ? AND worker_id = ?",
+                   (int(stale), robot_id, ROLE_ROBOT, self.worker_id))
+
+    def _insert_message(self, db: sqlite3.Connection, worker_id: str, robot_id: str, role: str,
+                        kind: str, payload: bytes):
+        db.execute("INSERT INTO messages (worker_id, robot_id, role, kind, payload) VALUES (?, ?, ?, ?, ?)",
+                   (worker_id, robot_id, role, kind, payload))
+
+    def _read_remote_leases(self, db: sqlite3.Connection) -> Dict[Tuple[str, str], tuple]:
+        rows = db.execute(
+            "SELECT robot_id, role, worker_id, wire_format, window, expires_at, stale FROM leases "
+            "WHERE expires_at >= ? AND worker_id != ?", (time.time(), self.worker_id)).fetchall()
+        return {(robot_id, role): lease for robot_id, role, *lease in rows}
+
+    def _fetch_messages(self, db: sqlite3.Connection) -> List[tuple]:
+        rows = db.execute(
+            "SELECT id, robot_id, role, kind, payload FROM messages WHERE worker_id = ? ORDER BY id",
+            (self.worker_id,)).fetchall()
+        if rows:
+            db.execute("DELETE FROM messages WHERE worker_id = ? AND id <= ?", (self.worker_id, rows[-1][0]))
+        return rows
+
+    def _renew_and_cleanup(self, db: sqlite3.Connection):
+        """Gia hạn lease của worker này và dọn lease/tin nhắn của các worker đã chết."""
+        now = time.time()
+        db.execute("UPDATE leases SET expires_at = ? WHERE worker_id = ?", (now + self.lease_ttl, self.worker_id))
+        db.execute("DELETE FROM leases WHERE expires_at < ?", (now - self.lease_ttl,))
+        db.execute("DELETE FROM messages WHERE worker_id NOT IN (SELECT worker_id FROM leases)")
+
+    def _poll(self, db: sqlite3.Connection, renew: bool, refresh: bool):
+        if renew:
+            self._renew_and_cleanup(db)
+        leases = self._read_remote_leases(db) if refresh else None
+        return leases, self._fetch_messages(db)
+
+    def _delete_worker(self, db: sqlite3.Connection):
+        db.execute("DELETE FROM leases WHERE worker_id = ?", (self.worker_id,))
+        db.execute("DELETE FROM messages WHERE worker_id = ?", (self.worker_id,))
+
+    # --- Event loop ---
+
+    async def _await_lease(self, future: asyncio.Future, robot_id: str, role: str):
+        """Chờ kết quả lấy lease; nếu người chờ bị hủy thì trả lại lease đã lấy được."""
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            def release(done: asyncio.Future):
+                if not done.cancelled() and done.exception() is None and done.result():
+                    self._worker.execute(self._release_lease, robot_id, role)
+            future.add_done_callback(release)
+            raise
+
+    def _lease(self, robot_id: str, role: str) -> Optional[tuple]:
+        """Lease đang hiệu lực (worker_id, wire_format, window), đọc từ bộ nhớ."""
+        key = (robot_id, role)
+        lease = self._own_leases.get(key)
+        if lease is not None:
+            return lease
+        lease = self._remote_leases.get(key)
+        if lease is not None and lease[3] >= time.time():
+            return lease
+        return None
+
+    async def register_robot(self, robot_id: str, ws: WebSocket, wire_format: str = WIRE_JSON, window: int = 1) -> bool:
+        self._ensure_started()
+        if robot_id in self.robot_connections:
+            return False
+        acquired = await self._await_lease(
+            self._worker.call(self._acquire_lease, robot_id, ROLE_ROBOT, wire_format, window), robot_id, ROLE_ROBOT)
+        if not acquired:
+            return False
+        self._own_leases[(robot_id, ROLE_ROBOT)] = (self.worker_id, wire_format, window)
+        return await super().register_robot(robot_id, ws, wire_format, window)
+
+    async def unregister_robot(self, robot_id: str):
+        if robot_id not in self.robot_connections:
+            return
+        self._own_leases.pop((robot_id, ROLE_ROBOT), None)
+        self._worker.execute(self._release_lease, robot_id, ROLE_ROBOT)
+        client_ws = self.get_client(robot_id)
+        await super().unregister_robot(robot_id)
+        # Client điều khiển nằm ở worker khác: yêu cầu worker đó đóng kết nối
+        if isinstance(client_ws, RemoteWebSocket):
+            await client_ws.close(code=1000)
+
+    async def register_client(self, robot_id: str, ws: WebSocket) -> bool:
+        self._ensure_started()
+        if robot_id in self.client_connections or self._lease(robot_id, ROLE_CLIENT) is not None:
+            return False
+        robot = await self._await_lease(
+            self._worker.call(self._acquire_client_lease, robot_id), robot_id, ROLE_CLIENT)
+        if robot is None:
+            return False
+        if robot[0] != self.worker_id:
+            # Robot vừa kết nối ở worker khác có thể chưa có trong lần đọc lease gần nhất
+            self._remote_leases[(robot_id, ROLE_ROBOT)] = tuple(robot)
+        self._own_leases[(robot_id, ROLE_CLIENT)] = (self.worker_id, WIRE_JSON, 1)
+        self.client_connections[robot_id] = ws
+        self.client_to_robot_mapping[ws] = robot_id
+        self._update_status(robot_id)
+        return True
+
+    def unregister_client(self, client_ws: WebSocket) -> Optional[str]:
+        robot_id = self.client_to_robot_mapping.get(client_ws)
+        if robot_id:
+            self._own_leases.pop((robot_id, ROLE_CLIENT), None)
+            self._worker.execute(self._release_lease, robot_id, ROLE_CLIENT)
+        return super().unregister_client(client_ws)
+
+    def get_robot(self, robot_id: str):
+        return self._get_connection(robot_id, ROLE_ROBOT, self.robot_connections)
+
+    def get_client(self, robot_id: str):
+        return self._get_connection(robot_id, ROLE_CLIENT, self.client_connections)
+
+    def _get_connection(self, robot_id: str, role: str, local: Dict[str, WebSocket]):
+        ws = local.get(robot_id)
+        if ws is not None:
+            return ws
+        lease = self._lease(robot_id, role)
+        if lease is None:
+            return None
+        return RemoteWebSocket(self, robot_id, role, lease[0])
+
+    def is_client_local(self, robot_id: str) -> bool:
+        return robot_id in self.client_connections or self._lease(robot_id, ROLE_CLIENT) is None
+
+    async def forward_robot_frame(self, robot_id: str, frame: dict):
+        lease = self._lease(robot_id, ROLE_CLIENT)
+        if lease is None or lease[0] == self.worker_id:
+            await super().forward_robot_frame(robot_id, frame)
+        elif frame.get("bytes") is not None:
+            self.post(lease[0], robot_id, ROLE_CLIENT, "frame_bytes", frame["bytes"])
+        else:
+            self.post(lease[0], robot_id, ROLE_CLIENT, "frame_text", frame["text"].encode("utf-8"))
+
+    def get_robot_wire_format(self, robot_id: str) -> str:
+        if robot_id in self.robot_wire_formats:
+            return self.robot_wire_formats[robot_id]
+        lease = self._lease(robot_id, ROLE_ROBOT)
+        return lease[1] if lease else WIRE_JSON
+
+    def get_robot_window(self, robot_id: str) -> int:
+        if robot_id in self.robot_windows:
+            return self.robot_windows[robot_id]
+        lease = self._lease(robot_id, ROLE_ROBOT)
+        return lease[2] if lease else 1
+
+    def on_robot_stale(self, robot_id: str, stale: bool):
+        # Chỉ worker giữ robot biết heartbeat của robot: ghi vào lease để các worker khác cũng thấy
+        if (robot_id, ROLE_ROBOT) in self._own_leases:
+            self._worker.execute(self._set_stale, robot_id, stale)
+        super().on_robot_stale(robot_id, stale)
+
+    def get_robot_status(self, robot_id: str) -> str:
+        if liveness_monitor.is_stale(robot_id):
+            return STATUS_STALE
+        remote = self._remote_leases.get((robot_id, ROLE_ROBOT))
+        if remote is not None and remote[4] and robot_id not in self.robot_connections:
+            return STATUS_STALE
+        if self._lease(robot_id, ROLE_CLIENT) is not None:
+            return STATUS_CONTROLLED
+        else:
+            return STATUS_AVAILABLE
+
+    def _update_status(self, robot_id: str):
+        # Robot có thể nằm ở worker khác: đọc trạng thái từ lease
+        if robot_id in self.robot_connections or self._lease(robot_id, ROLE_ROBOT) is not None:
+            self.fleet.set(robot_id, self.get_robot_status(robot_id))
+        else:
+            self.fleet.remove(robot_id)
+
+    @staticmethod
+    def _changed_robots(old: Dict[Tuple[str, str], tuple], new: Dict[Tuple[str, str], tuple]) -> set:
+        """robot_id có lease xuất hiện, biến mất, đổi worker hoặc đổi cờ stale giữa hai lần đọc."""
+        changed = {robot_id for (robot_id, _) in old.keys() - new.keys()}
+        for key, lease in new.items():
+            previous = old.get(key)
+            if previous is None or previous[0] != lease[0] or previous[4] != lease[4]:
+                changed.add(key[0])
+        return changed
+
+    def post(self, worker_id: str, robot_id: str, role: str, kind: str, payload: bytes):
+        """Ghi tin nhắn vào hộp thư của worker đích (thread registry ghi, không chờ)."""
+        self._worker.execute(self._insert_message, worker_id, robot_id, role, kind, payload)
+
+    async def _poll_loop(self):
+        while True:
+            try:
+                now = time.monotonic()
+                renew = now - self._last_renew > self.lease_ttl / 3
+                if renew:
+                    self._last_renew = now
+                refresh = now - self._last_refresh >= self.lease_refresh
+                if refresh:
+                    self._last_refresh = now
+                leases, messages = await self._worker.call(self._poll, renew, refresh)
+                if leases is not None:
+                    # Robot/client ở worker khác chỉ thấy được qua bảng leases: chỉ cập nhật robot có lease thay đổi
+                    changed = self._changed_robots(self._remote_leases, leases)
+                    self._remote_leases = leases
+                    for robot_id in changed:
+                        self._update_status(robot_id)
+                for _, robot_id, role, kind, payload in messages:
+                    await self._deliver(robot_id, role, kind, payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Lỗi khi xử lý hộp thư registry: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _deliver(self, robot_id: str, role: str, kind: str, payload: bytes):
+        if kind == "frame_text":
+            await super().forward_robot_frame(robot_id, {"text": payload.decode("utf-8")})
+            return
+        if kind == "frame_bytes":
+            await super().forward_robot_frame(robot_id, {"bytes": payload})
+            return
+
+        local = self.robot_connections if role == ROLE_ROBOT else self.client_connections
+        ws = local.get(robot_id)
+        if ws is None:
+            return
+        # Tin gửi tới robot luôn là tin điều khiển (action, flush)
+        control = role == ROLE_ROBOT
+        try:
+            if kind == "text":
+                await ws.send_text(payload.decode("utf-8"), control=control)
+            elif kind == "bytes":
+                await ws.send_bytes(payload, control=control)
+            elif kind == "close":
+                await ws.close(code=int(payload))
         except RuntimeError:
-            # Có thể client đã bị ngắt kết nối
+            # Kết nối đã đóng
             pass
 
-def register_client(robot_id: str, ws: WebSocket) -> bool:
+
+def create_registry(backend: str = REGISTRY_BACKEND) -> ConnectionRegistry:
+    if backend == "sqlite":
+        return SqliteConnectionRegistry()
+    return ConnectionRegistry()
+
+
+# Registry dùng cho toàn tiến trình
+registry: ConnectionRegistry = create_registry()
+liveness_monitor.set_stale_listener(registry.on_robot_stale)
+
+metrics.gauge_callback("connected_robots", "Số robot đang kết nối với worker này", lambda: len(registry.robot_connections))
+metrics.gauge_callback("connected_clients", "Số client đang kết nối với worker này", lambda: len(registry.client_connections))
+
+async def register_robot(robot_id: str, ws: WebSocket, wire_format: str = WIRE_JSON, window: int = 1) -> bool:
+    """
+    Đăng ký robot. Nếu robot đã tồn tại, trả về False
+    """
+    return await registry.register_robot(robot_id, ws, wire_format, window)
+
+async def unregister_robot(robot_id: str):
+    """
+    Hủy đăng ký robot và client đang điều khiển nó
+    """
+    await registry.unregister_robot(robot_id)
+
+async def register_client(robot_id: str, ws: WebSocket) -> bool:
     """
-    Đăng ký client để điều khiển robot. 
+    Đăng ký client để điều khiển robot.
     Chỉ cho phép 1 client điều khiển 1 robot.
     Trả về True nếu thành công, False nếu robot đã có client hoặc không tồn tại
     """
-    # Kiểm tra robot có tồn tại không
-    if robot_id not in robot_connections:
-        return False
-    
-    # Kiểm tra robot đã có client điều khiển chưa
-    if robot_id in client_connections:
-        return False  # Robot đã có client điều khiển
-    
-    # Đăng ký client
-    client_connections[robot_id] = ws
-    client_to_robot_mapping[ws] = robot_id
-    return True
+    return await registry.register_client(robot_id, ws)
 
 def unregister_client(client_ws: WebSocket):
     """
     Hủy đăng ký client
     """
-    robot_id = client_to_robot_mapping.pop(client_ws, None)
-    if robot_id:
-        client_connections.pop(robot_id, None)
+    registry.unregister_client(client_ws)
+
+def get_robot(robot_id: str) -> Optional[Union[WebSocket, RemoteWebSocket]]:
+    """
+    Lấy WebSocket của robot (có thể là kết nối ở worker khác)
+    """
+    return registry.get_robot(robot_id)
+
+def is_robot_local(robot_id: str) -> bool:
+    """
+    Robot có kết nối với worker này không
+    """
+    return registry.is_robot_local(robot_id)
+
+def get_client(robot_id: str) -> Optional[Union[WebSocket, RemoteWebSocket]]:
+    """
+    Lấy WebSocket của client đang điều khiển robot (có thể là kết nối ở worker khác)
+    """
+    return registry.get_client(robot_id)
 
-def get_robot(robot_id: str) -> Optional[WebSocket]:
+def get_robot_wire_format(robot_id: str) -> str:
     """
-    Lấy WebSocket của robot
+    Lấy giao thức (json/bin) robot đã chọn khi kết nối
     """
-    return robot_connections.get(robot_id)
+    return registry.get_robot_wire_format(robot_id)
 
-def get_client(robot_id: str) -> Optional[WebSocket]:
+def get_robot_window(robot_id: str) -> int:
     """
-    Lấy WebSocket của client đang điều khiển robot
+    Lấy kích thước cửa sổ action robot đã khai báo khi kết nối
     """
-    return client_connections.get(robot_id)
+    return registry.get_robot_window(robot_id)
 
 def get_robot_status(robot_id: str) -> str:
     """
     Lấy trạng thái của robot
     """
-    if robot_id in client_connections:
-        return "controlled"
-    else:
-        return "available"
+    return registry.get_robot_status(robot_id)
+
+def get_robot_rtt(robot_id: str) -> Optional[float]:
+    """
+    Lấy RTT ước lượng (giây) của robot kết nối với worker này, None nếu chưa đo được
+    """
+    return liveness_monitor.get_rtt(robot_id)
 
 def get_all_robots_status() -> Dict[str, str]:
     """
     Lấy trạng thái của tất cả robot
     """
-    return {robot_id: get_robot_status(robot_id) for robot_id in robot_connections.keys()}
+    return registry.get_all_robots_status()
+
+def get_fleet_status() -> FleetStatusIndex:
+    """
+    Lấy chỉ mục trạng thái robot (bộ đếm, phân trang, delta theo version)
+    """
+    return registry.fleet
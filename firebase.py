@@ -1,14 +1,62 @@
-import firebase_admin
-from firebase_admin import credentials, auth
+import asyncio
+import base64
+import hashlib
+import json
 import os
-from typing import Dict, Any
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Tuple
 from dotenv import load_dotenv
+from metrics import metrics
 
 # Load .env
 load_dotenv()
 
+# Xác thực token chạy trong thread pool riêng để không chặn event loop
+VERIFY_WORKERS = int(os.getenv("FIREBASE_VERIFY_WORKERS", "4"))
+TOKEN_CACHE_SIZE = int(os.getenv("FIREBASE_TOKEN_CACHE_SIZE", "4096"))
+# Chu kỳ kiểm tra thu hồi token của mỗi user (mỗi lần kiểm tra là một lượt gọi get_user tới Firebase,
+# chạy ở nền); kết quả đã cache được tin tưởng tối đa chừng này thời gian
+REVOCATION_CHECK_INTERVAL = float(os.getenv("FIREBASE_REVOCATION_CHECK_INTERVAL", "300"))
+# Thời gian cache kết quả token không hợp lệ
+NEGATIVE_CACHE_TTL = float(os.getenv("FIREBASE_NEGATIVE_CACHE_TTL", "30"))
+# Các lỗi do chính token (không phải lỗi tạm thời) mới được cache
+_CACHEABLE_ERRORS = {"INVALID_TOKEN", "EXPIRED_TOKEN", "REVOKED_TOKEN"}
+
+_verify_executor = ThreadPoolExecutor(max_workers=VERIFY_WORKERS, thread_name_prefix="firebase-verify")
+# token hash -> (hết hạn cache, thời điểm cần kiểm tra thu hồi, kết quả)
+_token_cache: "OrderedDict[str, Tuple[float, float, Dict[str, Any]]]" = OrderedDict()
+_inflight_verifications: Dict[str, asyncio.Future] = {}
+# ID token của Firebase sống tối đa 1 giờ: chừng ấy thời gian sau khi thu hồi, mọi token cấp trước đó đã hết hạn
+ID_TOKEN_MAX_AGE = 3600
+# uid -> (token có auth_time <= giá trị này bị thu hồi, thời điểm bỏ bản ghi), bỏ sớm nhất ở đầu
+_revoked_uids: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+# uid -> thời điểm (epoch) kiểm tra thu hồi gần nhất, cũ nhất ở đầu
+_revocation_checked: "OrderedDict[str, float]" = OrderedDict()
+_revocation_tasks: Dict[str, asyncio.Task] = {}
+
+TOKEN_VERIFY_SECONDS = metrics.histogram(
+    "firebase_token_verify_seconds",
+    "Thời gian xác thực token Firebase theo nguồn kết quả (cache, coalesced, firebase, revocation_check)", ["source"])
+
+# firebase_admin import mất hơn 100 ms nên chỉ được import khi cần lần đầu (xem startup.py)
+firebase_admin = None
+credentials = None
+auth = None
+
+def load_sdk():
+    """Import firebase_admin nếu chưa import."""
+    global firebase_admin, credentials, auth
+    if auth is None:
+        import firebase_admin as firebase_admin_module
+        from firebase_admin import credentials as credentials_module, auth as auth_module
+        firebase_admin, credentials = firebase_admin_module, credentials_module
+        auth = auth_module
+
 def _initialize_firebase():
     """Khởi tạo Firebase Admin SDK nếu chưa được khởi tạo"""
+    load_sdk()
     if not firebase_admin._apps:
         # Tạo dict cho service account từ env
         service_account_info = {
@@ -28,10 +76,30 @@ def _initialize_firebase():
         cred = credentials.Certificate(service_account_info)
         firebase_admin.initialize_app(cred)
 
-def verify_firebase_token(id_token: str) -> Dict[str, Any]:
+def _warmup_token(project_id: str) -> str:
+    """Token giả đúng header/claims của project nhưng không có chữ ký: qua được các bước kiểm tra trước khi tải cert."""
+    def encode(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+    header = {"alg": "RS256", "kid": "warmup", "typ": "JWT"}
+    payload = {"aud": project_id, "iss": f"https://securetoken.google.com/{project_id}", "sub": "warmup"}
+    return f"{encode(header)}.{encode(payload)}.AA"
+
+def prefetch_public_certs():
+    """
+    Tải trước public cert của Google vào cache HTTP mà firebase_admin dùng khi xác thực ID token,
+    để lần xác thực đầu tiên không phải chờ tải cert: xác thực một token giả, lỗi INVALID_TOKEN là bình thường.
+    """
+    _initialize_firebase()
+    result = verify_firebase_token(_warmup_token(firebase_admin.get_app().project_id))
+    if result.get("error_code") not in ("INVALID_TOKEN", None):
+        raise ConnectionError(f"Không tải được public cert: {result['error']}")
+
+def verify_firebase_token(id_token: str, check_revoked: bool = False) -> Dict[str, Any]:
+    # Import trước khối try: các mệnh đề except bên dưới cần module auth
+    load_sdk()
     try:
         _initialize_firebase()
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = auth.verify_id_token(id_token, check_revoked=check_revoked)
         return {
             'success': True,
             'uid': decoded_token.get('uid'),
@@ -43,13 +111,195 @@ def verify_firebase_token(id_token: str) -> Dict[str, Any]:
             'exp': decoded_token.get('exp'),
             'firebase': decoded_token.get('firebase', {})
         }
-    except auth.InvalidIdTokenError:
-        return {'success': False, 'error': 'Token không hợp lệ hoặc đã hết hạn', 'error_code': 'INVALID_TOKEN'}
+    # ExpiredIdTokenError và RevokedIdTokenError là lớp con của InvalidIdTokenError nên phải bắt trước
     except auth.ExpiredIdTokenError:
         return {'success': False, 'error': 'Token đã hết hạn', 'error_code': 'EXPIRED_TOKEN'}
     except auth.RevokedIdTokenError:
         return {'success': False, 'error': 'Token đã bị thu hồi', 'error_code': 'REVOKED_TOKEN'}
+    except auth.InvalidIdTokenError:
+        return {'success': False, 'error': 'Token không hợp lệ hoặc đã hết hạn', 'error_code': 'INVALID_TOKEN'}
     except auth.CertificateFetchError:
         return {'success': False, 'error': 'Lỗi khi lấy certificate từ Firebase', 'error_code': 'CERTIFICATE_ERROR'}
     except Exception as e:
         return {'success': False, 'error': f'Lỗi không xác định: {str(e)}', 'error_code': 'UNKNOWN_ERROR'}
+
+
+def _token_key(id_token: str) -> str:
+    return hashlib.sha256(id_token.encode("utf-8")).hexdigest()
+
+
+def _cache_get(key: str) -> Optional[Dict[str, Any]]:
+    """Trả về kết quả đã cache nếu còn hạn và không cần kiểm tra thu hồi lại."""
+    entry = _token_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, recheck_at, result = entry
+    now = time.time()
+    if now >= expires_at or now >= recheck_at:
+        _token_cache.pop(key, None)
+        return None
+    revoked_at = _revoked_before(result.get("uid"))
+    if revoked_at is not None and (result.get("auth_time") or 0) <= revoked_at:
+        _token_cache.pop(key, None)
+        return None
+    _token_cache.move_to_end(key)
+    return result
+
+
+def _cache_put(key: str, result: Dict[str, Any]):
+    now = time.time()
+    if result["success"]:
+        expires_at = float(result.get("exp") or now)
+        recheck_at = now + REVOCATION_CHECK_INTERVAL
+    elif result.get("error_code") in _CACHEABLE_ERRORS:
+        expires_at = recheck_at = now + NEGATIVE_CACHE_TTL
+    else:
+        return
+    if expires_at <= now:
+        return
+    _token_cache[key] = (expires_at, recheck_at, result)
+    _token_cache.move_to_end(key)
+    while len(_token_cache) > TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+
+
+async def verify_firebase_token_async(id_token: str) -> Dict[str, Any]:
+    """
+    Xác thực token không chặn event loop.
+    Kết quả được cache theo hash của token đến khi token hết hạn (exp);
+    token không hợp lệ được cache trong NEGATIVE_CACHE_TTL giây.
+    Các yêu cầu đồng thời cùng một token chỉ xác thực một lần.
+    Token mới chỉ được xác thực chữ ký. Kiểm tra thu hồi chạy ở nền, tối đa một lần mỗi
+    REVOCATION_CHECK_INTERVAL cho mỗi user; user đã biết bị thu hồi thì kiểm tra ngay.
+    """
+    started = time.perf_counter()
+    key = _token_key(id_token)
+    cached = _cache_get(key)
+    if cached is not None:
+        TOKEN_VERIFY_SECONDS.observe(time.perf_counter() - started, "cache")
+        return cached
+
+    inflight = _inflight_verifications.get(key)
+    if inflight is not None:
+        result = await asyncio.shield(inflight)
+        TOKEN_VERIFY_SECONDS.observe(time.perf_counter() - started, "coalesced")
+        return result
+
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    _inflight_verifications[key] = future
+    try:
+        result = await loop.run_in_executor(_verify_executor, verify_firebase_token, id_token, False)
+        uid = result.get("uid")
+        if result["success"] and _revoked_before(uid) is not None:
+            result = await _check_revocation(uid, id_token)
+        elif result["success"] and _revocation_check_due(uid) and uid not in _revocation_tasks:
+            task = asyncio.create_task(_check_revocation(uid, id_token, result.get("auth_time")))
+            _revocation_tasks[uid] = task
+            task.add_done_callback(lambda done: _revocation_check_done(uid, done))
+        _cache_put(key, result)
+        future.set_result(result)
+        TOKEN_VERIFY_SECONDS.observe(time.perf_counter() - started, "firebase")
+        return result
+    except BaseException as e:
+        future.set_exception(RuntimeError(f"Xác thực token bị gián đoạn: {e!r}"))
+        future.exception()
+        raise
+    finally:
+        _inflight_verifications.pop(key, None)
+
+
+async def _check_revocation(uid: str, id_token: str, auth_time: Optional[float] = None) -> Dict[str, Any]:
+    """Xác thực lại token kèm kiểm tra thu hồi; token bị thu hồi thì mọi token cũ hơn của user bị loại khỏi cache."""
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(_verify_executor, verify_firebase_token, id_token, True)
+    TOKEN_VERIFY_SECONDS.observe(time.perf_counter() - started, "revocation_check")
+    if result["success"]:
+        _mark_revocation_checked(uid)
+    elif result.get("error_code") == "REVOKED_TOKEN" and auth_time is not None:
+        invalidate_user(uid, auth_time)
+    return result
+
+
+def _revocation_check_done(uid: str, task: asyncio.Task):
+    """Kiểm tra thu hồi ở nền kết thúc: bỏ khỏi danh sách đang chạy, ghi log nếu lỗi (user vẫn đến hạn kiểm tra)."""
+    if _revocation_tasks.get(uid) is task:
+        del _revocation_tasks[uid]
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Lỗi khi kiểm tra thu hồi token của user {uid}: {task.exception()!r}")
+
+
+def _revocation_check_due(uid: Optional[str]) -> bool:
+    checked_at = _revocation_checked.get(uid)
+    return checked_at is None or time.time() - checked_at >= REVOCATION_CHECK_INTERVAL
+
+
+def _mark_revocation_checked(uid: Optional[str]):
+    now = time.time()
+    _revocation_checked.pop(uid, None)
+    _revocation_checked[uid] = now
+    # Bỏ các user đã quá chu kỳ (lần sau đằng nào cũng phải kiểm tra lại) và giữ kích thước có giới hạn
+    while _revocation_checked:
+        oldest_uid, checked_at = next(iter(_revocation_checked.items()))
+        if now - checked_at < REVOCATION_CHECK_INTERVAL and len(_revocation_checked) <= TOKEN_CACHE_SIZE:
+            break
+        _revocation_checked.pop(oldest_uid)
+
+
+def _revoked_before(uid: Optional[str]) -> Optional[float]:
+    """auth_time mà token của uid cấp trước đó bị coi là thu hồi, None nếu không có hoặc đã hết hạn."""
+    entry = _revoked_uids.get(uid)
+    if entry is None:
+        return None
+    revoked_at, forget_at = entry
+    if time.time() >= forget_at:
+        del _revoked_uids[uid]
+        return None
+    return revoked_at
+
+
+def invalidate_user(uid: str, revoked_at: Optional[float] = None):
+    """
+    Đánh dấu mọi token đã cấp cho uid trước revoked_at (mặc định thời điểm hiện tại) là bị thu hồi
+    và xóa chúng khỏi cache.
+    """
+    now = time.time()
+    revoked_at = max(_revoked_before(uid) or 0.0, now if revoked_at is None else revoked_at)
+    _revoked_uids.pop(uid, None)
+    _revoked_uids[uid] = (revoked_at, now + ID_TOKEN_MAX_AGE)
+    # Bỏ các bản ghi mà mọi token bị thu hồi đã hết hạn, và giữ kích thước có giới hạn
+    while _revoked_uids:
+        oldest_uid, (_, forget_at) = next(iter(_revoked_uids.items()))
+        if now < forget_at and len(_revoked_uids) <= TOKEN_CACHE_SIZE:
+            break
+        del _revoked_uids[oldest_uid]
+    for key in [k for k, (_, _, result) in _token_cache.items()
+                if result.get("uid") == uid and (result.get("auth_time") or 0) <= revoked_at]:
+        _token_cache.pop(key, None)
+
+
+async def revoke_user_tokens(uid: str):
+    """
+    Thu hồi refresh token của user trên Firebase và xóa cache tương ứng.
+    Worker khác nhận ra token bị thu hồi ở lần kiểm tra thu hồi kế tiếp (tối đa REVOCATION_CHECK_INTERVAL).
+    """
+    _initialize_firebase()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_verify_executor, auth.revoke_refresh_tokens, uid)
+    invalidate_user(uid)
+
+
+def token_cache_stats() -> Dict[str, int]:
+    return {
+        "entries": len(_token_cache),
+        "inflight": len(_inflight_verifications),
+        "revoked_users": len(_revoked_uids),
+        "revocation_checked_users": len(_revocation_checked),
+        "revocation_checks": len(_revocation_tasks),
+    }
+
+
+metrics.gauge_callback(
+    "firebase_token_cache", "Trạng thái cache xác thực token Firebase",
+    lambda: {(state,): float(count) for state, count in token_cache_stats().items()}, ["state"])
@@ -1,14 +1,69 @@
 import asyncio
+import time
+from collections import deque
+from contextlib import aclosing
+from typing import Optional
 from dotenv import load_dotenv
-from google import genai
-from google.genai import types
 from websockets.exceptions import ConnectionClosedError 
 import os 
-import json
+import codec
+from action_stream import ActionStreamParser
+from metrics import metrics
 
 load_dotenv()
 API_KEY = os.getenv("API_GEMINI_KEY")
-client = genai.Client(api_key=API_KEY)
+
+# SDK google-genai import mất vài trăm ms nên chỉ được import khi cần lần đầu
+# (hoặc ở nền lúc khởi động, xem startup.py); genai.Client dùng chung cho mọi phiên
+genai = None
+types = None
+_client = None
+
+def load_sdk():
+    """Import google-genai nếu chưa import."""
+    global genai, types
+    if types is None:
+        from google import genai as genai_module
+        from google.genai import types as types_module
+        if genai is None:
+            genai = genai_module
+        types = types_module
+
+def get_client():
+    """genai.Client dùng chung (tạo mới mỗi phiên tốn hàng chục ms CPU)."""
+    global _client
+    if _client is None:
+        load_sdk()
+        _client = genai.Client(api_key=API_KEY)
+    return _client
+
+# Cấu hình pool phiên Gemini Live
+GEMINI_POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", "2"))
+GEMINI_POOL_MAX_SIZE = int(os.getenv("GEMINI_POOL_MAX_SIZE", "32"))
+GEMINI_POOL_HEALTH_INTERVAL = float(os.getenv("GEMINI_POOL_HEALTH_INTERVAL", "15"))
+# Phiên Live bị server đóng sau một thời gian, thay mới phiên rảnh trước khi đến hạn
+GEMINI_POOL_MAX_IDLE = float(os.getenv("GEMINI_POOL_MAX_IDLE", "480"))
+# Thời gian tối đa mở một phiên Live, và chờ pool cấp phiên (gồm cả chờ phiên được trả lại và kết nối)
+GEMINI_CONNECT_TIMEOUT = float(os.getenv("GEMINI_CONNECT_TIMEOUT", "10"))
+GEMINI_ACQUIRE_TIMEOUT = float(os.getenv("GEMINI_ACQUIRE_TIMEOUT", "15"))
+# Ngữ cảnh phiên Live lớn dần theo từng lượt (câu lệnh + phản hồi) làm lượt sau chậm và tốn token hơn:
+# quá ngưỡng này (ước lượng hoặc theo usage_metadata) phiên được thay bằng phiên mới ở nền
+GEMINI_CONTEXT_MAX_TOKENS = int(os.getenv("GEMINI_CONTEXT_MAX_TOKENS", "4000"))
+# Ước lượng số token khi server không trả usage_metadata
+CHARS_PER_TOKEN = 4
+# Audio vào khoảng 32 token/giây; PCM 16-bit 16 kHz là 32000 byte/giây
+AUDIO_BYTES_PER_TOKEN = 1000
+# Model dùng cho lệnh generate_content (không qua phiên Live)
+GEMINI_GENERATE_MODEL = os.getenv("GEMINI_GENERATE_MODEL", "gemini-2.0-flash")
+
+GEMINI_CONNECT_SECONDS = metrics.histogram(
+    "gemini_connect_seconds", "Thời gian mở phiên Gemini Live", ["result"])
+GEMINI_FIRST_ACTION_SECONDS = metrics.histogram(
+    "gemini_first_action_seconds", "Thời gian từ lúc gửi câu lệnh đến khi nhận được action đầu tiên")
+GEMINI_TURN_SECONDS = metrics.histogram(
+    "gemini_turn_seconds", "Thời gian một lượt Gemini Live từ lúc gửi câu lệnh đến turn_complete", ["result"])
+GEMINI_SESSION_ROTATIONS = metrics.counter(
+    "gemini_session_rotations_total", "Số lần phiên Gemini của client được thay bằng phiên mới", ["reason"])
 
 TEMPLATE_PROMPT_ANALYZE = """
 Bạn là một AI chuyên phân tích **ý định di chuyển** của người dùng.
@@ -88,47 +143,61 @@ Phân tích câu lệnh sau:
 """
 
 def normalize_response(response: str):
-    raw_text = response.strip()
-
-    if raw_text.startswith("```"):
-        raw_text = raw_text.strip("`")
-        if raw_text.lower().startswith("json"):
-            raw_text = raw_text[4:].strip()
-
-    try:
-        data = json.loads(raw_text)
-        return data["actions"]
-    except json.JSONDecodeError as e:
-        print("JSON parse error:", e)
-        print("Raw text:", raw_text)
-        return []
+    """Phân tích cả phản hồi của model, chỉ trả về các action đúng schema."""
+    return codec.parse_actions_document(response)
 
 class GeminiLiveClient:
     """
     Lớp quản lý phiên Live API của Gemini.
     """
     def __init__(self, api_key: str, model: str = "gemini-2.0-flash-live-001"):
-        self.client = genai.Client(api_key=api_key)
+        load_sdk()
+        # Client dùng chung với API key mặc định, chỉ tạo riêng khi dùng key khác
+        self.client = get_client() if api_key == API_KEY else genai.Client(api_key=api_key)
         self.model = model
         self.session = None
         self.is_connected = False
         self._connector = None 
         self.prompt_template_sent = False
+        self.connected_at = 0.0
+        # Kích thước ngữ cảnh hiện tại của phiên (token) và số lượt đã gửi
+        self.context_tokens = 0
+        self.turns = 0
+        self.audio_bytes = 0
+        # Phiên thay thế đang được chuẩn bị ở nền (xem GeminiSessionPool.rotate)
+        self.successor: Optional[asyncio.Task] = None
 
-    async def connect(self):
+    async def connect(self, prime: bool = False):
+        """
+        Mở phiên Live. Nếu prime=True, TEMPLATE_PROMPT_ANALYZE được gửi làm
+        system instruction ngay khi bắt tay nên các lượt sau chỉ gửi câu lệnh.
+        """
         if self.is_connected:
             print("Kết nối Gemini Live đã được thiết lập.")
             return
 
+        config = types.LiveConnectConfig(response_modalities=["TEXT"])
+        if prime:
+            config.system_instruction = types.Content(parts=[types.Part(text=TEMPLATE_PROMPT_ANALYZE)])
+
+        started = time.perf_counter()
         try:
             self._connector = self.client.aio.live.connect( 
                 model=self.model,
-                config=types.LiveConnectConfig(response_modalities=["TEXT"]),
+                config=config,
             )
-            self.session = await self._connector.__aenter__()
+            self.session = await asyncio.wait_for(self._connector.__aenter__(), GEMINI_CONNECT_TIMEOUT)
             self.is_connected = True
+            self.connected_at = time.monotonic()
+            self.context_tokens = 0
+            self.turns = 0
+            if prime:
+                self.prompt_template_sent = True
+                self.context_tokens = _estimate_tokens(TEMPLATE_PROMPT_ANALYZE)
+            GEMINI_CONNECT_SECONDS.observe(time.perf_counter() - started, "ok")
             print("Kết nối Gemini Live thành công.")
         except Exception as e:
+            GEMINI_CONNECT_SECONDS.observe(time.perf_counter() - started, "error")
             self.is_connected = False
             self._connector = None # Đảm bảo connector được reset
             print(f"Lỗi kết nối Gemini Live: {e}")
@@ -147,18 +216,41 @@ class GeminiLiveClient:
         except Exception as e:
             print(f"Lỗi khi đóng kết nối Gemini Live: {e}")
 
+    def is_healthy(self) -> bool:
+        """Kiểm tra websocket bên dưới phiên Live vẫn còn mở."""
+        if not self.is_connected or not self.session:
+            return False
+        ws = getattr(self.session, "_ws", None)
+        return ws is None or getattr(ws, "close_code", None) is None
+
+    def rotation_reason(self) -> Optional[str]:
+        """Lý do cần thay phiên (ngữ cảnh quá lớn hoặc phiên sắp bị server đóng), None nếu chưa cần."""
+        if self.context_tokens >= GEMINI_CONTEXT_MAX_TOKENS:
+            return "context"
+        if self.connected_at and time.monotonic() - self.connected_at > GEMINI_POOL_MAX_IDLE:
+            return "age"
+        return None
+
     async def send_message(self, user_text: str) -> list:
+        return [action async for action in self.stream_actions(user_text)]
+
+    async def stream_actions(self, user_text: str):
+        """
+        Gửi câu lệnh và trả về (async generator) từng action ngay khi model
+        stream xong phần tử đó, không chờ hết lượt trả lời.
+        Người dùng phải đọc hết generator để phiên không còn dữ liệu của lượt cũ.
+        """
         if not self.session or not self.is_connected:
             raise ConnectionError("Không có kết nối Gemini Live. Vui lòng gọi connect() trước.")
         
-        full_response = ""
         parts_to_send = []
-
         if not self.prompt_template_sent:
             parts_to_send.append(types.Part(text=TEMPLATE_PROMPT_ANALYZE))
             self.prompt_template_sent = True
         parts_to_send.append(types.Part(text=user_text))
 
+        started = time.perf_counter()
+        self.turns += 1
         try:
             await self.session.send_client_content(
                 turns=types.Content(
@@ -167,11 +259,69 @@ class GeminiLiveClient:
                 )
             )
         except Exception as e:
+            GEMINI_TURN_SECONDS.observe(time.perf_counter() - started, "error")
             print(f"Lỗi khi gửi nội dung đến Gemini Live: {e}")
             raise
 
+        sent_text = "".join(part.text for part in parts_to_send)
+        async with aclosing(self._receive_actions(started, lambda response: _estimate_tokens(sent_text + response))) as actions:
+            async for action in actions:
+                yield action
+
+    async def start_audio(self):
+        """Bắt đầu một câu lệnh giọng nói: nạp prompt nếu phiên chưa được nạp."""
+        if not self.session or not self.is_connected:
+            raise ConnectionError("Không có kết nối Gemini Live. Vui lòng gọi connect() trước.")
+        self.audio_bytes = 0
+        if not self.prompt_template_sent:
+            await self.session.send_client_content(
+                turns=types.Content(role="user", parts=[types.Part(text=TEMPLATE_PROMPT_ANALYZE)]),
+                turn_complete=False,
+            )
+            self.prompt_template_sent = True
+            self.context_tokens += _estimate_tokens(TEMPLATE_PROMPT_ANALYZE)
+
+    async def send_audio(self, chunk: bytes, mime_type: str):
+        """Gửi một đoạn audio vào phiên Live; model nhận dạng song song khi người dùng còn đang nói."""
+        if not self.session or not self.is_connected:
+            raise ConnectionError("Không có kết nối Gemini Live.")
+        try:
+            await self.session.send_realtime_input(audio=types.Blob(data=chunk, mime_type=mime_type))
+        except ConnectionClosedError as e:
+            await self.disconnect()
+            raise ConnectionError(f"Kết nối Gemini Live bị đóng khi gửi audio: {e}")
+        self.audio_bytes += len(chunk)
+
+    async def end_audio(self):
+        """Báo hết câu lệnh giọng nói để model trả lời ngay, không chờ phát hiện im lặng."""
+        if not self.session or not self.is_connected:
+            raise ConnectionError("Không có kết nối Gemini Live.")
+        try:
+            await self.session.send_realtime_input(audio_stream_end=True)
+        except ConnectionClosedError as e:
+            await self.disconnect()
+            raise ConnectionError(f"Kết nối Gemini Live bị đóng khi gửi audio: {e}")
+
+    async def audio_actions(self):
+        """Nhận (async generator) các action của câu lệnh giọng nói đang gửi qua send_audio."""
+        started = time.perf_counter()
+        self.turns += 1
+        estimate = lambda response: self.audio_bytes // AUDIO_BYTES_PER_TOKEN + _estimate_tokens(response)
+        async with aclosing(self._receive_actions(started, estimate)) as actions:
+            async for action in actions:
+                yield action
+
+    async def _receive_actions(self, started: float, estimate_tokens):
+        """Đọc một lượt trả lời của phiên Live và trả về từng action ngay khi phân tích xong."""
+        full_response = ""
+        parser = ActionStreamParser()
+        yielded = 0
+        reported_tokens = None
         try:
             async for message in self.session.receive():
+                usage = getattr(message, "usage_metadata", None)
+                if usage is not None and getattr(usage, "total_token_count", None):
+                    reported_tokens = usage.total_token_count
                 if message.server_content:
                     server_content = message.server_content
                     
@@ -179,14 +329,233 @@ class GeminiLiveClient:
                         for part in server_content.model_turn.parts:
                             if part.text:
                                 full_response += part.text
+                                for item in parser.feed(part.text):
+                                    try:
+                                        action = codec.validate_action(item)
+                                    except codec.ActionSchemaError as e:
+                                        print(f"Bỏ action không hợp lệ từ Gemini: {e}")
+                                        continue
+                                    if not yielded:
+                                        GEMINI_FIRST_ACTION_SECONDS.observe(time.perf_counter() - started)
+                                    yielded += 1
+                                    yield action
                                 
                     if server_content.turn_complete:
-                      return normalize_response(full_response)
+                        GEMINI_TURN_SECONDS.observe(time.perf_counter() - started, "ok")
+                        if reported_tokens:
+                            self.context_tokens = reported_tokens
+                        else:
+                            self.context_tokens += estimate_tokens(full_response)
+                        # Phản hồi không theo dạng stream được (vd. thiếu "actions"): phân tích cả khối
+                        if not yielded:
+                            for action in normalize_response(full_response):
+                                yield action
+                        return
                       
         except ConnectionClosedError as e:
+            GEMINI_TURN_SECONDS.observe(time.perf_counter() - started, "error")
             await self.disconnect()
             raise ConnectionError(f"Kết nối Gemini Live bị đóng trong khi nhận tin nhắn: {e}")
 
+async def generate_actions(user_text: str) -> list:
+    """
+    Phân tích câu lệnh bằng một lệnh generate_content (không qua phiên Live, không giữ ngữ cảnh).
+    Dùng cho yêu cầu dự phòng (hedge) khi phiên Live trả lời chậm.
+    """
+    response = await get_client().aio.models.generate_content(
+        model=GEMINI_GENERATE_MODEL,
+        contents=user_text,
+        config=types.GenerateContentConfig(
+            system_instruction=TEMPLATE_PROMPT_ANALYZE,
+            response_mime_type="application/json",
+        ),
+    )
+    return normalize_response(response.text or "")
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
 async def get_gemini():
     client = GeminiLiveClient(api_key=API_KEY)
-    return client
\ No newline at end of file
+    return client
+
+
+class GeminiSessionPool:
+    """
+    Pool các phiên Gemini Live đã kết nối sẵn và đã nạp TEMPLATE_PROMPT_ANALYZE.
+    Mỗi client được cấp một phiên riêng; khi trả lại, phiên bị đóng (vì đã chứa
+    ngữ cảnh hội thoại của client) và pool tạo phiên mới ở nền.
+    """
+    def __init__(self, size: int = GEMINI_POOL_SIZE, max_size: int = GEMINI_POOL_MAX_SIZE,
+                 health_interval: float = GEMINI_POOL_HEALTH_INTERVAL, max_idle: float = GEMINI_POOL_MAX_IDLE):
+        self.size = size
+        self.max_size = max(max_size, size)
+        self.health_interval = health_interval
+        self.max_idle = max_idle
+        self._idle: deque = deque()
+        self._leased: set = set()
+        self._connecting = 0
+        self._available = asyncio.Condition()
+        self._health_task = None
+        self._background_tasks: set = set()
+
+    @property
+    def total(self) -> int:
+        return len(self._idle) + len(self._leased) + self._connecting
+
+    def start(self):
+        """Bắt đầu làm đầy pool và vòng kiểm tra sức khỏe (gọi trong event loop)."""
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._health_loop())
+        self._refill()
+
+    async def close(self):
+        if self._health_task:
+            self._health_task.cancel()
+            self._health_task = None
+        for task in list(self._background_tasks):
+            task.cancel()
+        while self._idle:
+            await self._idle.popleft().disconnect()
+
+    async def wait_ready(self, timeout: float) -> bool:
+        """Chờ đến khi pool có ít nhất một phiên sẵn sàng (dùng khi khởi động), False nếu hết giờ."""
+        async def wait():
+            async with self._available:
+                await self._available.wait_for(lambda: bool(self._idle))
+        try:
+            await asyncio.wait_for(wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def acquire(self, timeout: Optional[float] = GEMINI_ACQUIRE_TIMEOUT) -> GeminiLiveClient:
+        """
+        Lấy một phiên đã sẵn sàng; tạo mới ngay nếu pool đang trống.
+        Raise TimeoutError nếu không có phiên sau timeout giây.
+        """
+        self.start()
+        try:
+            return await asyncio.wait_for(self._acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Không có phiên Gemini Live sau {timeout:g} giây") from None
+
+    async def _acquire(self) -> GeminiLiveClient:
+        while True:
+            while self._idle:
+                session = self._idle.popleft()
+                if session.is_healthy():
+                    self._leased.add(session)
+                    self._refill()
+                    return session
+                self._spawn(session.disconnect())
+
+            if self.total < self.max_size:
+                self._connecting += 1
+                try:
+                    session = await self._new_session()
+                finally:
+                    self._connecting -= 1
+                self._leased.add(session)
+                self._refill()
+                return session
+
+            # Pool đã đạt kích thước tối đa, chờ có phiên được trả lại hoặc tạo xong
+            async with self._available:
+                await self._available.wait()
+
+    def rotate(self, session: GeminiLiveClient) -> GeminiLiveClient:
+        """
+        Thay phiên của client khi ngữ cảnh quá lớn mà không lượt nào phải chờ kết nối:
+        lần gọi đầu tiên sau khi vượt ngưỡng bắt đầu lấy phiên mới ở nền và vẫn trả về phiên cũ;
+        khi phiên mới đã sẵn sàng, trả về phiên mới và trả phiên cũ về pool.
+        Gọi trước và sau mỗi lượt, dùng phiên được trả về cho lượt tiếp theo.
+        """
+        successor = session.successor
+        if successor is None:
+            if session.rotation_reason():
+                session.successor = asyncio.create_task(self.acquire())
+            return session
+        if not successor.done():
+            return session
+        session.successor = None
+        if successor.cancelled() or successor.exception() is not None:
+            # Lần gọi sau sẽ thử lại vì phiên cũ vẫn vượt ngưỡng
+            print(f"Không thể chuẩn bị phiên Gemini mới: {None if successor.cancelled() else successor.exception()}")
+            return session
+        GEMINI_SESSION_ROTATIONS.inc(session.rotation_reason() or "context")
+        self._spawn(self.release(session))
+        return successor.result()
+
+    async def release(self, session: GeminiLiveClient):
+        """Trả phiên về pool: đóng phiên ở nền và bổ sung phiên mới."""
+        self._leased.discard(session)
+        if session.successor is not None:
+            # Phiên thay thế chưa kịp dùng: trả về pool khi lấy xong
+            session.successor.add_done_callback(self._release_unused)
+            session.successor = None
+        self._spawn(session.disconnect())
+        self._refill()
+        await self._notify()
+
+    def _release_unused(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is None:
+            self._spawn(self.release(task.result()))
+
+    async def _new_session(self) -> GeminiLiveClient:
+        session = await get_gemini()
+        await session.connect(prime=True)
+        return session
+
+    def _refill(self):
+        while len(self._idle) + self._connecting < self.size and self.total < self.max_size:
+            self._connecting += 1
+            self._spawn(self._fill_one())
+
+    async def _fill_one(self):
+        try:
+            session = await self._new_session()
+        except Exception as e:
+            print(f"Không thể tạo phiên Gemini Live cho pool: {e}")
+            session = None
+        finally:
+            self._connecting -= 1
+        if session is not None:
+            self._idle.append(session)
+        # Kể cả khi lỗi: người đang chờ pool đầy có thể tự kết nối vì đã có chỗ trống
+        await self._notify()
+
+    async def _notify(self):
+        async with self._available:
+            self._available.notify_all()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            now = time.monotonic()
+            for session in list(self._idle):
+                if not session.is_healthy() or now - session.connected_at > self.max_idle:
+                    self._idle.remove(session)
+                    self._spawn(session.disconnect())
+            self._refill()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    def stats(self) -> dict:
+        return {
+            "idle": len(self._idle),
+            "leased": len(self._leased),
+            "connecting": self._connecting,
+            "max_size": self.max_size,
+        }
+
+
+# Singleton instance
+gemini_pool = GeminiSessionPool()
+
+metrics.gauge_callback(
+    "gemini_pool_sessions", "Số phiên Gemini Live trong pool theo trạng thái",
+    lambda: {(state,): gemini_pool.stats()[state] for state in ("idle", "leased", "connecting")}, ["state"])
\ No newline at end of file
@@ -0,0 +1,268 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import AsyncIterator, Optional
+import gemini
+from async_utils import cancel_and_wait
+from metrics import metrics
+from rate_limit import gemini_admission, RateLimited
+
+# Bảo vệ đường phân tích câu lệnh bằng Gemini:
+# - Hạn chót cho mỗi lượt: lượt bị treo không giữ vòng client_ws mãi
+# - Hedge (tùy chọn): action đầu tiên chưa về sau khoảng trễ p95 thì gửi thêm một lệnh
+#   generate_content và dùng kết quả nào về trước
+# - Mỗi lượt giữ một chỗ trong gemini_admission (ngân sách và số lượt đồng thời, xem rate_limit)
+# - Circuit breaker: Gemini lỗi liên tiếp thì chỉ dùng bộ phân tích cục bộ trong một thời gian,
+#   sau đó cho một câu lệnh đi qua để thử lại
+
+GEMINI_TURN_TIMEOUT = float(os.getenv("GEMINI_TURN_TIMEOUT", "10"))
+GEMINI_HEDGE_ENABLED = os.getenv("GEMINI_HEDGE", "0") == "1"
+# Khoảng trễ hedge khi chưa đủ mẫu để tính p95, và khoảng trễ tối thiểu
+GEMINI_HEDGE_DELAY = float(os.getenv("GEMINI_HEDGE_DELAY", "1.0"))
+GEMINI_HEDGE_MIN_DELAY = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", "0.2"))
+GEMINI_HEDGE_QUANTILE = 0.95
+GEMINI_HEDGE_MIN_SAMPLES = 20
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+
+GEMINI_REQUESTS = metrics.counter(
+    "gemini_requests_total",
+    "Kết quả các lượt phân tích bằng Gemini: ok, hedge_primary (đã hedge, phiên Live về trước), "
+    "hedge_won (lệnh hedge về trước), hedge_empty (lệnh hedge không có action, chờ phiên Live), timeout, error, connect_error (không mở được phiên Live), "
+    "connect_timeout (pool không cấp phiên trong GEMINI_TURN_TIMEOUT), "
+    "rejected (circuit breaker đang mở)",
+    ["outcome"])
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+
+class GeminiUnavailable(ConnectionError):
+    """Gemini không trả lời kịp hoặc đang bị ngắt bởi circuit breaker; không nên thử lại ngay."""
+
+
+class GeminiTimeout(GeminiUnavailable):
+    pass
+
+
+class CircuitOpenError(GeminiUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker 3 trạng thái: closed (bình thường) -> open sau `failure_threshold` lỗi liên tiếp
+    -> half_open sau `cooldown` giây, cho đúng một yêu cầu thử; thành công thì closed, lỗi thì open lại.
+    """
+    def __init__(self, failure_threshold: int = GEMINI_BREAKER_FAILURES, cooldown: float = GEMINI_BREAKER_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        """Cho phép gửi yêu cầu tới Gemini không. Ở half_open chỉ cho một yêu cầu thử tại một thời điểm."""
+        if self.state == BREAKER_CLOSED:
+            return True
+        if self.state == BREAKER_OPEN:
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.state = BREAKER_HALF_OPEN
+            self._probing = False
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def is_open(self) -> bool:
+        """Đang trong thời gian nghỉ sau khi mở (không tính lượt thử của half_open)."""
+        return self.state == BREAKER_OPEN and time.monotonic() - self.opened_at < self.cooldown
+
+    def record_success(self):
+        self.failures = 0
+        self._probing = False
+        if self.state != BREAKER_CLOSED:
+            print("Gemini hoạt động trở lại, đóng circuit breaker")
+            self.state = BREAKER_CLOSED
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == BREAKER_HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != BREAKER_OPEN:
+                print(f"Gemini lỗi {self.failures} lần liên tiếp, chỉ dùng bộ phân tích cục bộ "
+                      f"trong {self.cooldown:.0f} giây")
+            self.state = BREAKER_OPEN
+            self.opened_at = time.monotonic()
+
+    def record_abandoned(self):
+        """Yêu cầu bị hủy giữa chừng (client ngắt kết nối): không tính là thành công hay lỗi."""
+        self._probing = False
+
+
+class LatencyTracker:
+    """Giữ các mẫu độ trễ gần nhất để tính phân vị."""
+    def __init__(self, size: int = 200):
+        self._samples: deque = deque(maxlen=size)
+
+    def observe(self, value: float):
+        self._samples.append(value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self._samples) < GEMINI_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# Singleton instance
+gemini_breaker = CircuitBreaker()
+first_action_latency = LatencyTracker()
+
+metrics.gauge_callback(
+    "gemini_circuit_open", "Trạng thái circuit breaker của Gemini (0 closed, 0.5 half_open, 1 open)",
+    lambda: {BREAKER_CLOSED: 0.0, BREAKER_HALF_OPEN: 0.5, BREAKER_OPEN: 1.0}[gemini_breaker.state])
+
+
+def hedge_delay() -> float:
+    """Thời gian chờ action đầu tiên của phiên Live trước khi gửi lệnh hedge."""
+    p95 = first_action_latency.quantile(GEMINI_HEDGE_QUANTILE)
+    return max(GEMINI_HEDGE_MIN_DELAY, p95 if p95 is not None else GEMINI_HEDGE_DELAY)
+
+
+async def acquire_session(session: Optional["gemini.GeminiLiveClient"] = None,
+                          fresh: bool = False) -> "gemini.GeminiLiveClient":
+    """
+    Phiên Gemini cho lượt tiếp theo của client: giữ phiên hiện tại nếu còn kết nối (dùng phiên thay thế
+    nếu pool đã chuẩn bị xong), ngược lại trả phiên cũ về pool và lấy phiên mới.
+    fresh=True: luôn đổi phiên mới (phiên hiện tại vừa lỗi).
+    Không lấy phiên mới khi circuit breaker đang mở. Việc lấy phiên có hạn chót GEMINI_TURN_TIMEOUT;
+    lỗi kết nối và hết giờ được tính là lỗi của breaker.
+    Raise CircuitOpenError, GeminiTimeout hoặc GeminiUnavailable; khi đó phiên cũ đã được trả về pool.
+    """
+    if session is not None:
+        if session.is_connected and not fresh:
+            return gemini.gemini_pool.rotate(session)
+        await gemini.gemini_pool.release(session)
+    if gemini_breaker.is_open():
+        GEMINI_REQUESTS.inc("rejected")
+        raise CircuitOpenError("Gemini tạm thời không khả dụng")
+    try:
+        return await gemini.gemini_pool.acquire(timeout=GEMINI_TURN_TIMEOUT)
+    except TimeoutError as e:
+        GEMINI_REQUESTS.inc("connect_timeout")
+        gemini_breaker.record_failure()
+        raise GeminiTimeout(f"Không lấy được phiên Gemini: {e}") from e
+    except Exception as e:
+        GEMINI_REQUESTS.inc("connect_error")
+        gemini_breaker.record_failure()
+        raise GeminiUnavailable(f"Không kết nối được Gemini: {e}") from e
+
+
+async def guarded_stream(session: "gemini.GeminiLiveClient", user_text: str) -> AsyncIterator[dict]:
+    """
+    Như session.stream_actions nhưng có hạn chót cho cả lượt, hedge và circuit breaker.
+    Raise GeminiTimeout/CircuitOpenError (không nên thử lại), RateLimited (hết ngân sách/hàng đợi đầy)
+    hoặc ConnectionError (phiên Live lỗi).
+    Phiên Live bị bỏ giữa lượt (hết giờ hoặc thua hedge) sẽ bị đóng để client đổi phiên mới.
+    """
+    if not gemini_breaker.allow():
+        GEMINI_REQUESTS.inc("rejected")
+        raise CircuitOpenError("Gemini tạm thời không khả dụng")
+    try:
+        await gemini_admission.acquire()
+    except (RateLimited, asyncio.CancelledError):
+        gemini_breaker.record_abandoned()
+        raise
+
+    started = time.monotonic()
+    deadline = started + GEMINI_TURN_TIMEOUT
+    primary = session.stream_actions(user_text)
+    first = asyncio.ensure_future(primary.__anext__())
+    hedge: Optional[asyncio.Future] = None
+    finished = False
+    try:
+        waiting = {first}
+        if GEMINI_HEDGE_ENABLED:
+            done, _ = await asyncio.wait(waiting, timeout=min(hedge_delay(), deadline - time.monotonic()))
+            # Lệnh hedge cũng tính vào ngân sách Gemini; hết ngân sách thì chỉ chờ phiên Live
+            if not done and time.monotonic() < deadline and gemini_admission.try_spend():
+                hedge = asyncio.ensure_future(gemini.generate_actions(user_text))
+                waiting = {first, hedge}
+
+        winner = None
+        while winner is None:
+            done, _ = await asyncio.wait(waiting, timeout=max(0.0, deadline - time.monotonic()),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise GeminiTimeout(f"Gemini không trả lời trong {GEMINI_TURN_TIMEOUT:g} giây")
+            for task in done:
+                waiting.discard(task)
+                error = task.exception()
+                if task is hedge and error is None and not task.result():
+                    # generate_actions trả [] khi không phân tích được phản hồi: không tính là thắng
+                    GEMINI_REQUESTS.inc("hedge_empty")
+                    error = ValueError("Lệnh hedge không trả về action nào")
+                if error is None or isinstance(error, StopAsyncIteration):
+                    winner = task
+                    break
+                print(f"Yêu cầu {'hedge' if task is hedge else 'Gemini Live'} lỗi: {error}")
+            if winner is None and not waiting:
+                raise error
+
+        if winner is hedge:
+            GEMINI_REQUESTS.inc("hedge_won")
+            first_action_latency.observe(time.monotonic() - started)
+            await cancel_and_wait(first)
+            await primary.aclose()
+            # Phiên Live còn dữ liệu của lượt bị bỏ dở
+            await session.disconnect()
+            finished = True
+            gemini_breaker.record_success()
+            for action in hedge.result():
+                yield action
+            return
+
+        await cancel_and_wait(hedge)
+        first_action_latency.observe(time.monotonic() - started)
+        if isinstance(first.exception(), StopAsyncIteration):
+            # Lượt kết thúc mà không có action nào
+            actions_done = True
+        else:
+            actions_done = False
+            yield first.result()
+        while not actions_done:
+            try:
+                action = await asyncio.wait_for(primary.__anext__(), max(0.0, deadline - time.monotonic()))
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise GeminiTimeout(f"Gemini không trả lời hết lượt trong {GEMINI_TURN_TIMEOUT:g} giây")
+            yield action
+        finished = True
+        GEMINI_REQUESTS.inc("hedge_primary" if hedge is not None else "ok")
+        gemini_breaker.record_success()
+    except GeminiTimeout:
+        GEMINI_REQUESTS.inc("timeout")
+        gemini_breaker.record_failure()
+        await session.disconnect()
+        raise
+    except (asyncio.CancelledError, GeneratorExit):
+        if not finished:
+            gemini_breaker.record_abandoned()
+        raise
+    except Exception:
+        if not finished:
+            GEMINI_REQUESTS.inc("error")
+            gemini_breaker.record_failure()
+        raise
+    finally:
+        gemini_admission.release()
+        if not finished:
+            await cancel_and_wait(first)
+            await cancel_and_wait(hedge)
+            await primary.aclose()
@@ -0,0 +1,202 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+# Phát hiện robot mất kết nối không đóng socket (mất Wi-Fi, mất nguồn) bằng ping/pong tầng ứng dụng.
+# Mọi hẹn giờ nằm trong một timer wheel duy nhất do một task điều khiển,
+# nên chi phí mỗi tick chỉ tỉ lệ với số hẹn giờ đến hạn, không cần một coroutine ngủ cho mỗi socket.
+
+# Firmware cũ không trả lời ping nên heartbeat là tùy chọn (?heartbeat=1), trừ khi bật mặc định
+HEARTBEAT_DEFAULT = os.getenv("HEARTBEAT_DEFAULT", "0") == "1"
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "5"))
+# Không nhận frame nào trong khoảng này thì robot bị coi là "stale"
+HEARTBEAT_STALE_AFTER = float(os.getenv("HEARTBEAT_STALE_AFTER", "8"))
+# Không nhận frame nào trong khoảng này thì robot bị loại
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", "15"))
+TIMER_WHEEL_TICK = float(os.getenv("TIMER_WHEEL_TICK", "0.25"))
+TIMER_WHEEL_SLOTS = 512
+
+# Mã đóng khi robot không trả lời heartbeat
+CLOSE_HEARTBEAT_TIMEOUT = 1001
+
+# Hệ số EWMA cho ước lượng RTT (giống SRTT của TCP)
+_RTT_ALPHA = 0.125
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: mỗi slot ứng với một tick, hẹn giờ dài hơn một vòng
+    lưu số vòng còn lại. Lên lịch, hủy và kích hoạt đều O(1) mỗi hẹn giờ.
+    """
+    def __init__(self, tick: float = TIMER_WHEEL_TICK, slots: int = TIMER_WHEEL_SLOTS):
+        self.tick = tick
+        self._slots = [dict() for _ in range(slots)]
+        self._entries: Dict[Hashable, int] = {}  # key -> slot đang chứa hẹn giờ
+        self._cursor = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable[[], None]):
+        """Hẹn giờ gọi callback sau delay giây; thay thế hẹn giờ cũ cùng key."""
+        self.cancel(key)
+        ticks = max(1, int(round(delay / self.tick)))
+        rounds, offset = divmod(ticks, len(self._slots))
+        slot = (self._cursor + offset) % len(self._slots)
+        self._slots[slot][key] = [rounds, callback]
+        self._entries[key] = slot
+
+    def cancel(self, key: Hashable):
+        slot = self._entries.pop(key, None)
+        if slot is not None:
+            self._slots[slot].pop(key, None)
+
+    def advance(self):
+        """Tiến một tick và gọi các hẹn giờ đến hạn."""
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        bucket = self._slots[self._cursor]
+        due = []
+        for key, entry in bucket.items():
+            if entry[0] == 0:
+                due.append((key, entry[1]))
+            else:
+                entry[0] -= 1
+        for key, callback in due:
+            del bucket[key]
+            del self._entries[key]
+            try:
+                callback()
+            except Exception as e:
+                print(f"Lỗi trong hẹn giờ {key}: {e}")
+
+    async def _run(self):
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.tick
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+            self.advance()
+
+
+class _RobotLiveness:
+    __slots__ = ("last_seen", "rtt", "ping_id", "ping_sent_at", "stale", "send_ping", "on_expire")
+
+    def __init__(self, send_ping: Callable[[int], None], on_expire: Callable[[], Awaitable[None]]):
+        self.last_seen = time.monotonic()
+        self.rtt: Optional[float] = None
+        self.ping_id = 0
+        self.ping_sent_at = 0.0
+        self.stale = False
+        self.send_ping = send_ping
+        self.on_expire = on_expire
+
+
+class LivenessMonitor:
+    def __init__(self, interval: float = HEARTBEAT_INTERVAL, stale_after: float = HEARTBEAT_STALE_AFTER,
+                 timeout: float = HEARTBEAT_TIMEOUT, wheel: Optional[TimerWheel] = None):
+        self.interval = interval
+        self.stale_after = stale_after
+        self.timeout = timeout
+        self.wheel = wheel or TimerWheel()
+        self._robots: Dict[str, _RobotLiveness] = {}
+        self._expire_tasks: set = set()
+        self._stale_listener: Optional[Callable[[str, bool], None]] = None
+        self.expired = 0
+
+    def set_stale_listener(self, listener: Callable[[str, bool], None]):
+        """listener(robot_id, stale) được gọi khi robot chuyển sang/thoát trạng thái stale."""
+        self._stale_listener = listener
+
+    def _set_stale(self, robot_id: str, state: _RobotLiveness, stale: bool):
+        state.stale = stale
+        if self._stale_listener is not None:
+            self._stale_listener(robot_id, stale)
+
+    def register(self, robot_id: str, send_ping: Callable[[int], None], on_expire: Callable[[], Awaitable[None]]):
+        """
+        Theo dõi robot. send_ping(ping_id) gửi ping (không chờ),
+        on_expire() được gọi khi robot im lặng quá timeout.
+        """
+        self.wheel.start()
+        self._robots[robot_id] = _RobotLiveness(send_ping, on_expire)
+        self.wheel.schedule(robot_id, self.interval, lambda: self._check(robot_id))
+
+    def unregister(self, robot_id: str):
+        self._robots.pop(robot_id, None)
+        self.wheel.cancel(robot_id)
+
+    def touch(self, robot_id: str):
+        """Ghi nhận robot còn sống khi nhận được bất kỳ frame nào (O(1), không đụng tới timer wheel)."""
+        state = self._robots.get(robot_id)
+        if state is not None:
+            state.last_seen = time.monotonic()
+            if state.stale:
+                self._set_stale(robot_id, state, False)
+
+    def pong(self, robot_id: str, ping_id: int):
+        """Cập nhật ước lượng RTT khi robot trả lời ping."""
+        state = self._robots.get(robot_id)
+        if state is None or ping_id != state.ping_id or not state.ping_sent_at:
+            return
+        sample = time.monotonic() - state.ping_sent_at
+        state.ping_sent_at = 0.0
+        state.rtt = sample if state.rtt is None else (1 - _RTT_ALPHA) * state.rtt + _RTT_ALPHA * sample
+
+    def get_rtt(self, robot_id: str) -> Optional[float]:
+        """RTT ước lượng (giây) của robot, None nếu chưa có mẫu."""
+        state = self._robots.get(robot_id)
+        return state.rtt if state else None
+
+    def is_stale(self, robot_id: str) -> bool:
+        state = self._robots.get(robot_id)
+        return state is not None and state.stale
+
+    def is_monitored(self, robot_id: str) -> bool:
+        return robot_id in self._robots
+
+    def _check(self, robot_id: str):
+        state = self._robots.get(robot_id)
+        if state is None:
+            return
+        silent = time.monotonic() - state.last_seen
+        if silent >= self.timeout:
+            print(f"Robot {robot_id} không phản hồi sau {silent:.1f}s, loại bỏ kết nối")
+            self.unregister(robot_id)
+            self.expired += 1
+            task = asyncio.create_task(state.on_expire())
+            self._expire_tasks.add(task)
+            task.add_done_callback(self._expire_tasks.discard)
+            return
+
+        if silent >= self.stale_after and not state.stale:
+            self._set_stale(robot_id, state, True)
+        if silent >= self.interval:
+            state.ping_id = state.ping_id % 0xFFFFFFFF + 1
+            state.ping_sent_at = time.monotonic()
+            state.send_ping(state.ping_id)
+        # Kiểm tra lại ở lần ping tiếp theo, khi đến hạn stale hoặc timeout, tùy cái nào sớm hơn
+        next_check = min(self.interval, self.timeout - silent)
+        if not state.stale:
+            next_check = min(next_check, self.stale_after - silent)
+        self.wheel.schedule(robot_id, next_check, lambda: self._check(robot_id))
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "monitored": len(self._robots),
+            "timers": len(self.wheel),
+            "expired": self.expired,
+        }
+
+
+# Singleton instance
+liveness_monitor = LivenessMonitor()
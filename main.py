@@ -1,15 +1,45 @@
-from fastapi import FastAPI, Query, HTTPException
+from startup import startup, PROCESS_STARTED, PHASE_IMPORT, PHASE_ACTION_JOURNAL
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import FastAPI, Query, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
-from firebase import verify_firebase_token
+from fastapi.responses import JSONResponse, Response
+from firebase import verify_firebase_token_async, revoke_user_tokens
 import ws_routes
+from pending_actions import pending_manager
 import uvicorn
-from connections import get_all_robots_status
+import gemini
+from connections import registry, get_fleet_status, ROBOT_STATUSES
+from telemetry_store import telemetry_store, TELEMETRY_MAX_POINTS
+from outbound import all_queue_stats
+from metrics import metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+
+# Thời gian tối đa một request long-poll /api/robots được giữ
+FLEET_LONG_POLL_MAX = float(os.getenv("FLEET_LONG_POLL_MAX", "60"))
+FLEET_PAGE_MAX = 1000
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Khôi phục journal, rồi nhận kết nối ngay và làm nóng Firebase và Gemini ở nền (xem startup.py)."""
+    startup.phases[PHASE_IMPORT] = time.perf_counter() - PROCESS_STARTED
+    # Chuỗi hành động phải được khôi phục trước khi robot kết nối lại
+    await startup.run_phase(PHASE_ACTION_JOURNAL, pending_manager.open_journal, in_thread=True)
+    await registry.start()
+    warm_up = asyncio.create_task(startup.warm_up())
+    yield
+    warm_up.cancel()
+    await gemini.gemini_pool.close()
+    await registry.close()
 
 # Khởi tạo FastAPI app
 app = FastAPI(
     title="Robot Server API",
     description="Server để điều khiển robot thông qua WebSocket và REST API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 # Cấu hình CORS
@@ -24,20 +54,106 @@ app.add_middleware(
 # Đăng ký các router
 app.include_router(ws_routes.router, tags=["WebSocket"])
 
+def _fleet_etag(version: int) -> str:
+    return f'"fleet-{version}"'
+
 @app.get("/api/robots", tags=["Robots"])
-async def list_robots(token: str = Query(...)):
-    """Lấy danh sách tất cả robot và trạng thái của chúng"""
-    token_result = verify_firebase_token(token)
+async def list_robots(
+    token: str = Query(...),
+    status: Optional[str] = Query(None, description="Chỉ lấy robot có trạng thái này (available, controlled, stale)"),
+    after: Optional[str] = Query(None, description="Con trỏ phân trang: robot_id cuối cùng của trang trước (trường next)"),
+    limit: Optional[int] = Query(None, ge=1, le=FLEET_PAGE_MAX, description="Số robot tối đa mỗi trang, mặc định lấy tất cả"),
+    wait: float = Query(0, ge=0, description="Long-poll: chờ tối đa số giây này nếu trạng thái chưa đổi so với If-None-Match"),
+    if_none_match: Optional[str] = Header(None),
+):
+    """
+    Lấy danh sách robot và trạng thái của chúng.
+    ETag là version của trạng thái fleet: gửi lại qua If-None-Match để nhận 304 khi không có gì thay đổi,
+    kèm wait để chờ đến khi có thay đổi thay vì poll liên tục.
+    """
+    token_result = await verify_firebase_token_async(token)
     if not token_result['success']:
         raise HTTPException(status_code=401, detail=f"Invalid token: {token_result.get('error', 'Unknown error')}")
-    
-    robots_status = get_all_robots_status()
-    return {
-        "robots": robots_status,
-        "total": len(robots_status),
-        "available": sum(1 for status in robots_status.values() if status == "available"),
-        "controlled": sum(1 for status in robots_status.values() if status == "controlled"),
+    if status is not None and status not in ROBOT_STATUSES:
+        raise HTTPException(status_code=400, detail=f"Trạng thái không hợp lệ: {status}")
+
+    fleet = get_fleet_status()
+    version = fleet.version
+    if if_none_match == _fleet_etag(version):
+        if wait > 0:
+            await fleet.wait_for_change(version, min(wait, FLEET_LONG_POLL_MAX))
+        if fleet.version == version:
+            return Response(status_code=304, headers={"ETag": _fleet_etag(version)})
+        version = fleet.version
+
+    robots, next_cursor = fleet.page(after, limit, status)
+    counts = fleet.counts()
+    body = {
+        "robots": robots,
+        "total": counts["total"],
+        "available": counts["available"],
+        "controlled": counts["controlled"],
+        "stale": counts["stale"],
+        "version": version,
+        "next": next_cursor,
     }
+    return JSONResponse(body, headers={"ETag": _fleet_etag(version)})
+
+@app.get("/api/robots/{robot_id}/telemetry", tags=["Robots"])
+async def robot_telemetry(
+    robot_id: str,
+    token: str = Query(...),
+    start: Optional[float] = Query(None, description="Thời điểm bắt đầu (epoch giây), mặc định 60 giây trước"),
+    end: Optional[float] = Query(None, description="Thời điểm kết thúc (epoch giây), mặc định hiện tại"),
+    points: int = Query(200, ge=1, le=TELEMETRY_MAX_POINTS, description="Số điểm tối đa sau khi gộp"),
+):
+    """Lấy lịch sử telemetry của robot trong một khoảng thời gian, gộp min/max/mean theo số điểm yêu cầu"""
+    token_result = await verify_firebase_token_async(token)
+    if not token_result['success']:
+        raise HTTPException(status_code=401, detail=f"Invalid token: {token_result.get('error', 'Unknown error')}")
+
+    buffer = telemetry_store.get(robot_id)
+    if buffer is None:
+        raise HTTPException(status_code=404, detail=f"Không có telemetry của robot {robot_id}")
+
+    end = time.time() if end is None else end
+    start = end - 60 if start is None else start
+    return {"robot_id": robot_id, "start": start, "end": end, **buffer.query(start, end, points)}
+
+@app.post("/api/auth/revoke", tags=["Auth"])
+async def revoke_tokens(token: str = Query(...)):
+    """Đăng xuất mọi thiết bị: thu hồi mọi token đã cấp cho user sở hữu token này"""
+    token_result = await verify_firebase_token_async(token)
+    if not token_result['success']:
+        raise HTTPException(status_code=401, detail=f"Invalid token: {token_result.get('error', 'Unknown error')}")
+    await revoke_user_tokens(token_result['uid'])
+    return {"revoked": True, "uid": token_result['uid']}
+
+@app.get("/api/outbound", tags=["Monitoring"])
+async def outbound_queues(
+    token: str = Query(...),
+    peer: Optional[str] = Query(None, description="Chỉ lấy hàng đợi của loại kết nối này (robot, client, subscriber, fleet)"),
+):
+    """Thống kê hàng đợi gửi của từng kết nối trên worker này: độ sâu, số tin đã gửi/bỏ, độ trễ gửi"""
+    token_result = await verify_firebase_token_async(token)
+    if not token_result['success']:
+        raise HTTPException(status_code=401, detail=f"Invalid token: {token_result.get('error', 'Unknown error')}")
+    return {"queues": all_queue_stats(peer)}
+
+@app.get("/health", tags=["Monitoring"])
+async def health():
+    """Liveness: tiến trình còn chạy và event loop còn phản hồi"""
+    return {"status": "ok"}
+
+@app.get("/ready", tags=["Monitoring"])
+async def ready():
+    """Readiness: 503 cho đến khi làm nóng xong (Firebase, Gemini), kèm thời gian từng bước khởi động"""
+    return JSONResponse(startup.to_dict(), status_code=200 if startup.ready else 503)
+
+@app.get("/metrics", tags=["Monitoring"], include_in_schema=False)
+async def prometheus_metrics():
+    """Các chỉ số của worker này theo định dạng text của Prometheus"""
+    return Response(content=metrics.render(), media_type=METRICS_CONTENT_TYPE)
 
 if __name__ == "__main__":
     print("Khởi động Robot Server...")
@@ -1,14 +1,36 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Optional
+import codec
+import wire
 
-@dataclass
+@dataclass(slots=True)
 class Action:
     action_id: str
     intent: str
     params: dict
+    seq: int = 0  # Số thứ tự trong cửa sổ gửi của robot, do PendingActionManager gán
+    dispatched_at: float = field(default=0.0, repr=False, compare=False)  # time.monotonic() khi gửi, để đo thời gian đến ack
+    steps: list = field(default_factory=list, compare=False)  # Chỉ số các bước gốc action đại diện (sau khi gộp)
+    # Bản mã hóa đã tạo, kèm seq lúc mã hóa: action gửi lại (cửa sổ, kết nối lại) không phải mã hóa lại
+    _json: Optional[tuple] = field(default=None, init=False, repr=False, compare=False)
+    _bytes: Optional[tuple] = field(default=None, init=False, repr=False, compare=False)
 
     def to_dict(self):
         return {
             "action_id": self.action_id,
+            "seq": self.seq,
             "intent": self.intent,
             "params": self.params,
-        }
\ No newline at end of file
+        }
+
+    def to_json(self) -> str:
+        """Mã hóa action thành JSON gửi cho robot (giao thức JSON)."""
+        if self._json is None or self._json[0] != self.seq:
+            self._json = (self.seq, codec.dumps(self.to_dict()))
+        return self._json[1]
+
+    def to_bytes(self) -> bytes:
+        """Mã hóa action theo giao thức nhị phân (wire.py) cho robot đã chọn binary."""
+        if self._bytes is None or self._bytes[0] != self.seq:
+            self._bytes = (self.seq, wire.encode_action(self))
+        return self._bytes[1]
@@ -0,0 +1,263 @@
+import asyncio
+import os
+import time
+import weakref
+from collections import deque
+from typing import Dict, List, Optional, Union
+from fastapi import WebSocket
+from metrics import metrics, SIZE_BUCKETS
+
+# Hàng đợi gửi riêng cho từng WebSocket: handler chỉ xếp tin nhắn vào hàng đợi,
+# một writer task gửi dần nên client chậm hoặc đã chết không chặn vòng lặp của robot.
+
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "256"))
+# Khi hàng đợi đầy: drop_oldest (bỏ tin thông tin cũ nhất), drop_newest (bỏ tin mới), disconnect (đóng kết nối)
+OUTBOUND_OVERFLOW_POLICY = os.getenv("OUTBOUND_OVERFLOW_POLICY", "drop_oldest")
+# Thời gian tối đa chờ gửi một frame; peer không đọc quá thời gian này bị coi là chậm và bị ngắt
+SEND_TIMEOUT = float(os.getenv("OUTBOUND_SEND_TIMEOUT", "10"))
+
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_DROP_NEWEST = "drop_newest"
+POLICY_DISCONNECT = "disconnect"
+
+# Mã đóng khi client/robot không đọc kịp
+CLOSE_SLOW_CONSUMER = 1013
+
+FRAME_BYTES = metrics.histogram(
+    "ws_frame_bytes", "Kích thước frame WebSocket (frame text tính theo số ký tự)", ["direction", "peer"], SIZE_BUCKETS)
+OUTBOUND_DROPPED = metrics.counter("outbound_dropped_total", "Số tin bị bỏ khỏi hàng đợi gửi", ["peer"])
+OUTBOUND_SEND_LATENCY = metrics.histogram(
+    "outbound_send_latency_seconds", "Thời gian từ lúc tin được xếp vào hàng đợi đến khi gửi xong", ["peer"])
+
+_KIND_TEXT = "text"
+_KIND_BYTES = "bytes"
+_KIND_CLOSE = "close"
+
+
+class _Item:
+    __slots__ = ("kind", "payload", "enqueued_at", "coalesce_key")
+
+    def __init__(self, kind: str, payload: Union[str, bytes, int], coalesce_key: Optional[str] = None):
+        self.kind = kind
+        self.payload = payload
+        self.enqueued_at = time.monotonic()
+        self.coalesce_key = coalesce_key
+
+
+class OutboundQueue:
+    """
+    Bọc một WebSocket với hàng đợi gửi có giới hạn.
+    - Tin điều khiển (action, flush, stop) luôn được gửi trước tin thông tin.
+    - Tin thông tin có coalesce_key chỉ giữ bản mới nhất chưa gửi.
+    - Khi đầy, áp dụng chính sách tràn; tin điều khiển không bao giờ bị bỏ,
+      nếu không còn chỗ cho tin điều khiển thì đóng kết nối.
+    Giao diện send_text/send_bytes/close giống WebSocket để dùng thay thế trong registry.
+    """
+    def __init__(self, websocket: WebSocket, name: str = "", max_size: int = OUTBOUND_QUEUE_SIZE,
+                 policy: str = OUTBOUND_OVERFLOW_POLICY):
+        self.websocket = websocket
+        self.name = name
+        # Nhãn metric: loại kết nối (robot/client/subscriber) lấy từ tên hàng đợi
+        self.peer = name.split(":", 1)[0] or "unknown"
+        self.max_size = max_size
+        self.policy = policy
+        self._control: deque = deque()
+        self._info: deque = deque()
+        self._coalesced: Dict[str, _Item] = {}
+        self._wakeup = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        self.closed = False
+        # Thống kê
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self._latency_total = 0.0
+        _queues.add(self)
+
+    def start(self):
+        """Bắt đầu writer task (gọi sau khi websocket.accept())."""
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_loop())
+
+    @property
+    def depth(self) -> int:
+        return len(self._control) + len(self._info)
+
+    async def send_text(self, data: str, control: bool = False, coalesce_key: Optional[str] = None):
+        self.enqueue_text(data, control, coalesce_key)
+
+    async def send_bytes(self, data: bytes, control: bool = False, coalesce_key: Optional[str] = None):
+        self.enqueue_bytes(data, control, coalesce_key)
+
+    def enqueue_text(self, data: str, control: bool = False, coalesce_key: Optional[str] = None) -> bool:
+        return self.enqueue(_Item(_KIND_TEXT, data, coalesce_key), control)
+
+    def enqueue_bytes(self, data: bytes, control: bool = False, coalesce_key: Optional[str] = None) -> bool:
+        return self.enqueue(_Item(_KIND_BYTES, data, coalesce_key), control)
+
+    async def close(self, code: int = 1000, reason: Optional[str] = None):
+        """Đóng kết nối sau khi gửi hết các tin điều khiển đang chờ."""
+        if self.closed:
+            return
+        self._info.clear()
+        self._coalesced.clear()
+        self._control.append(_Item(_KIND_CLOSE, code))
+        self.closed = True
+        self._wakeup.set()
+        if self._writer is None:
+            await self._close_socket(code)
+
+    def enqueue(self, item: _Item, control: bool = False) -> bool:
+        """Xếp tin vào hàng đợi, không chờ gửi. Trả về False nếu tin bị bỏ."""
+        if self.closed:
+            self._drop()
+            return False
+
+        if not control and item.coalesce_key is not None:
+            pending = self._coalesced.get(item.coalesce_key)
+            if pending is not None:
+                # Thay nội dung tin cùng loại chưa gửi bằng bản mới nhất
+                pending.kind = item.kind
+                pending.payload = item.payload
+                self.coalesced += 1
+                return True
+
+        if self.depth >= self.max_size and not self._make_room(control):
+            self._drop()
+            return False
+
+        if control:
+            self._control.append(item)
+        else:
+            self._info.append(item)
+            if item.coalesce_key is not None:
+                self._coalesced[item.coalesce_key] = item
+        self.max_depth = max(self.max_depth, self.depth)
+        self._wakeup.set()
+        return True
+
+    def _make_room(self, control: bool) -> bool:
+        if self.policy == POLICY_DROP_OLDEST and self._info:
+            dropped = self._info.popleft()
+            if dropped.coalesce_key is not None:
+                self._coalesced.pop(dropped.coalesce_key, None)
+            self._drop()
+            return True
+        if self.policy == POLICY_DROP_NEWEST and not control:
+            return False
+        # Chính sách disconnect, hoặc không còn chỗ cho tin điều khiển
+        print(f"Hàng đợi gửi {self.name} bị đầy ({self.depth}), đóng kết nối")
+        self._control.clear()
+        self._info.clear()
+        self._coalesced.clear()
+        self._control.append(_Item(_KIND_CLOSE, CLOSE_SLOW_CONSUMER))
+        self.closed = True
+        self._wakeup.set()
+        return False
+
+    def _next_item(self) -> Optional[_Item]:
+        if self._control:
+            return self._control.popleft()
+        if self._info:
+            item = self._info.popleft()
+            if item.coalesce_key is not None:
+                self._coalesced.pop(item.coalesce_key, None)
+            return item
+        return None
+
+    async def _write_loop(self):
+        while True:
+            item = self._next_item()
+            if item is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            if item.kind == _KIND_CLOSE:
+                await self._close_socket(item.payload)
+                return
+            try:
+                if item.kind == _KIND_TEXT:
+                    await asyncio.wait_for(self.websocket.send_text(item.payload), SEND_TIMEOUT)
+                else:
+                    await asyncio.wait_for(self.websocket.send_bytes(item.payload), SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                # Peer không đọc: tin đóng kết nối đang chờ sau lần gửi bị kẹt không bao giờ chạy được
+                print(f"Gửi tin đến {self.name} quá {SEND_TIMEOUT:g} giây, đóng kết nối")
+                self._abandon()
+                await self._close_socket(CLOSE_SLOW_CONSUMER)
+                return
+            except Exception as e:
+                # Kết nối đã đóng: bỏ các tin còn lại
+                print(f"Lỗi khi gửi tin đến {self.name}: {e}")
+                self._abandon()
+                return
+
+            latency = time.monotonic() - item.enqueued_at
+            FRAME_BYTES.observe(len(item.payload), "out", self.peer)
+            OUTBOUND_SEND_LATENCY.observe(latency, self.peer)
+            self.sent += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self._latency_total += latency
+
+    def _abandon(self):
+        """Đánh dấu hàng đợi đã đóng và bỏ mọi tin còn lại."""
+        self.closed = True
+        self._drop(self.depth)
+        self._control.clear()
+        self._info.clear()
+        self._coalesced.clear()
+
+    def _drop(self, count: int = 1):
+        self.dropped += count
+        OUTBOUND_DROPPED.inc(self.peer, amount=count)
+
+    async def _close_socket(self, code: int):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Đóng kết nối {self.name} quá {SEND_TIMEOUT:g} giây")
+        except RuntimeError:
+            # Có thể kết nối đã bị ngắt
+            pass
+
+    async def aclose(self):
+        """Dừng writer task khi handler kết thúc."""
+        self.closed = True
+        if self._writer is not None and not self._writer.done():
+            self._writer.cancel()
+        _queues.discard(self)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+            "avg_latency": self._latency_total / self.sent if self.sent else 0.0,
+        }
+
+
+_queues: "weakref.WeakSet[OutboundQueue]" = weakref.WeakSet()
+
+
+def all_queue_stats(peer: Optional[str] = None) -> List[Dict[str, float]]:
+    """Thống kê của mọi hàng đợi gửi đang hoạt động (lọc theo loại kết nối nếu có), xem /api/outbound."""
+    return [{"name": queue.name, **queue.stats()} for queue in list(_queues) if peer is None or queue.peer == peer]
+
+
+def _queue_depths() -> Dict[tuple, float]:
+    depths: Dict[tuple, float] = {}
+    for queue in list(_queues):
+        depths[(queue.peer,)] = depths.get((queue.peer,), 0) + queue.depth
+    return depths
+
+
+metrics.gauge_callback("outbound_queue_depth", "Tổng số tin đang chờ gửi theo loại kết nối", _queue_depths, ["peer"])
@@ -1,67 +1,338 @@
-from typing import Dict, List, Optional, Deque, Tuple
-from collections import deque
+import os
+import time
+from typing import Dict, List, Optional, Deque, Iterable
+from collections import deque, OrderedDict
 from model import Action
+from plan_optimizer import PLAN_OPTIMIZER_ENABLED, normalize_action, merge_actions
+from action_journal import open_action_journal, ACTION_RESUME_TTL
+from metrics import metrics
+
+# Số action tối đa được gửi trước cho một robot (robot phải tự khai báo window khi kết nối)
+MAX_ACTION_WINDOW = int(os.getenv("MAX_ACTION_WINDOW", "8"))
+
+ACTION_ACK_SECONDS = metrics.histogram(
+    "action_ack_seconds", "Thời gian từ lúc gửi action đến khi robot ack, theo intent", ["intent"])
+
+def clamp_window(window: int) -> int:
+    """Giới hạn kích thước cửa sổ robot khai báo trong [1, MAX_ACTION_WINDOW]."""
+    return max(1, min(int(window), MAX_ACTION_WINDOW))
 
 class PendingActionManager:
+    """
+    Quản lý chuỗi hành động của từng robot theo cửa sổ trượt:
+    tối đa `window` action được gửi trước (đang chờ ack), phần còn lại nằm trong hàng đợi.
+    Robot firmware cũ dùng window=1 (gửi - chờ ack - gửi tiếp).
+    Khi có journal, chuỗi đang dở được giữ lại khi robot mất kết nối (hoặc server khởi động lại)
+    và gửi tiếp từ action chưa ack đầu tiên khi robot kết nối lại.
+    """
     def __init__(self):
-        # Lưu trữ hàng đợi các PendingAction cho mỗi robot
+        # Lưu trữ hàng đợi các action chưa gửi cho mỗi robot
         self._robot_action_queues: Dict[str, Deque[Action]] = {}
-        # Lưu trữ PendingAction hiện tại đang được robot thực thi
-        self._robot_current_executing_action: Dict[str, Action] = {}
+        # Các action đã gửi nhưng robot chưa ack, theo thứ tự seq
+        self._robot_in_flight_actions: Dict[str, "OrderedDict[int, Action]"] = {}
+        # Kích thước cửa sổ đã thương lượng với robot
+        self._robot_windows: Dict[str, int] = {}
+        # Seq tiếp theo sẽ gán cho action của mỗi robot
+        self._robot_next_seq: Dict[str, int] = {}
+        # Id của chuỗi hành động hiện tại của mỗi robot (dùng khi actions đến dần)
+        self._robot_sequence_ids: Dict[str, int] = {}
+        self._last_sequence_id = 0
+        # Tiến độ chuỗi hiện tại theo số bước gốc (trước khi gộp): [đã hoàn thành, tổng]
+        self._robot_progress: Dict[str, List[int]] = {}
+        self._journal = None
+        # Robot mất kết nối khi chuỗi chưa xong: thời điểm (monotonic) bắt đầu chờ robot quay lại
+        self._suspended: Dict[str, float] = {}
+        # Chuỗi đọc lại từ journal lúc khởi động, chờ robot kết nối lại
+        self._recovered: Dict[str, dict] = {}
+
+    def open_journal(self):
+        """
+        Mở journal (nếu được bật), đọc lại các chuỗi hành động chưa xong rồi bắt đầu ghi.
+        Gọi một lần lúc khởi động, trước khi nhận kết nối robot (xem main.lifespan).
+        """
+        journal = open_action_journal()
+        if journal is None:
+            return
+        now = time.time()
+        self._recovered = {
+            robot_id: robot for robot_id, robot in journal.recover().items()
+            if now - robot["t"] <= ACTION_RESUME_TTL
+        }
+        journal.start()
+        self._journal = journal
 
-    def create_action_sequence(self, robot_id: str, actions: List[Action]) -> Optional[Action]:
+    def set_robot_window(self, robot_id: str, window: int) -> int:
+        """Thiết lập kích thước cửa sổ cho robot, trả về giá trị thực tế được dùng."""
+        window = clamp_window(window)
+        self._robot_windows[robot_id] = window
+        return window
+
+    def get_robot_window(self, robot_id: str) -> int:
+        return self._robot_windows.get(robot_id, 1)
+
+    def remove_robot(self, robot_id: str):
+        """Xóa toàn bộ trạng thái của robot khi robot ngắt kết nối."""
+        self.cancel_robot_actions(robot_id)
+        self._robot_windows.pop(robot_id, None)
+        self._robot_next_seq.pop(robot_id, None)
+
+    def suspend_robot(self, robot_id: str):
+        """
+        Robot mất kết nối: nếu có journal thì giữ chuỗi đang dở để gửi tiếp khi robot kết nối lại
+        (action đã gửi chưa ack được đưa lại đầu hàng đợi), ngược lại xóa như remove_robot.
+        """
+        if self._journal is None or robot_id not in self._robot_sequence_ids:
+            self.remove_robot(robot_id)
+            return
+        now = time.monotonic()
+        for other_id, suspended_at in list(self._suspended.items()):
+            if now - suspended_at > ACTION_RESUME_TTL:
+                self.cancel_robot_actions(other_id)
+        in_flight = self._robot_in_flight_actions.pop(robot_id, None)
+        if in_flight:
+            action_queue = self._robot_action_queues.setdefault(robot_id, deque())
+            action_queue.extendleft(reversed(in_flight.values()))
+        self._suspended[robot_id] = now
+
+    def resume_robot(self, robot_id: str) -> List[Action]:
+        """
+        Robot kết nối lại: tiếp tục chuỗi đang dở (giữ trong bộ nhớ hoặc đọc từ journal).
+        Trả về các hành động cần gửi lại, bắt đầu từ action chưa ack đầu tiên.
+        """
+        recovered = self._recovered.pop(robot_id, None)
+        if recovered is not None and robot_id not in self._robot_sequence_ids:
+            self._restore(robot_id, recovered)
+        suspended_at = self._suspended.pop(robot_id, None)
+        if suspended_at is not None and time.monotonic() - suspended_at > ACTION_RESUME_TTL:
+            self.cancel_robot_actions(robot_id)
+            return []
+        if robot_id not in self._robot_sequence_ids:
+            return []
+        return self._fill_window(robot_id)
+
+    def _restore(self, robot_id: str, recovered: dict):
+        """Dựng lại chuỗi hành động từ trạng thái journal."""
+        self._last_sequence_id += 1
+        self._robot_sequence_ids[robot_id] = self._last_sequence_id
+        self._robot_progress[robot_id] = list(recovered["p"])
+        self._robot_next_seq[robot_id] = recovered["n"]
+        self._robot_action_queues[robot_id] = deque(
+            Action(action_id=item["id"], intent=item["intent"], params=item["params"],
+                   seq=item["seq"], steps=item.get("steps", []))
+            for item in recovered["actions"]
+        )
+        print(f"Khôi phục chuỗi hành động của robot {robot_id}: {len(recovered['actions'])} action chưa hoàn thành")
+
+    def _record(self, op: str, robot_id: str, **fields):
+        """Ghi sự kiện vào journal kèm tiến độ và seq kế tiếp hiện tại."""
+        if self._journal is None:
+            return
+        progress = self._robot_progress.get(robot_id)
+        if progress is not None:
+            fields["p"] = list(progress)
+        fields["n"] = self._robot_next_seq.get(robot_id, 1)
+        self._journal.record(op, robot_id, **fields)
+
+    def create_action_sequence(self, robot_id: str, actions: List[Action]) -> List[Action]:
         """
         Tạo một chuỗi hành động mới cho robot.
         Hủy bỏ chuỗi hành động cũ nếu có.
-        Trả về hành động đầu tiên trong chuỗi để gửi đến robot.
+        Trả về các hành động cần gửi ngay đến robot (tối đa bằng window).
         """
-        self.cancel_robot_actions(robot_id)
+        sequence_id = self.begin_action_sequence(robot_id)
 
         if not actions:
-            return None
+            return []
+
+        return self.append_actions(robot_id, sequence_id, actions)
+
+    def begin_action_sequence(self, robot_id: str) -> int:
+        """
+        Mở một chuỗi hành động mới (rỗng) cho robot, hủy chuỗi cũ nếu có.
+        Trả về id của chuỗi để dùng với append_actions khi actions đến dần (stream).
+        """
+        self.cancel_robot_actions(robot_id)
+        self._last_sequence_id += 1
+        self._robot_sequence_ids[robot_id] = self._last_sequence_id
+        self._robot_progress[robot_id] = [0, 0]
+        self._record("begin", robot_id)
+        return self._last_sequence_id
+
+    def append_actions(self, robot_id: str, sequence_id: int, actions: Iterable[Action],
+                       optimize: bool = False) -> List[Action]:
+        """
+        Thêm actions vào cuối chuỗi sequence_id của robot và gán seq cho từng action.
+        Bỏ qua nếu chuỗi đã bị hủy hoặc thay thế bởi chuỗi mới.
+        optimize=True (actions đến dần từ stream): gộp action mới vào action cuối hàng đợi
+        chưa gửi nếu được, xem plan_optimizer.
+        Trả về các hành động cần gửi ngay nếu cửa sổ còn chỗ.
+        """
+        if self._robot_sequence_ids.get(robot_id) != sequence_id:
+            return []
 
-        action_queue = deque()
+        action_queue = self._robot_action_queues.setdefault(robot_id, deque())
+        progress = self._robot_progress.setdefault(robot_id, [0, 0])
+        next_seq = self._robot_next_seq.get(robot_id, 1)
         for action in actions:
+            progress[1] += _step_count(action)
+            if optimize and PLAN_OPTIMIZER_ENABLED:
+                normalized = normalize_action(action)
+                if normalized is None:
+                    # Bước không làm gì: coi như đã hoàn thành
+                    progress[0] += _step_count(action)
+                    self._record("progress", robot_id)
+                    continue
+                action = normalized
+                # Chỉ gộp với action chưa gửi (còn trong hàng đợi)
+                merged = merge_actions(action_queue[-1], action) if action_queue else None
+                if merged is not None:
+                    tail = action_queue.pop()
+                    if merged:
+                        action_queue.append(merged[0])
+                        self._record("add", robot_id, a=_journal_action(merged[0]))
+                    else:
+                        # Hai action triệt tiêu nhau: trả lại seq của action bị bỏ
+                        progress[0] += _step_count(tail) + _step_count(action)
+                        next_seq = tail.seq
+                        self._robot_next_seq[robot_id] = next_seq
+                        self._record("drop", robot_id, seq=tail.seq)
+                    continue
+            # seq là số 32-bit, quay vòng về 1
+            action.seq = next_seq
+            next_seq = next_seq % 0xFFFFFFFF + 1
             action_queue.append(action)
+            self._robot_next_seq[robot_id] = next_seq
+            self._record("add", robot_id, a=_journal_action(action))
+        self._robot_next_seq[robot_id] = next_seq
 
-        self._robot_action_queues[robot_id] = action_queue
-        
-        # Lấy hành động đầu tiên để gửi đến robot
-        first_action: Action = action_queue.popleft()
-        self._robot_current_executing_action[robot_id] = first_action
-        return first_action
+        return self._fill_window(robot_id)
 
-    def process_robot_completion(self, robot_id: str, completed_action_id: str) -> Optional[Action]:
+    def process_robot_completion(self, robot_id: str, completed_action_id: Optional[str] = None,
+                                 ack_seq: Optional[int] = None, sack: Optional[Iterable[int]] = None) -> List[Action]:
         """
         Xử lý thông báo hoàn thành hành động từ robot.
-        Trả về hành động tiếp theo trong chuỗi nếu có.
+        - completed_action_id: ack một action theo action_id (firmware cũ)
+        - ack_seq: ack tích lũy, mọi action có seq <= ack_seq đã hoàn thành
+        - sack: ack chọn lọc theo danh sách seq
+        Trả về các hành động tiếp theo cần gửi để lấp đầy cửa sổ.
         """
-        current_executing_action = self._robot_current_executing_action.get(robot_id)
+        in_flight = self._robot_in_flight_actions.get(robot_id)
+        if not in_flight:
+            return []
 
-        if not current_executing_action or current_executing_action.action_id != completed_action_id:
-            return None
-        
-        self._robot_current_executing_action.pop(robot_id, None)
+        acked: List[int] = []
+        now = time.monotonic()
+        if completed_action_id:
+            for seq, action in in_flight.items():
+                if action.action_id == completed_action_id:
+                    del in_flight[seq]
+                    self._on_acked(robot_id, action, now)
+                    acked.append(seq)
+                    break
+        if ack_seq is not None:
+            # in_flight giữ thứ tự gửi nên chỉ cần xóa từ đầu
+            while in_flight:
+                seq = next(iter(in_flight))
+                if not _seq_before_or_equal(seq, ack_seq):
+                    break
+                self._on_acked(robot_id, in_flight.pop(seq), now)
+                acked.append(seq)
+        for seq in sack or ():
+            action = in_flight.pop(seq, None)
+            if action is not None:
+                self._on_acked(robot_id, action, now)
+                acked.append(seq)
 
+        if not acked:
+            return []
+        self._record("ack", robot_id, seqs=acked)
+        return self._fill_window(robot_id)
+
+    def _on_acked(self, robot_id: str, action: Action, now: float):
+        ACTION_ACK_SECONDS.observe(now - action.dispatched_at, action.intent)
+        progress = self._robot_progress.get(robot_id)
+        if progress is not None:
+            progress[0] += _step_count(action)
+
+    def _fill_window(self, robot_id: str) -> List[Action]:
+        """Chuyển action từ hàng đợi sang trạng thái đã gửi cho đến khi đầy cửa sổ."""
+        if robot_id in self._suspended:
+            # Robot đang mất kết nối: giữ action trong hàng đợi đến khi robot quay lại
+            return []
         action_queue = self._robot_action_queues.get(robot_id)
-        if action_queue and len(action_queue) > 0:
-            # Lấy hành động tiếp theo từ hàng đợi
-            next_action = action_queue.popleft()
-            self._robot_current_executing_action[robot_id] = next_action
-            return next_action
-        else:
-            # Chuỗi hành động đã hoàn thành
-            self._robot_action_queues.pop(robot_id, None) # Xóa hàng đợi
-            return None
-    
-    def cancel_robot_actions(self, robot_id: str):
-        """Hủy tất cả các hành động đang chờ xử lý và đang thực thi của robot."""
-        self._robot_current_executing_action.pop(robot_id, None)
+        in_flight = self._robot_in_flight_actions.setdefault(robot_id, OrderedDict())
+        window = self.get_robot_window(robot_id)
+
+        to_send: List[Action] = []
+        now = time.monotonic()
+        while action_queue and len(in_flight) < window:
+            action = action_queue.popleft()
+            action.dispatched_at = now
+            in_flight[action.seq] = action
+            to_send.append(action)
+        if to_send:
+            self._record("dispatch", robot_id, seqs=[action.seq for action in to_send])
+
+        if not action_queue:
+            # Hàng đợi đã gửi hết, xóa hàng đợi
+            self._robot_action_queues.pop(robot_id, None)
+        if not in_flight:
+            self._robot_in_flight_actions.pop(robot_id, None)
+        return to_send
+
+    def cancel_robot_actions(self, robot_id: str) -> bool:
+        """
+        Hủy tất cả các hành động đang chờ xử lý và đang thực thi của robot.
+        Trả về True nếu robot đang giữ các action gửi trước trong hàng đợi cục bộ
+        (window > 1) và cần được báo để xóa hàng đợi đó.
+        """
+        in_flight = self._robot_in_flight_actions.pop(robot_id, None)
         self._robot_action_queues.pop(robot_id, None)
-    
+        self._robot_progress.pop(robot_id, None)
+        self._suspended.pop(robot_id, None)
+        recovered = self._recovered.pop(robot_id, None)
+        if self._robot_sequence_ids.pop(robot_id, None) is not None or recovered is not None:
+            self._record("cancel", robot_id)
+        return bool(in_flight) and self.get_robot_window(robot_id) > 1
+
     def has_pending_actions(self, robot_id: str) -> bool:
         """Kiểm tra robot có hành động đang chờ xử lý hoặc đang thực thi không."""
-        return robot_id in self._robot_action_queues or robot_id in self._robot_current_executing_action
+        return robot_id in self._robot_action_queues or robot_id in self._robot_in_flight_actions
+
+    def get_progress(self, robot_id: str) -> Optional[Dict[str, int]]:
+        """Số bước gốc đã hoàn thành và tổng số bước của chuỗi hiện tại, None nếu không có chuỗi."""
+        progress = self._robot_progress.get(robot_id)
+        if progress is None:
+            return None
+        return {"completed_steps": progress[0], "total_steps": progress[1]}
+
+    def get_window_stats(self, robot_id: str) -> Dict[str, int]:
+        """Số action đang chờ ack, số action trong hàng đợi và kích thước cửa sổ của robot."""
+        return {
+            "in_flight": len(self._robot_in_flight_actions.get(robot_id, ())),
+            "queued": len(self._robot_action_queues.get(robot_id, ())),
+            "window": self.get_robot_window(robot_id),
+        }
+
+
+def _journal_action(action: Action) -> dict:
+    return {"id": action.action_id, "seq": action.seq, "intent": action.intent,
+            "params": action.params, "steps": action.steps}
+
+def _step_count(action: Action) -> int:
+    """Số bước gốc action đại diện (action chưa qua tối ưu tính là một bước)."""
+    return len(action.steps) or 1
+
+def _seq_before_or_equal(seq: int, ack_seq: int) -> bool:
+    """So sánh seq 32-bit có quay vòng (serial number arithmetic)."""
+    return ((ack_seq - seq) & 0xFFFFFFFF) < 0x80000000
 
 # Singleton instance
 pending_manager = PendingActionManager()
+
+metrics.gauge_callback(
+    "pending_actions", "Số action đang chờ ack (in_flight) và chưa gửi (queued) của mọi robot",
+    lambda: {
+        ("in_flight",): sum(len(q) for q in pending_manager._robot_in_flight_actions.values()),
+        ("queued",): sum(len(q) for q in pending_manager._robot_action_queues.values()),
+    }, ["state"])
@@ -0,0 +1,125 @@
+import os
+from typing import List, Optional, Tuple
+from model import Action
+
+# Rút gọn chuỗi hành động trước khi gửi cho robot: mỗi action là một vòng gửi - thực hiện - ack,
+# nên gộp các bước liền nhau giúp nhiệm vụ ngắn hơn và ít ack hơn.
+# - tien/lui liên tiếp cùng đơn vị được cộng dồn (tien 2m + lui 2m -> bỏ cả hai)
+# - re_trai/re_phai liên tiếp được cộng dồn, góc chuẩn hóa modulo 360 và quay theo chiều ngắn hơn
+# - bước không làm gì (đi 0m, quay 0/360 độ) bị bỏ
+# - dung_lai và các intent khác (nang, ha...) là ranh giới, không gộp qua
+# Action.steps giữ chỉ số các bước gốc mà action đại diện để báo tiến độ cho client.
+
+PLAN_OPTIMIZER_ENABLED = os.getenv("PLAN_OPTIMIZER", "1") == "1"
+
+_LINEAR_SIGN = {"tien": 1, "lui": -1}
+_TURN_SIGN = {"re_trai": 1, "re_phai": -1}
+_DISTANCE_UNITS = ("m",)
+_ANGLE_UNITS = ("deg",)
+
+
+def _number(value) -> Optional[float]:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return None
+
+
+def _clean(value: float):
+    """Bỏ sai số cộng dấu phẩy động và trả về int nếu là số nguyên."""
+    value = round(value, 6)
+    return int(value) if value.is_integer() else value
+
+
+def _signed_amount(action: Action) -> Optional[Tuple[str, float, str]]:
+    """(loại, giá trị có dấu, đơn vị) nếu action là di chuyển thẳng/quay gộp được, ngược lại None."""
+    params = action.params or {}
+    if set(params) != {"distance", "unit"} and set(params) != {"angle", "unit"}:
+        return None
+    if action.intent in _LINEAR_SIGN and params.get("unit") in _DISTANCE_UNITS:
+        value = _number(params.get("distance"))
+        if value is not None and value >= 0:
+            return "linear", _LINEAR_SIGN[action.intent] * value, params["unit"]
+    if action.intent in _TURN_SIGN and params.get("unit") in _ANGLE_UNITS:
+        value = _number(params.get("angle"))
+        if value is not None and value >= 0:
+            return "turn", _TURN_SIGN[action.intent] * value, params["unit"]
+    return None
+
+
+def _build(kind: str, amount: float, unit: str, template: Action, steps: List[int]) -> Optional[Action]:
+    """Tạo action từ giá trị có dấu; None nếu action không làm gì."""
+    if kind == "linear":
+        if amount == 0:
+            return None
+        intent = "tien" if amount > 0 else "lui"
+        params = {"distance": _clean(abs(amount)), "unit": unit}
+    else:
+        # Đưa về (-180, 180]: quay trái 270 độ tương đương quay phải 90 độ
+        amount = amount % 360
+        if amount > 180:
+            amount -= 360
+        if amount == 0:
+            return None
+        intent = "re_trai" if amount > 0 else "re_phai"
+        params = {"angle": _clean(abs(amount)), "unit": unit}
+    return Action(action_id=template.action_id, intent=intent, params=params, seq=template.seq, steps=steps)
+
+
+def _steps(action: Action) -> List[int]:
+    return list(action.steps)
+
+
+def normalize_action(action: Action) -> Optional[Action]:
+    """Chuẩn hóa góc của một action; None nếu action không làm gì."""
+    amount = _signed_amount(action)
+    if amount is None:
+        return action
+    kind, value, unit = amount
+    return _build(kind, value, unit, action, _steps(action))
+
+
+def merge_actions(prev: Action, nxt: Action) -> Optional[List[Action]]:
+    """
+    Gộp hai action liền nhau.
+    Trả về None nếu không gộp được, [] nếu hai action triệt tiêu nhau, [action] nếu gộp thành một.
+    """
+    a, b = _signed_amount(prev), _signed_amount(nxt)
+    if a is None or b is None or a[0] != b[0] or a[2] != b[2]:
+        return None
+    merged = _build(a[0], a[1] + b[1], a[2], prev, _steps(prev) + _steps(nxt))
+    return [merged] if merged is not None else []
+
+
+def optimize_plan(actions: List[Action]) -> List[Action]:
+    """
+    Rút gọn cả chuỗi hành động. Các bước bị bỏ (không làm gì hoặc triệt tiêu nhau)
+    được gắn vào action kế tiếp (hoặc action cuối) để tiến độ vẫn đếm đủ số bước gốc.
+    Trả về [] nếu cả chuỗi không làm robot thay đổi gì.
+    """
+    if not PLAN_OPTIMIZER_ENABLED:
+        return actions
+
+    result: List[Action] = []
+    carry: List[int] = []
+    for action in actions:
+        normalized = normalize_action(action)
+        if normalized is None:
+            carry.extend(_steps(action))
+            continue
+        if carry:
+            normalized.steps = carry + normalized.steps
+            carry = []
+        if result:
+            merged = merge_actions(result[-1], normalized)
+            if merged is not None:
+                prev = result.pop()
+                if merged:
+                    result.append(merged[0])
+                else:
+                    carry = _steps(prev) + _steps(normalized)
+                continue
+        result.append(normalized)
+
+    if carry and result:
+        result[-1].steps = result[-1].steps + carry
+    return result
@@ -0,0 +1,202 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+from metrics import metrics
+
+# Giới hạn tốc độ bằng token bucket, nạp lại theo đồng hồ monotonic mỗi lần kiểm tra
+# (không cần task nền):
+# - mỗi uid Firebase và mỗi robot_id: số câu lệnh client gửi (mọi câu lệnh đều hủy và dựng lại hàng đợi robot)
+# - toàn server: số lượt gọi Gemini (kể cả hedge) để không đốt hết quota
+# - semaphore giới hạn số lượt Gemini chạy đồng thời, lượt vượt quá chờ tối đa GEMINI_QUEUE_TIMEOUT
+# Đặt rate = 0 để tắt một giới hạn.
+
+CLIENT_RATE_LIMIT = float(os.getenv("CLIENT_RATE_LIMIT", "2"))      # câu lệnh/giây mỗi uid
+CLIENT_RATE_BURST = float(os.getenv("CLIENT_RATE_BURST", "10"))
+ROBOT_RATE_LIMIT = float(os.getenv("ROBOT_RATE_LIMIT", "2"))        # câu lệnh/giây mỗi robot
+ROBOT_RATE_BURST = float(os.getenv("ROBOT_RATE_BURST", "10"))
+GEMINI_RATE_LIMIT = float(os.getenv("GEMINI_RATE_LIMIT", "20"))     # lượt Gemini/giây toàn server
+GEMINI_RATE_BURST = float(os.getenv("GEMINI_RATE_BURST", "40"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "32"))
+GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", "2"))
+# Số bucket tối đa giữ cho mỗi loại khóa (uid, robot_id), bucket lâu không dùng bị bỏ
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "10000"))
+
+RATE_LIMITED = metrics.counter(
+    "rate_limited_total", "Số yêu cầu bị từ chối do giới hạn tốc độ, theo phạm vi", ["scope"])
+
+SCOPE_UID = "uid"
+SCOPE_ROBOT = "robot"
+SCOPE_GEMINI = "gemini"
+SCOPE_GEMINI_QUEUE = "gemini_queue"
+
+
+class RateLimited(Exception):
+    """Yêu cầu vượt giới hạn; retry_after là số giây nên chờ trước khi gửi lại."""
+    def __init__(self, scope: str, retry_after: float, message: str):
+        super().__init__(message)
+        self.scope = scope
+        self.retry_after = retry_after
+
+    def to_message(self, robot_id: str) -> dict:
+        return {
+            "error": str(self),
+            "scope": self.scope,
+            "retry_after": round(self.retry_after, 2),
+            "robot_id": robot_id,
+        }
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: float, now: Optional[float] = None):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic() if now is None else now
+
+    def retry_after(self, now: float, cost: float = 1.0) -> float:
+        """Nạp lại theo thời gian đã trôi qua; 0 nếu đủ token, ngược lại số giây cần chờ."""
+        if now > self.updated_at:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def consume(self, cost: float = 1.0):
+        self.tokens -= cost
+
+    def refund(self, cost: float = 1.0):
+        """Trả lại token đã lấy cho yêu cầu cuối cùng không được thực hiện."""
+        self.tokens = min(self.burst, self.tokens + cost)
+
+    def try_acquire(self, now: Optional[float] = None, cost: float = 1.0) -> float:
+        """Lấy token nếu đủ. Trả về 0 nếu được phép, ngược lại số giây cần chờ."""
+        wait = self.retry_after(time.monotonic() if now is None else now, cost)
+        if wait == 0.0:
+            self.consume(cost)
+        return wait
+
+
+class KeyedRateLimiter:
+    """Một token bucket cho mỗi khóa, giữ tối đa max_keys bucket (bỏ bucket lâu không dùng nhất)."""
+    def __init__(self, rate: float, burst: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def bucket(self, key: str, now: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class CommandRateLimiter:
+    """Giới hạn câu lệnh client theo uid và theo robot_id; chỉ trừ token khi cả hai đều cho phép."""
+    def __init__(self):
+        self.by_uid = KeyedRateLimiter(CLIENT_RATE_LIMIT, CLIENT_RATE_BURST)
+        self.by_robot = KeyedRateLimiter(ROBOT_RATE_LIMIT, ROBOT_RATE_BURST)
+
+    def admit(self, uid: str, robot_id: str):
+        """Raise RateLimited nếu uid hoặc robot đã gửi quá nhiều câu lệnh."""
+        now = time.monotonic()
+        checks = []
+        for scope, limiter, key in ((SCOPE_UID, self.by_uid, uid), (SCOPE_ROBOT, self.by_robot, robot_id)):
+            if not limiter.enabled:
+                continue
+            bucket = limiter.bucket(key, now)
+            wait = bucket.retry_after(now)
+            if wait > 0:
+                RATE_LIMITED.inc(scope)
+                target = "tài khoản" if scope == SCOPE_UID else f"robot {robot_id}"
+                raise RateLimited(scope, wait, f"Gửi câu lệnh quá nhanh cho {target}, thử lại sau {wait:.1f} giây")
+            checks.append(bucket)
+        for bucket in checks:
+            bucket.consume()
+
+
+class GeminiAdmission:
+    """
+    Ngân sách lượt gọi Gemini toàn server (token bucket) và số lượt chạy đồng thời (semaphore).
+    Lượt vượt ngân sách bị từ chối ngay; lượt vượt số đồng thời chờ trong hàng tối đa queue_timeout.
+    """
+    def __init__(self, rate: float = GEMINI_RATE_LIMIT, burst: float = GEMINI_RATE_BURST,
+                 max_concurrency: int = GEMINI_MAX_CONCURRENCY, queue_timeout: float = GEMINI_QUEUE_TIMEOUT):
+        self.budget = TokenBucket(rate, burst) if rate > 0 else None
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.inflight = 0
+        self.waiting = 0
+
+    def saturated(self) -> bool:
+        """Mọi chỗ đang bận: lượt mới sẽ phải xếp hàng."""
+        return self._semaphore.locked()
+
+    def try_spend(self) -> bool:
+        """Trừ ngân sách cho một lệnh gọi phụ (vd. hedge) nếu còn, không chờ."""
+        return self.budget is None or self.budget.try_acquire() == 0.0
+
+    async def acquire(self):
+        """Giữ một chỗ cho lượt Gemini, raise RateLimited nếu hết ngân sách hoặc chờ quá lâu."""
+        if self.budget is not None:
+            wait = self.budget.try_acquire()
+            if wait > 0:
+                RATE_LIMITED.inc(SCOPE_GEMINI)
+                raise RateLimited(SCOPE_GEMINI, wait, f"Máy chủ đang quá tải yêu cầu Gemini, thử lại sau {wait:.1f} giây")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            # Lượt không được gọi Gemini: không tính vào ngân sách
+            self._refund()
+            RATE_LIMITED.inc(SCOPE_GEMINI_QUEUE)
+            raise RateLimited(SCOPE_GEMINI_QUEUE, self.queue_timeout,
+                              "Hàng đợi Gemini đang đầy, vui lòng thử lại sau")
+        except asyncio.CancelledError:
+            self._refund()
+            raise
+        finally:
+            self.waiting -= 1
+        self.inflight += 1
+
+    def _refund(self):
+        if self.budget is not None:
+            self.budget.refund()
+
+    def release(self):
+        self.inflight -= 1
+        self._semaphore.release()
+
+
+# Singleton instance
+command_limiter = CommandRateLimiter()
+gemini_admission = GeminiAdmission()
+
+metrics.gauge_callback(
+    "gemini_turns", "Số lượt Gemini đang chạy (inflight) và đang chờ chỗ (waiting)",
+    lambda: {("inflight",): gemini_admission.inflight, ("waiting",): gemini_admission.waiting}, ["state"])
+metrics.gauge_callback(
+    "rate_limit_config", "Giới hạn đang cấu hình: rate (yêu cầu/giây), burst, concurrency",
+    lambda: {
+        (SCOPE_UID, "rate"): CLIENT_RATE_LIMIT, (SCOPE_UID, "burst"): CLIENT_RATE_BURST,
+        (SCOPE_ROBOT, "rate"): ROBOT_RATE_LIMIT, (SCOPE_ROBOT, "burst"): ROBOT_RATE_BURST,
+        (SCOPE_GEMINI, "rate"): GEMINI_RATE_LIMIT, (SCOPE_GEMINI, "burst"): GEMINI_RATE_BURST,
+        (SCOPE_GEMINI, "concurrency"): GEMINI_MAX_CONCURRENCY,
+    }, ["scope", "param"])
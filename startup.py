@@ -0,0 +1,98 @@
+import asyncio
+import os
+import time
+from typing import Callable, Dict, Optional
+from metrics import metrics
+
+# Khởi động nhanh: server nhận kết nối ngay sau khi import xong app, các việc tốn thời gian
+# chạy ở nền trong lifespan (xem main.py) và /ready chỉ báo sẵn sàng khi đã làm xong:
+# - đọc lại journal chuỗi hành động (chạy trước khi nhận kết nối, xem main.lifespan)
+# - import SDK google-genai và firebase_admin (được import lười, xem gemini.load_sdk, firebase.load_sdk)
+# - khởi tạo Firebase và tải trước public cert để xác thực token
+# - tạo genai.Client dùng chung và chờ pool có phiên Gemini Live đã kết nối
+# Gemini chưa sẵn sàng (lỗi hoặc quá STARTUP_GEMINI_TIMEOUT) không chặn /ready: server vẫn
+# xử lý được các lệnh phân tích cục bộ. Firebase lỗi thì không sẵn sàng vì mọi yêu cầu đều cần xác thực.
+
+STARTUP_GEMINI_TIMEOUT = float(os.getenv("STARTUP_GEMINI_TIMEOUT", "10"))
+
+# Mốc thời gian bắt đầu import app (main import module này đầu tiên)
+PROCESS_STARTED = time.perf_counter()
+
+PHASE_IMPORT = "import_app"
+PHASE_ACTION_JOURNAL = "action_journal"
+PHASE_FIREBASE = "firebase_init"
+PHASE_FIREBASE_CERTS = "firebase_certs"
+PHASE_GEMINI_SDK = "gemini_sdk"
+PHASE_GEMINI_POOL = "gemini_pool"
+# Các bước phải thành công thì worker mới sẵn sàng nhận yêu cầu
+REQUIRED_PHASES = (PHASE_FIREBASE,)
+
+
+class StartupState:
+    """Thời gian và kết quả từng bước khởi động của worker."""
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+        self.warmed_up = False
+        self.ready_after: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.warmed_up and not any(phase in self.errors for phase in REQUIRED_PHASES)
+
+    async def run_phase(self, name: str, func: Callable, *args, in_thread: bool = False) -> bool:
+        """Chạy một bước (hàm async, hoặc hàm đồng bộ trong thread), ghi lại thời gian và lỗi."""
+        started = time.perf_counter()
+        try:
+            if in_thread:
+                result = await asyncio.to_thread(func, *args)
+            else:
+                result = await func(*args)
+            if result is False:
+                raise TimeoutError("chưa xong khi hết thời gian chờ")
+        except Exception as e:
+            self.errors[name] = str(e) or type(e).__name__
+            print(f"Bước khởi động {name} lỗi: {self.errors[name]}")
+            return False
+        finally:
+            self.phases[name] = time.perf_counter() - started
+        return True
+
+    async def warm_up(self):
+        """Chạy các bước làm nóng; Firebase và Gemini chạy song song (phần chờ mạng chồng lên nhau)."""
+        import firebase
+        import gemini
+
+        async def warm_firebase():
+            if await self.run_phase(PHASE_FIREBASE, firebase._initialize_firebase, in_thread=True):
+                await self.run_phase(PHASE_FIREBASE_CERTS, firebase.prefetch_public_certs, in_thread=True)
+
+        async def warm_gemini():
+            if await self.run_phase(PHASE_GEMINI_SDK, gemini.get_client, in_thread=True):
+                gemini.gemini_pool.start()
+                await self.run_phase(PHASE_GEMINI_POOL, gemini.gemini_pool.wait_ready, STARTUP_GEMINI_TIMEOUT)
+
+        await asyncio.gather(warm_firebase(), warm_gemini())
+        self.warmed_up = True
+        self.ready_after = time.perf_counter() - PROCESS_STARTED
+        breakdown = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.phases.items())
+        status = "sẵn sàng" if self.ready else "KHÔNG sẵn sàng"
+        print(f"Khởi động xong sau {self.ready_after:.3f}s ({status}): {breakdown}")
+
+    def to_dict(self) -> dict:
+        return {
+            "ready": self.ready,
+            "ready_after": round(self.ready_after, 3) if self.ready_after is not None else None,
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            "errors": self.errors,
+        }
+
+
+# Singleton instance
+startup = StartupState()
+
+metrics.gauge_callback(
+    "startup_phase_seconds", "Thời gian từng bước khởi động của worker",
+    lambda: {(name,): seconds for name, seconds in startup.phases.items()}, ["phase"])
+metrics.gauge_callback("ready", "Worker đã sẵn sàng nhận yêu cầu (1) hay chưa (0)",
+                       lambda: 1.0 if startup.ready else 0.0)
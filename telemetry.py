@@ -0,0 +1,108 @@
+import asyncio
+import os
+import time
+from typing import Dict, Optional, Union
+from outbound import OutboundQueue
+
+# Phát lại (fan-out) mọi frame robot gửi lên cho nhiều người quan sát chỉ đọc
+# (dashboard, logger) bên cạnh client điều khiển duy nhất.
+# Frame thô từ robot được gửi nguyên vẹn, không phân tích/serialize lại cho từng subscriber.
+# Subscriber chỉ nhận frame của robot kết nối cùng worker.
+
+TELEMETRY_MAX_RATE = float(os.getenv("TELEMETRY_MAX_RATE", "10"))  # frame/giây mỗi subscriber
+TELEMETRY_QUEUE_SIZE = int(os.getenv("TELEMETRY_QUEUE_SIZE", "32"))
+
+_COALESCE_KEY = "telemetry"
+
+
+class Subscription:
+    """
+    Một subscriber của robot. Giới hạn tốc độ theo max_rate (trong khoảng (0, TELEMETRY_MAX_RATE]):
+    frame đến quá sớm được giữ lại (chỉ bản mới nhất) và gửi khi hết khoảng thời gian tối thiểu.
+    """
+    def __init__(self, queue: OutboundQueue, max_rate: float = TELEMETRY_MAX_RATE):
+        if not max_rate > 0:
+            raise ValueError("max_rate phải lớn hơn 0")
+        self.queue = queue
+        self.min_interval = 1.0 / min(max_rate, TELEMETRY_MAX_RATE)
+        self._last_sent = 0.0
+        self._pending: Optional[Union[str, bytes]] = None
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self.delivered = 0
+        self.downsampled = 0
+
+    def offer(self, frame: Union[str, bytes]):
+        now = time.monotonic()
+        wait = self._last_sent + self.min_interval - now
+        if wait <= 0 and self._flush_handle is None:
+            self._deliver(frame, now)
+            return
+        if self._pending is not None:
+            self.downsampled += 1
+        self._pending = frame
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(max(wait, 0), self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        frame, self._pending = self._pending, None
+        if frame is not None:
+            self._deliver(frame, time.monotonic())
+
+    def _deliver(self, frame: Union[str, bytes], now: float):
+        self._last_sent = now
+        self.delivered += 1
+        # Subscriber chậm chỉ cần frame mới nhất
+        if isinstance(frame, str):
+            self.queue.enqueue_text(frame, coalesce_key=_COALESCE_KEY)
+        else:
+            self.queue.enqueue_bytes(frame, coalesce_key=_COALESCE_KEY)
+
+    def cancel(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._pending = None
+
+
+class TelemetryHub:
+    def __init__(self):
+        self._subscribers: Dict[str, Dict[OutboundQueue, Subscription]] = {}
+        self.published = 0
+
+    def subscribe(self, robot_id: str, queue: OutboundQueue, max_rate: float = TELEMETRY_MAX_RATE) -> Subscription:
+        subscription = Subscription(queue, max_rate)
+        self._subscribers.setdefault(robot_id, {})[queue] = subscription
+        return subscription
+
+    def unsubscribe(self, robot_id: str, queue: OutboundQueue):
+        subscribers = self._subscribers.get(robot_id)
+        if not subscribers:
+            return
+        subscription = subscribers.pop(queue, None)
+        if subscription:
+            subscription.cancel()
+        if not subscribers:
+            self._subscribers.pop(robot_id, None)
+
+    def has_subscribers(self, robot_id: str) -> bool:
+        return robot_id in self._subscribers
+
+    def publish(self, robot_id: str, frame: Union[str, bytes]) -> int:
+        """Gửi frame thô của robot cho mọi subscriber, trả về số subscriber."""
+        subscribers = self._subscribers.get(robot_id)
+        if not subscribers:
+            return 0
+        self.published += 1
+        for subscription in list(subscribers.values()):
+            subscription.offer(frame)
+        return len(subscribers)
+
+    def subscriber_count(self, robot_id: Optional[str] = None) -> int:
+        if robot_id is not None:
+            return len(self._subscribers.get(robot_id, ()))
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+# Singleton instance
+telemetry_hub = TelemetryHub()
@@ -0,0 +1,137 @@
+import math
+import os
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# Lịch sử telemetry của từng robot trong ring buffer dung lượng cố định.
+# Mỗi trường là một cột array kiểu số (không tạo object Python cho từng mẫu),
+# nên bộ nhớ mỗi robot = capacity * (8 + 4 * số trường) byte, biết trước.
+# Timestamp lưu theo time.monotonic() để luôn không giảm kể cả khi NTP chỉnh
+# đồng hồ hệ thống lùi lại; chỉ đổi sang epoch khi nhận truy vấn và trả kết quả.
+
+TELEMETRY_HISTORY_SIZE = int(os.getenv("TELEMETRY_HISTORY_SIZE", "3600"))
+TELEMETRY_MAX_ROBOTS = int(os.getenv("TELEMETRY_MAX_ROBOTS", "1000"))
+TELEMETRY_MAX_POINTS = 2000
+
+# Các trường số được lưu, thứ tự cũng là thứ tự trong frame TELEMETRY nhị phân
+TELEMETRY_FIELDS = ("x", "y", "heading", "battery", "speed")
+
+_NAN = float("nan")
+
+
+class TelemetryRingBuffer:
+    def __init__(self, capacity: int = TELEMETRY_HISTORY_SIZE):
+        self.capacity = capacity
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.columns: Dict[str, array] = {field: array("f", [_NAN]) * capacity for field in TELEMETRY_FIELDS}
+        self._head = 0   # vị trí ghi tiếp theo
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def nbytes(self) -> int:
+        return self.timestamps.itemsize * self.capacity + \
+            sum(column.itemsize * self.capacity for column in self.columns.values())
+
+    def append(self, timestamp: float, values: Dict[str, float]):
+        """Ghi một mẫu, O(1). Trường thiếu được lưu là NaN; timestamp (monotonic) phải không giảm."""
+        idx = self._head
+        self.timestamps[idx] = timestamp
+        for field, column in self.columns.items():
+            value = values.get(field)
+            column[idx] = _NAN if value is None else value
+        self._head = (idx + 1) % self.capacity
+        if self._size < self.capacity:
+            self._size += 1
+
+    def _physical(self, i: int) -> int:
+        """Chuyển chỉ số logic (0 = mẫu cũ nhất) sang vị trí trong mảng."""
+        return (self._head - self._size + i) % self.capacity
+
+    def _bisect(self, timestamp: float) -> int:
+        """Chỉ số logic đầu tiên có timestamp (monotonic) >= timestamp."""
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamps[self._physical(mid)] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, start: float, end: float, points: int) -> dict:
+        """
+        Lấy các mẫu trong [start, end] (epoch giây), gộp thành tối đa `points` điểm.
+        Mỗi điểm gồm timestamp trung bình (epoch giây) và min/max/mean của từng trường (bỏ qua NaN).
+        """
+        # Độ lệch giữa đồng hồ hệ thống và monotonic tại thời điểm truy vấn
+        offset = time.time() - time.monotonic()
+        lo = self._bisect(start - offset)
+        hi = self._bisect(math.nextafter(end - offset, math.inf))
+        count = hi - lo
+        points = max(1, min(points, TELEMETRY_MAX_POINTS))
+        buckets = min(points, count)
+
+        result: dict = {"count": count, "t": [], **{field: {"min": [], "max": [], "mean": []} for field in TELEMETRY_FIELDS}}
+        for b in range(buckets):
+            b_lo = lo + count * b // buckets
+            b_hi = lo + count * (b + 1) // buckets
+            indices = [self._physical(i) for i in range(b_lo, b_hi)]
+            result["t"].append(sum(self.timestamps[i] for i in indices) / len(indices) + offset)
+            for field, column in self.columns.items():
+                values = [column[i] for i in indices if column[i] == column[i]]  # bỏ NaN
+                stats = result[field]
+                if values:
+                    stats["min"].append(min(values))
+                    stats["max"].append(max(values))
+                    stats["mean"].append(sum(values) / len(values))
+                else:
+                    stats["min"].append(None)
+                    stats["max"].append(None)
+                    stats["mean"].append(None)
+        return result
+
+
+class TelemetryStore:
+    """Ring buffer theo robot_id; giữ tối đa TELEMETRY_MAX_ROBOTS robot, bỏ robot lâu không cập nhật nhất."""
+    def __init__(self, capacity: int = TELEMETRY_HISTORY_SIZE, max_robots: int = TELEMETRY_MAX_ROBOTS):
+        self.capacity = capacity
+        self.max_robots = max_robots
+        self._buffers: "OrderedDict[str, TelemetryRingBuffer]" = OrderedDict()
+
+    def record(self, robot_id: str, values: Dict[str, float], timestamp: Optional[float] = None):
+        """Ghi một mẫu cho robot; timestamp theo time.monotonic(), mặc định là hiện tại."""
+        buffer = self._buffers.get(robot_id)
+        if buffer is None:
+            buffer = self._buffers[robot_id] = TelemetryRingBuffer(self.capacity)
+            while len(self._buffers) > self.max_robots:
+                self._buffers.popitem(last=False)
+        else:
+            self._buffers.move_to_end(robot_id)
+        buffer.append(time.monotonic() if timestamp is None else timestamp, values)
+
+    def record_fields(self, robot_id: str, data: dict):
+        """Lấy các trường số đã biết từ frame telemetry JSON và ghi lại."""
+        values = {}
+        for field in TELEMETRY_FIELDS:
+            value = data.get(field)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                values[field] = value
+        self.record(robot_id, values)
+
+    def get(self, robot_id: str) -> Optional[TelemetryRingBuffer]:
+        return self._buffers.get(robot_id)
+
+    def memory_bytes(self) -> int:
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+    def robot_ids(self) -> List[str]:
+        return list(self._buffers.keys())
+
+
+# Singleton instance
+telemetry_store = TelemetryStore()
@@ -0,0 +1,166 @@
+import asyncio
+import os
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, Optional
+import gemini
+from async_utils import cancel_and_wait
+from gemini_guard import (gemini_breaker, GEMINI_REQUESTS, GEMINI_TURN_TIMEOUT,
+                          CircuitOpenError, GeminiTimeout)
+from metrics import metrics
+from rate_limit import gemini_admission, RateLimited
+
+# Câu lệnh giọng nói: client gửi các frame audio nhị phân qua client_ws, server chuyển
+# ngay từng frame vào phiên Gemini Live (send_realtime_input) trong lúc người dùng còn nói,
+# nên khi client báo hết câu ({"type": "audio_end"}) model gần như đã nghe xong.
+# - Audio được chuyển nguyên dạng kèm mime type client khai báo (PCM 16-bit hoặc Opus), không chuyển mã
+# - Bộ đệm giữa WebSocket và Gemini có giới hạn: client gửi nhanh hơn tốc độ chuyển thì câu lệnh bị hủy.
+#   Câu lệnh chưa bắt đầu gửi (còn chờ câu lệnh trước có kết quả) được đệm đến VOICE_MAX_BYTES
+# - Mỗi câu lệnh giọng nói là một lượt Gemini: qua circuit breaker và gemini_admission như câu lệnh chữ
+
+VOICE_AUDIO_MIME = os.getenv("VOICE_AUDIO_MIME", "audio/pcm;rate=16000")
+# Số byte audio tối đa chờ chuyển vào Gemini (mặc định ~2 giây PCM 16 kHz)
+VOICE_BUFFER_BYTES = int(os.getenv("VOICE_BUFFER_BYTES", "64000"))
+# Độ dài tối đa một câu lệnh giọng nói (mặc định ~30 giây PCM 16 kHz) và thời gian nói tối đa
+VOICE_MAX_BYTES = int(os.getenv("VOICE_MAX_BYTES", "960000"))
+VOICE_MAX_SECONDS = float(os.getenv("VOICE_MAX_SECONDS", "30"))
+# Chu kỳ kiểm tra lại hạn chót (hạn chót rút ngắn lại khi client báo hết câu)
+VOICE_DEADLINE_CHECK = 0.5
+
+VOICE_END_TO_ACTION_SECONDS = metrics.histogram(
+    "voice_end_to_action_seconds",
+    "Thời gian từ lúc client báo hết câu lệnh giọng nói đến khi có action đầu tiên (0 nếu có trước)")
+VOICE_TURNS = metrics.counter(
+    "voice_turns_total", "Số câu lệnh giọng nói theo kết quả (ok, empty, aborted, error, failed)", ["outcome"])
+
+_END = None
+
+
+class VoiceRejected(ValueError):
+    """Frame audio bị từ chối (câu lệnh quá dài hoặc bộ đệm đầy); câu lệnh giọng nói bị hủy."""
+
+
+class VoiceTurn:
+    """Một câu lệnh giọng nói đang được chuyển vào phiên Gemini Live."""
+    def __init__(self, mime_type: str = VOICE_AUDIO_MIME):
+        self.session: Optional["gemini.GeminiLiveClient"] = None
+        self.mime_type = mime_type
+        self.started_at = time.perf_counter()
+        self.ended_at: Optional[float] = None
+        self.bytes_received = 0
+        self._buffered = 0
+        # Số byte được phép chờ gửi: tới VOICE_MAX_BYTES khi chưa bắt đầu gửi, sau đó phần tồn đọng
+        # lúc bắt đầu gửi cộng VOICE_BUFFER_BYTES (giảm dần khi phần tồn đọng đã được gửi)
+        self._buffer_limit = VOICE_MAX_BYTES
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    @property
+    def ended(self) -> bool:
+        return self.ended_at is not None
+
+    def feed(self, chunk: bytes):
+        """Đưa một frame audio vào bộ đệm chờ gửi. Raise VoiceRejected nếu vượt giới hạn."""
+        if self.ended:
+            raise VoiceRejected("Câu lệnh giọng nói đã kết thúc")
+        self.bytes_received += len(chunk)
+        if self.bytes_received > VOICE_MAX_BYTES:
+            raise VoiceRejected("Câu lệnh giọng nói quá dài")
+        if self._buffered + len(chunk) > self._buffer_limit:
+            raise VoiceRejected("Audio gửi nhanh hơn tốc độ chuyển tới Gemini")
+        self._buffered += len(chunk)
+        self._queue.put_nowait(chunk)
+
+    def end(self):
+        """Client báo hết câu: gửi audio_stream_end sau các frame còn trong bộ đệm."""
+        if not self.ended:
+            self.ended_at = time.perf_counter()
+            self._queue.put_nowait(_END)
+
+    def deadline(self) -> float:
+        if self.ended:
+            return self.ended_at + GEMINI_TURN_TIMEOUT
+        return self.started_at + VOICE_MAX_SECONDS + GEMINI_TURN_TIMEOUT
+
+    async def _send_loop(self):
+        while True:
+            chunk = await self._queue.get()
+            if chunk is _END:
+                await self.session.end_audio()
+                return
+            self._buffered -= len(chunk)
+            await self.session.send_audio(chunk, self.mime_type)
+            self._buffer_limit = max(VOICE_BUFFER_BYTES, self._buffer_limit - len(chunk))
+
+    async def actions(self, session: "gemini.GeminiLiveClient") -> AsyncIterator[dict]:
+        """
+        Gửi audio vào session và trả về từng action ngay khi model phân tích xong.
+        Raise CircuitOpenError/GeminiTimeout, RateLimited hoặc ConnectionError như guarded_stream.
+        Phiên Live bị bỏ giữa lượt sẽ bị đóng để client đổi phiên mới.
+        """
+        if not gemini_breaker.allow():
+            GEMINI_REQUESTS.inc("rejected")
+            raise CircuitOpenError("Gemini tạm thời không khả dụng")
+        try:
+            await gemini_admission.acquire()
+        except (RateLimited, asyncio.CancelledError):
+            gemini_breaker.record_abandoned()
+            raise
+
+        finished = False
+        count = 0
+        sender: Optional[asyncio.Future] = None
+        try:
+            self.session = session
+            await session.start_audio()
+            self._buffer_limit = self._buffered + VOICE_BUFFER_BYTES
+            sender = asyncio.ensure_future(self._send_loop())
+            async with aclosing(session.audio_actions()) as stream:
+                while True:
+                    next_action = asyncio.ensure_future(stream.__anext__())
+                    try:
+                        while not next_action.done():
+                            remaining = self.deadline() - time.perf_counter()
+                            if remaining <= 0:
+                                raise GeminiTimeout(f"Gemini không trả lời trong {GEMINI_TURN_TIMEOUT:g} giây")
+                            waiting = {next_action} if sender.done() else {next_action, sender}
+                            await asyncio.wait(waiting, timeout=min(remaining, VOICE_DEADLINE_CHECK),
+                                               return_when=asyncio.FIRST_COMPLETED)
+                            if sender.done() and sender.exception() is not None:
+                                raise sender.exception()
+                    finally:
+                        await cancel_and_wait(next_action)
+                    try:
+                        action = next_action.result()
+                    except StopAsyncIteration:
+                        break
+                    if count == 0:
+                        VOICE_END_TO_ACTION_SECONDS.observe(
+                            time.perf_counter() - self.ended_at if self.ended else 0.0)
+                    count += 1
+                    yield action
+            finished = True
+            VOICE_TURNS.inc("ok" if count else "empty")
+            GEMINI_REQUESTS.inc("ok")
+            gemini_breaker.record_success()
+        except GeminiTimeout:
+            GEMINI_REQUESTS.inc("timeout")
+            VOICE_TURNS.inc("error")
+            gemini_breaker.record_failure()
+            raise
+        except (asyncio.CancelledError, GeneratorExit):
+            if not finished:
+                VOICE_TURNS.inc("aborted")
+                gemini_breaker.record_abandoned()
+            raise
+        except Exception:
+            if not finished:
+                GEMINI_REQUESTS.inc("error")
+                VOICE_TURNS.inc("error")
+                gemini_breaker.record_failure()
+            raise
+        finally:
+            gemini_admission.release()
+            await cancel_and_wait(sender)
+            if not finished:
+                # Phiên Live còn audio hoặc câu trả lời của lượt bị bỏ dở
+                await session.disconnect()
@@ -0,0 +1,184 @@
+import struct
+from typing import List, NamedTuple, Optional
+
+# Giao thức nhị phân gọn cho robot (tùy chọn, JSON vẫn là mặc định).
+# Robot chọn giao thức khi kết nối bằng subprotocol "robot-bin.v1" hoặc query param ?proto=bin.
+#
+# Mọi frame bắt đầu bằng header 8 byte (little-endian):
+#   version: uint8 | frame_type: uint8 | payload_len: uint16 | seq: uint32
+#
+# Payload theo frame_type:
+#   ACTION (server -> robot): intent: uint8 | unit: uint8 | value: float32
+#   FLUSH  (server -> robot): rỗng, robot xóa hàng đợi action cục bộ
+#   HELLO  (server -> robot): window: uint8
+#   ACK    (robot -> server): seq là ack tích lũy, payload là message UTF-8 (có thể rỗng)
+#   SACK   (robot -> server): danh sách seq uint32 đã hoàn thành, seq trong header = 0
+#   TELEMETRY (robot -> server): x, y, heading, battery, speed: float32 (NaN nếu không có)
+#   PING   (server -> robot): rỗng, seq là mã ping
+#   PONG   (robot -> server): rỗng, seq lặp lại mã ping đã nhận
+
+WIRE_VERSION = 1
+BINARY_SUBPROTOCOL = "robot-bin.v1"
+WIRE_JSON = "json"
+WIRE_BINARY = "bin"
+
+FRAME_ACTION = 1
+FRAME_FLUSH = 2
+FRAME_HELLO = 3
+FRAME_ACK = 4
+FRAME_SACK = 5
+FRAME_TELEMETRY = 6
+FRAME_PING = 7
+FRAME_PONG = 8
+
+INTENT_CODES = {
+    "tien": 1,
+    "lui": 2,
+    "re_trai": 3,
+    "re_phai": 4,
+    "dung_lai": 5,
+    "nang": 6,
+    "ha": 7,
+}
+INTENT_NAMES = {code: name for name, code in INTENT_CODES.items()}
+
+UNIT_NONE = 0
+UNIT_CODES = {"m": 1, "deg": 2}
+UNIT_NAMES = {code: name for name, code in UNIT_CODES.items()}
+# Tham số số duy nhất ứng với mỗi đơn vị
+_UNIT_PARAM = {"m": "distance", "deg": "angle"}
+
+_HEADER = struct.Struct("<BBHI")
+_ACTION_PAYLOAD = struct.Struct("<BBf")
+_HELLO_PAYLOAD = struct.Struct("<B")
+_SEQ = struct.Struct("<I")
+_TELEMETRY_PAYLOAD = struct.Struct("<5f")
+
+HEADER_SIZE = _HEADER.size
+
+
+class WireError(ValueError):
+    """Frame nhị phân không hợp lệ hoặc action không biểu diễn được bằng giao thức nhị phân."""
+
+
+class RobotFrame(NamedTuple):
+    frame_type: int
+    seq: int
+    sack: List[int]
+    message: str
+    telemetry: tuple = ()
+
+
+def negotiate_wire_format(subprotocols: List[str], proto: Optional[str]) -> str:
+    """Chọn giao thức theo subprotocol hoặc query param, mặc định JSON."""
+    if BINARY_SUBPROTOCOL in subprotocols or proto == WIRE_BINARY:
+        return WIRE_BINARY
+    return WIRE_JSON
+
+
+def encode_action(action) -> bytes:
+    intent = INTENT_CODES.get(action.intent)
+    if intent is None:
+        raise WireError(f"Intent không hỗ trợ trong giao thức nhị phân: {action.intent}")
+
+    params = action.params or {}
+    unit_name = params.get("unit")
+    if unit_name is None:
+        if params:
+            raise WireError(f"Tham số không hỗ trợ trong giao thức nhị phân: {params}")
+        unit, value = UNIT_NONE, 0.0
+    else:
+        unit = UNIT_CODES.get(unit_name)
+        param = _UNIT_PARAM.get(unit_name)
+        if unit is None or param not in params or len(params) != 2:
+            raise WireError(f"Tham số không hỗ trợ trong giao thức nhị phân: {params}")
+        value = float(params[param])
+
+    return _HEADER.pack(WIRE_VERSION, FRAME_ACTION, _ACTION_PAYLOAD.size, action.seq) + \
+        _ACTION_PAYLOAD.pack(intent, unit, value)
+
+
+def encode_flush() -> bytes:
+    return _HEADER.pack(WIRE_VERSION, FRAME_FLUSH, 0, 0)
+
+
+def encode_hello(window: int) -> bytes:
+    return _HEADER.pack(WIRE_VERSION, FRAME_HELLO, _HELLO_PAYLOAD.size, 0) + _HELLO_PAYLOAD.pack(window)
+
+
+def encode_ack(seq: int, message: str = "") -> bytes:
+    payload = message.encode("utf-8")
+    return _HEADER.pack(WIRE_VERSION, FRAME_ACK, len(payload), seq) + payload
+
+
+def encode_sack(seqs: List[int]) -> bytes:
+    payload = b"".join(_SEQ.pack(seq) for seq in seqs)
+    return _HEADER.pack(WIRE_VERSION, FRAME_SACK, len(payload), 0) + payload
+
+
+def encode_telemetry(x: float, y: float, heading: float, battery: float, speed: float) -> bytes:
+    return _HEADER.pack(WIRE_VERSION, FRAME_TELEMETRY, _TELEMETRY_PAYLOAD.size, 0) + \
+        _TELEMETRY_PAYLOAD.pack(x, y, heading, battery, speed)
+
+
+def encode_ping(ping_id: int) -> bytes:
+    return _HEADER.pack(WIRE_VERSION, FRAME_PING, 0, ping_id)
+
+
+def encode_pong(ping_id: int) -> bytes:
+    return _HEADER.pack(WIRE_VERSION, FRAME_PONG, 0, ping_id)
+
+
+def is_telemetry_frame(data: bytes) -> bool:
+    return len(data) > 1 and data[1] == FRAME_TELEMETRY
+
+
+def is_pong_frame(data: bytes) -> bool:
+    return len(data) > 1 and data[1] == FRAME_PONG
+
+
+def _decode_header(data: bytes):
+    if len(data) < HEADER_SIZE:
+        raise WireError(f"Frame quá ngắn: {len(data)} byte")
+    version, frame_type, length, seq = _HEADER.unpack_from(data)
+    if version != WIRE_VERSION:
+        raise WireError(f"Phiên bản giao thức không hỗ trợ: {version}")
+    if len(data) != HEADER_SIZE + length:
+        raise WireError(f"Độ dài payload không khớp: {len(data) - HEADER_SIZE} != {length}")
+    return frame_type, seq, memoryview(data)[HEADER_SIZE:]
+
+
+def decode_robot_frame(data: bytes) -> RobotFrame:
+    """Giải mã frame ACK/SACK/TELEMETRY/PONG từ robot."""
+    frame_type, seq, payload = _decode_header(data)
+    if frame_type == FRAME_ACK:
+        return RobotFrame(frame_type, seq, [], bytes(payload).decode("utf-8", errors="replace"))
+    if frame_type == FRAME_SACK:
+        if len(payload) % _SEQ.size:
+            raise WireError("Payload SACK không phải bội số của 4 byte")
+        return RobotFrame(frame_type, seq, [s for (s,) in _SEQ.iter_unpack(payload)], "")
+    if frame_type == FRAME_TELEMETRY:
+        if len(payload) != _TELEMETRY_PAYLOAD.size:
+            raise WireError("Payload TELEMETRY không hợp lệ")
+        return RobotFrame(frame_type, seq, [], "", _TELEMETRY_PAYLOAD.unpack(payload))
+    if frame_type == FRAME_PONG:
+        return RobotFrame(frame_type, seq, [], "")
+    raise WireError(f"Loại frame không hợp lệ từ robot: {frame_type}")
+
+
+def decode_action(data: bytes) -> dict:
+    """Giải mã frame ACTION thành dict dạng Action.to_dict() (không có action_id)."""
+    frame_type, seq, payload = _decode_header(data)
+    if frame_type != FRAME_ACTION:
+        raise WireError(f"Không phải frame ACTION: {frame_type}")
+    intent, unit, value = _ACTION_PAYLOAD.unpack(payload)
+    if intent not in INTENT_NAMES:
+        raise WireError(f"Intent không hợp lệ: {intent}")
+    params = {}
+    if unit != UNIT_NONE:
+        unit_name = UNIT_NAMES.get(unit)
+        if unit_name is None:
+            raise WireError(f"Đơn vị không hợp lệ: {unit}")
+        value = int(value) if value.is_integer() else value
+        params = {_UNIT_PARAM[unit_name]: value, "unit": unit_name}
+    return {"seq": seq, "intent": INTENT_NAMES[intent], "params": params}
@@ -1,114 +1,674 @@
+import asyncio
+import time
 import uuid
+from typing import Optional
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from connections import *
-from firebase import verify_firebase_token
+from firebase import verify_firebase_token_async
 import gemini
-import json
+import gemini_guard
+import codec
 from model import Action
-from pending_actions import pending_manager
+from pending_actions import pending_manager, clamp_window
+from plan_optimizer import optimize_plan
+from command_parser import local_parser
+from command_cache import command_cache
+from rate_limit import command_limiter, gemini_admission, RateLimited
+from voice import VoiceTurn, VoiceRejected, VOICE_AUDIO_MIME, VOICE_TURNS
+import wire
+from outbound import OutboundQueue, FRAME_BYTES, POLICY_DISCONNECT
+from metrics import metrics
+from telemetry import telemetry_hub, TELEMETRY_MAX_RATE, TELEMETRY_QUEUE_SIZE
+from telemetry_store import telemetry_store, TELEMETRY_FIELDS
+from liveness import liveness_monitor, HEARTBEAT_DEFAULT, CLOSE_HEARTBEAT_TIMEOUT
 
 router = APIRouter(prefix="/api/ws")
 
+# Chu kỳ kiểm tra lại kết nối feed fleet khi không có thay đổi
+FLEET_FEED_KEEPALIVE = 30.0
+# Mã đóng uvicorn dùng khi server tắt/khởi động lại (không phải client chủ động ngắt)
+CLOSE_SERVICE_RESTART = 1012
+
+# Robot có client đăng ký nhận tiến độ chuỗi hành động (client_ws ?progress=true)
+_progress_robots = set()
+
+COMMANDS_TOTAL = metrics.counter(
+    "commands_total", "Số câu lệnh client theo cách phân tích (json, local, gemini, voice)", ["source"])
+COMMAND_DISPATCH_SECONDS = metrics.histogram(
+    "command_dispatch_seconds", "Thời gian từ lúc nhận câu lệnh đến khi action đầu tiên được xếp gửi cho robot", ["source"])
+
+def _build_action(action_item: dict, step: int = 0) -> Action:
+    """step: chỉ số của action trong câu lệnh gốc, dùng để báo tiến độ sau khi gộp."""
+    return Action(
+        action_id=str(uuid.uuid4()),
+        intent=action_item["intent"],
+        params=action_item["params"],
+        steps=[step],
+    )
+
+async def _guarded_actions(get_session, msg: str):
+    """Lấy phiên Gemini (chỉ khi cache không có câu lệnh) rồi phân tích qua gemini_guard."""
+    session = await get_session()
+    async for action_item in gemini_guard.guarded_stream(session, msg):
+        yield action_item
+
+async def _stream_to_robot(robot_id: str, robot: WebSocket, msg: str, get_session, received_at: float) -> int:
+    """
+    Phân tích câu lệnh bằng Gemini (qua cache) và gửi action đầu tiên cho robot
+    ngay khi nhận được, các action sau được nối vào hàng đợi khi đến.
+    get_session: coroutine function trả về phiên Gemini, chỉ được gọi khi cache không có câu lệnh.
+    Trả về số action đã nhận.
+    """
+    await _cancel_robot_actions(robot_id, robot)
+    sequence_id = pending_manager.begin_action_sequence(robot_id)
+    count = 0
+    cancelled = False
+    try:
+        async for action_item in command_cache.stream(msg, lambda: _guarded_actions(get_session, msg)):
+            count += 1
+            if cancelled:
+                # Chuỗi đã bị hủy: vẫn nhận hết lượt để cache đủ kết quả, không nối thêm action
+                continue
+            new_action = _build_action(action_item, count - 1)
+            for action_to_send in pending_manager.append_actions(robot_id, sequence_id, [new_action], optimize=True):
+                if not await _send_action(robot_id, robot, action_to_send):
+                    cancelled = True
+                    break
+            if count == 1 and not cancelled:
+                COMMAND_DISPATCH_SECONDS.observe(time.perf_counter() - received_at, "gemini")
+    except ConnectionError as e:
+        # Robot đã bắt đầu thực hiện một phần chuỗi, không gửi lại từ đầu
+        if count == 0:
+            raise
+        print(f"Gemini ngắt kết nối giữa chừng, đã gửi {count} hành động: {e}")
+    return count
+
+async def _voice_to_robot(robot_id: str, robot: WebSocket, voice: VoiceTurn, get_session,
+                         client_out: OutboundQueue, previous: Optional[asyncio.Task] = None):
+    """
+    Gửi action của câu lệnh giọng nói cho robot ngay khi Gemini phân tích xong.
+    previous: câu lệnh giọng nói trước còn chờ kết quả; câu lệnh này chờ nó xong rồi mới dùng phiên Gemini
+    (audio đến trong lúc chờ được đệm trong voice).
+    Hàng đợi robot chỉ bị hủy khi có action đầu tiên, lỗi được báo cho client.
+    """
+    if previous is not None:
+        # wait() không hủy câu lệnh trước khi câu lệnh này bị hủy
+        await asyncio.wait({previous})
+    sequence_id = None
+    count = 0
+    cancelled = False
+    try:
+        async for action_item in voice.actions(await get_session()):
+            if cancelled:
+                continue
+            if sequence_id is None:
+                await _cancel_robot_actions(robot_id, robot)
+                sequence_id = pending_manager.begin_action_sequence(robot_id)
+            count += 1
+            new_action = _build_action(action_item, count - 1)
+            for action_to_send in pending_manager.append_actions(robot_id, sequence_id, [new_action], optimize=True):
+                if not await _send_action(robot_id, robot, action_to_send):
+                    cancelled = True
+                    break
+            if count == 1 and not cancelled:
+                COMMAND_DISPATCH_SECONDS.observe(time.perf_counter() - (voice.ended_at or voice.started_at), "voice")
+    except RateLimited as e:
+        await client_out.send_text(codec.dumps(e.to_message(robot_id)))
+        return
+    except ConnectionError as e:
+        if count == 0:
+            print(f"Gemini không khả dụng cho câu lệnh giọng nói: {e}")
+            await client_out.send_text(codec.dumps({
+                "error": f"{e}. Hiện chỉ hỗ trợ các câu lệnh đơn giản",
+                "robot_id": robot_id
+            }))
+            return
+        print(f"Gemini ngắt kết nối giữa chừng, đã gửi {count} hành động: {e}")
+    except Exception as e:
+        VOICE_TURNS.inc("failed")
+        print(f"Lỗi khi xử lý câu lệnh giọng nói cho robot {robot_id}: {e}")
+        await client_out.send_text(codec.dumps({
+            "error": f"Lỗi khi xử lý câu lệnh giọng nói: {e}",
+            "robot_id": robot_id
+        }))
+        return
+    print("Số hành động đã gửi từ câu lệnh giọng nói:", count)
+    if count == 0:
+        await client_out.send_text(codec.dumps({
+            "error": "Không phân tích được lệnh",
+            "robot_id": robot_id
+        }))
+
+async def _send_action(robot_id: str, robot: WebSocket, action: Action) -> bool:
+    """
+    Gửi action cho robot theo giao thức robot đã chọn (JSON hoặc nhị phân).
+    Trả về False nếu action không gửi được và chuỗi hành động đã bị hủy: bên gọi dừng gửi các action sau.
+    """
+    if get_robot_wire_format(robot_id) == wire.WIRE_BINARY:
+        try:
+            await robot.send_bytes(action.to_bytes(), control=True)
+        except wire.WireError as e:
+            # Action không biểu diễn được bằng frame nhị phân: hủy chuỗi và báo client
+            print(f"Không thể gửi action nhị phân cho robot {robot_id}: {e}")
+            await _cancel_robot_actions(robot_id, robot)
+            client = get_client(robot_id)
+            if client:
+                await client.send_text(codec.dumps({
+                    "error": f"Robot không hỗ trợ hành động: {e}",
+                    "robot_id": robot_id
+                }))
+            return False
+    else:
+        await robot.send_text(action.to_json(), control=True)
+    return True
+
+async def _cancel_robot_actions(robot_id: str, robot: WebSocket):
+    """Hủy chuỗi hành động hiện tại, báo robot xóa hàng đợi cục bộ nếu robot đang giữ action gửi trước."""
+    if pending_manager.cancel_robot_actions(robot_id) and robot:
+        if get_robot_wire_format(robot_id) == wire.WIRE_BINARY:
+            await robot.send_bytes(wire.encode_flush(), control=True)
+        else:
+            await robot.send_text(codec.dumps({"type": "flush"}), control=True)
+
 @router.websocket("/robot/{robot_id}")
-async def robot_ws(websocket: WebSocket, robot_id: str):
-    if not register_robot(robot_id, websocket):
+async def robot_ws(websocket: WebSocket, robot_id: str, window: int = 1, proto: str = wire.WIRE_JSON,
+                   heartbeat: bool = HEARTBEAT_DEFAULT):
+    # Robot chọn giao thức nhị phân qua subprotocol hoặc ?proto=bin, mặc định JSON
+    subprotocols = websocket.scope.get("subprotocols", [])
+    wire_format = wire.negotiate_wire_format(subprotocols, proto)
+    binary = wire_format == wire.WIRE_BINARY
+
+    # Firmware mới khai báo window > 1 qua query param, firmware cũ giữ window=1
+    window = clamp_window(window)
+    # Mọi tin gửi tới robot đi qua hàng đợi riêng, không chặn handler
+    robot_out = OutboundQueue(websocket, f"robot:{robot_id}")
+    if not await register_robot(robot_id, robot_out, wire_format, window):
         await websocket.close(code=1008, reason=f"Robot {robot_id} đã được kết nối")
+        await robot_out.aclose()
         return
-    await websocket.accept()
-    client = None 
+    await websocket.accept(subprotocol=wire.BINARY_SUBPROTOCOL if wire.BINARY_SUBPROTOCOL in subprotocols else None)
+    robot_out.start()
+    pending_manager.set_robot_window(robot_id, window)
+    if binary:
+        await robot_out.send_bytes(wire.encode_hello(window), control=True)
+    elif window > 1:
+        await robot_out.send_text(codec.dumps({"type": "hello", "window": window}), control=True)
+    # Robot kết nối lại khi chuỗi hành động chưa xong: gửi tiếp từ action chưa ack đầu tiên
+    for action in pending_manager.resume_robot(robot_id):
+        if not await _send_action(robot_id, robot_out, action):
+            break
+    if heartbeat:
+        # Firmware hỗ trợ heartbeat: ping định kỳ, loại robot nếu im lặng quá lâu
+        liveness_monitor.register(
+            robot_id,
+            lambda ping_id: _send_ping(robot_out, binary, ping_id),
+            lambda: _expire_robot(robot_id, robot_out),
+        )
     try:
         while True:
-            msg = await websocket.receive_text()
-            try:
-                message_data = json.loads(msg)
-                action_id = message_data.get("action_id", "")
-                response_message = str(message_data.get("message", ""))
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000), frame.get("reason"))
+            # Bất kỳ frame nào cũng chứng tỏ robot còn sống
+            liveness_monitor.touch(robot_id)
+            payload = frame["text"] if frame.get("text") is not None else frame["bytes"]
+            FRAME_BYTES.observe(len(payload), "in", "robot")
+            if _handle_pong(robot_id, payload):
+                continue
+            # Mọi frame của robot được phát cho các subscriber chỉ đọc
+            telemetry_hub.publish(robot_id, payload)
+            # Telemetry được lưu vào lịch sử ở worker của robot, không phải ack
+            if _record_telemetry(robot_id, payload):
+                continue
+            # Frame được xử lý ở worker đang giữ client điều khiển (có thể là worker khác)
+            await registry.forward_robot_frame(robot_id, frame)
+
+    except WebSocketDisconnect:
+        # Robot có thể đã bị loại do heartbeat và kết nối lại bằng socket mới
+        if get_robot(robot_id) is robot_out:
+            liveness_monitor.unregister(robot_id)
+            client = get_client(robot_id)
+            if client:
+                await client.send_text(f"Robot {robot_id} disconnected")
+            # Giữ chuỗi đang dở (nếu có journal) để gửi tiếp khi robot kết nối lại
+            pending_manager.suspend_robot(robot_id)
+            await unregister_robot(robot_id) # Thay đổi này
+    finally:
+        await robot_out.aclose()
+
+def _send_ping(robot_out: OutboundQueue, binary: bool, ping_id: int):
+    if binary:
+        robot_out.enqueue_bytes(wire.encode_ping(ping_id), control=True)
+    else:
+        robot_out.enqueue_text(codec.dumps({"type": "ping", "id": ping_id}), control=True)
 
-                if not pending_manager.has_pending_actions(robot_id): continue
+async def _expire_robot(robot_id: str, robot_out: OutboundQueue):
+    """Loại robot không trả lời heartbeat: hủy các action đang chờ và giải phóng robot_id."""
+    if get_robot(robot_id) is not robot_out:
+        return
+    client = get_client(robot_id)
+    if client:
+        await client.send_text(f"Robot {robot_id} disconnected")
+    pending_manager.suspend_robot(robot_id)
+    await unregister_robot(robot_id)
+    await robot_out.close(CLOSE_HEARTBEAT_TIMEOUT)
 
-                next_action = pending_manager.process_robot_completion(robot_id, action_id)
+def _handle_pong(robot_id: str, payload) -> bool:
+    """Cập nhật RTT khi nhận pong. Trả về False nếu không phải pong."""
+    try:
+        if isinstance(payload, str):
+            if '"pong"' not in payload:
+                return False
+            data = codec.loads(payload)
+            if not isinstance(data, dict) or data.get("type") != "pong":
+                return False
+            liveness_monitor.pong(robot_id, int(data.get("id", 0)))
+            return True
+        if not wire.is_pong_frame(payload):
+            return False
+        liveness_monitor.pong(robot_id, wire.decode_robot_frame(payload).seq)
+        return True
+    except (ValueError, TypeError, wire.WireError) as e:
+        print(f"Pong không hợp lệ từ robot {robot_id}: {e}")
+        return True
 
+def _record_telemetry(robot_id: str, payload) -> bool:
+    """Lưu frame telemetry vào ring buffer. Trả về False nếu không phải telemetry."""
+    try:
+        if isinstance(payload, str):
+            # Kiểm tra chuỗi trước để không phải giải mã JSON mọi frame
+            if '"telemetry"' not in payload:
+                return False
+            data = codec.loads(payload)
+            if not isinstance(data, dict) or data.get("type") != "telemetry":
+                return False
+            telemetry_store.record_fields(robot_id, data)
+            return True
+        if not wire.is_telemetry_frame(payload):
+            return False
+        values = wire.decode_robot_frame(payload).telemetry
+        telemetry_store.record(robot_id, dict(zip(TELEMETRY_FIELDS, values)))
+        return True
+    except (ValueError, wire.WireError) as e:
+        print(f"Telemetry không hợp lệ từ robot {robot_id}: {e}")
+        return True
+
+async def _handle_robot_frame(robot_id: str, frame: dict):
+    """Xử lý ack/tin nhắn từ robot: chuyển message cho client và gửi các action tiếp theo."""
+    robot = get_robot(robot_id)
+    binary = frame.get("bytes") is not None
+    try:
+        action_id = ""
+        ack_seq = None
+        sack = None
+        coalesce_key = None
+        if binary:
+            # Ack nhị phân: không cần giải mã JSON
+            robot_frame = wire.decode_robot_frame(frame["bytes"])
+            if robot_frame.frame_type == wire.FRAME_ACK:
+                ack_seq = robot_frame.seq
+            else:
+                sack = robot_frame.sack
+            response_message = robot_frame.message
+        else:
+            message_data = codec.loads(frame["text"])
+            action_id = message_data.get("action_id", "")
+            ack_seq = message_data.get("ack_seq")
+            sack = message_data.get("sack")
+            response_message = str(message_data.get("message", ""))
+            # Client chậm chỉ cần nhận trạng thái mới nhất của robot
+            if message_data.get("type") == "status":
+                coalesce_key = "status"
+
+        if not pending_manager.has_pending_actions(robot_id):
+            if coalesce_key is not None:
+                # Trạng thái robot vẫn được chuyển cho client khi không có chuỗi hành động nào
                 client = get_client(robot_id)
                 if client:
-                    await client.send_text(response_message)
-
-                if next_action:
-                    await websocket.send_text(json.dumps(next_action.to_dict()))
+                    await client.send_text(response_message, coalesce_key=coalesce_key)
+            return
 
-            except Exception as e:
-                await websocket.send_text(f"Lỗi khi xử lý tin nhắn từ robot {robot_id}: {e}")
+        next_actions = pending_manager.process_robot_completion(robot_id, action_id, ack_seq, sack)
 
-    except WebSocketDisconnect:
+        client = get_client(robot_id)
         if client:
-            await client.send_text(f"Robot {robot_id} disconnected")
-        pending_manager.cancel_robot_actions(robot_id)
-        await unregister_robot(robot_id) # Thay đổi này
+            await client.send_text(response_message, coalesce_key=coalesce_key)
+            progress = pending_manager.get_progress(robot_id) if robot_id in _progress_robots else None
+            if progress:
+                await client.send_text(codec.dumps({"type": "progress", "robot_id": robot_id, **progress}),
+                                       coalesce_key="progress")
+
+        for next_action in next_actions:
+            if not await _send_action(robot_id, robot, next_action):
+                break
+
+    except Exception as e:
+        if binary or robot is None:
+            print(f"Lỗi khi xử lý tin nhắn từ robot {robot_id}: {e}")
+        else:
+            await robot.send_text(f"Lỗi khi xử lý tin nhắn từ robot {robot_id}: {e}")
+
+registry.set_robot_frame_handler(_handle_robot_frame)
 
 @router.websocket("/client/{robot_id}")
-async def client_ws(websocket: WebSocket, robot_id: str, token: str):
-    token_result = verify_firebase_token(token)
+async def client_ws(websocket: WebSocket, robot_id: str, token: str, progress: bool = False,
+                    audio_mime: str = VOICE_AUDIO_MIME):
+    """
+    Câu lệnh dạng chữ (text frame) hoặc giọng nói: các frame nhị phân là audio (`audio_mime`)
+    được chuyển ngay vào Gemini Live, kết thúc câu lệnh bằng {"type": "audio_end"}.
+    Frame nhị phân sau audio_end bắt đầu câu lệnh giọng nói mới (xếp sau câu lệnh trước nếu còn chờ Gemini).
+    """
+    token_result = await verify_firebase_token_async(token)
     if not token_result['success']:
         await websocket.close(code=1008, reason=f"Invalid token: {token_result.get('error', 'Unknown error')}")
         return
     
-    if not register_client(robot_id, websocket):
+    client_out = OutboundQueue(websocket, f"client:{robot_id}")
+    if not await register_client(robot_id, client_out):
         await websocket.close(code=1008, reason=get_robot_status(robot_id))
+        await client_out.aclose()
         return
     
     await websocket.accept()
-    gemini_client = await gemini.get_gemini()
+    client_out.start()
+    if progress:
+        _progress_robots.add(robot_id)
+    robot = get_robot(robot_id)
+    # Robot có thể nằm ở worker khác: lấy window robot đã khai báo từ registry
+    pending_manager.set_robot_window(robot_id, get_robot_window(robot_id))
+    gemini_client = None
+    voice: Optional[VoiceTurn] = None
+    voice_task: Optional[asyncio.Task] = None
+    # Câu lệnh giọng nói đang chạy hoặc xếp hàng, bị hủy khi client ngắt kết nối
+    voice_tasks = set()
+    # Câu lệnh giọng nói hiện tại đã bị từ chối: bỏ các frame còn lại đến khi client báo hết câu
+    voice_rejected = False
+
+    async def gemini_session(fresh: bool = False):
+        """Phiên Gemini cho lượt tiếp theo (xem gemini_guard.acquire_session)."""
+        nonlocal gemini_client
+        session, gemini_client = gemini_client, None
+        gemini_client = await gemini_guard.acquire_session(session, fresh)
+        return gemini_client
+
     try:
-        robot = get_robot(robot_id)
-        await gemini_client.connect()
+        # Phiên Gemini chỉ được lấy từ pool khi có câu lệnh cần Gemini (xem gemini_guard.acquire_session)
         while True:
             if not robot:
-                await websocket.send_text(json.dumps({
+                await client_out.send_text(codec.dumps({
                     "error": "Robot không khả dụng",
                     "robot_id": robot_id
-                }, ensure_ascii=False))
+                }))
                 continue
 
-            msg = await websocket.receive_text()
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            received_at = time.perf_counter()
+            if frame.get("bytes") is not None:
+                chunk = frame["bytes"]
+                FRAME_BYTES.observe(len(chunk), "in", "client")
+                if voice_rejected:
+                    continue
+                if voice is None or voice.ended:
+                    # Frame đầu tiên của câu lệnh giọng nói mới; câu lệnh trước có thể vẫn đang chờ Gemini
+                    try:
+                        command_limiter.admit(token_result.get("uid", ""), robot_id)
+                    except RateLimited as e:
+                        voice_rejected = True
+                        await client_out.send_text(codec.dumps(e.to_message(robot_id)))
+                        continue
+                    COMMANDS_TOTAL.inc("voice")
+                    if gemini_admission.saturated():
+                        await client_out.send_text(codec.dumps({
+                            "type": "queued",
+                            "message": "Đang chờ lượt phân tích câu lệnh",
+                            "robot_id": robot_id
+                        }))
+                    previous = voice_task if voice_task is not None and not voice_task.done() else None
+                    voice = VoiceTurn(audio_mime)
+                    voice_task = asyncio.create_task(
+                        _voice_to_robot(robot_id, robot, voice, gemini_session, client_out, previous))
+                    voice_tasks.add(voice_task)
+                    voice_task.add_done_callback(voice_tasks.discard)
+                elif voice_task.done():
+                    # Câu lệnh đã kết thúc trước khi client báo hết câu (lỗi, hoặc Gemini đã trả lời): bỏ phần còn lại
+                    continue
+                try:
+                    voice.feed(chunk)
+                except VoiceRejected as e:
+                    voice_rejected = True
+                    voice_task.cancel()
+                    await client_out.send_text(codec.dumps({
+                        "error": f"{e}, câu lệnh giọng nói bị hủy",
+                        "robot_id": robot_id
+                    }))
+                continue
+
+            msg = frame["text"]
+            FRAME_BYTES.observe(len(msg), "in", "client")
+            try:
+                message_json = codec.loads(msg)
+            except codec.DecodeError:
+                message_json = None
+            if isinstance(message_json, dict) and message_json.get("type") == "audio_end":
+                if voice is not None:
+                    voice.end()
+                voice_rejected = False
+                continue
 
             print("Nhận được tin nhắn từ client:", msg)
-            actions = [] # Khởi tạo actions là một list rỗng
+            # Mỗi câu lệnh hủy và dựng lại hàng đợi robot: giới hạn theo tài khoản và theo robot
             try:
-                message_json = json.loads(msg)
-                actions = [message_json]
-            except Exception:
-                actions = await gemini_client.send_message(msg)
+                command_limiter.admit(token_result.get("uid", ""), robot_id)
+            except RateLimited as e:
+                await client_out.send_text(codec.dumps(e.to_message(robot_id)))
+                continue
+            actions = [] # Khởi tạo actions là một list rỗng
+            source = "json"
+            if isinstance(message_json, dict):
+                COMMANDS_TOTAL.inc(source)
+                try:
+                    actions = [codec.validate_action(message_json)]
+                except codec.ActionSchemaError as e:
+                    await client_out.send_text(codec.dumps({
+                        "error": f"Hành động không hợp lệ: {e}",
+                        "robot_id": robot_id
+                    }))
+                    continue
+            else:
+                # Thử phân tích cục bộ trước, chỉ gọi Gemini khi không nhận dạng được
+                actions = local_parser.parse(msg)
+                source = "local" if actions is not None else "gemini"
+                COMMANDS_TOTAL.inc(source)
+
+            if actions is None and voice_task is not None and not voice_task.done():
+                # Phiên Gemini đang nhận câu lệnh giọng nói
+                await client_out.send_text(codec.dumps({
+                    "error": "Đang xử lý câu lệnh giọng nói, vui lòng thử lại sau",
+                    "robot_id": robot_id
+                }))
+                continue
+
+            if actions is None:
+                if gemini_admission.saturated():
+                    await client_out.send_text(codec.dumps({
+                        "type": "queued",
+                        "message": "Đang chờ lượt phân tích câu lệnh",
+                        "robot_id": robot_id
+                    }))
+                # Gửi từng action đến robot ngay khi Gemini stream xong phần tử đó. Phiên Gemini chỉ được
+                # lấy khi cache không có câu lệnh: dùng phiên thay thế nếu pool đã chuẩn bị xong (ngữ cảnh
+                # quá lớn), lấy phiên mới nếu phiên cũ đã đóng, không lấy khi circuit breaker đang mở
+                unavailable = None
+                try:
+                    dispatched = await _stream_to_robot(robot_id, robot, msg, gemini_session, received_at)
+                except RateLimited as e:
+                    await client_out.send_text(codec.dumps(e.to_message(robot_id)))
+                    continue
+                except gemini_guard.GeminiUnavailable as e:
+                    # Hết giờ, không kết nối được hoặc circuit breaker đang mở: không thử lại, chỉ còn lệnh cục bộ
+                    unavailable, dispatched = e, 0
+                except ConnectionError as e:
+                    # Phiên Gemini bị đóng trước khi có action nào: đổi phiên mới và thử lại một lần
+                    print(f"Phiên Gemini Live lỗi, đổi phiên mới: {e}")
+                    try:
+                        dispatched = await _stream_to_robot(robot_id, robot, msg,
+                                                            lambda: gemini_session(fresh=True), received_at)
+                    except RateLimited as e:
+                        await client_out.send_text(codec.dumps(e.to_message(robot_id)))
+                        continue
+                    except ConnectionError as e:
+                        unavailable, dispatched = e, 0
+                if gemini_client is not None and gemini_client.is_connected:
+                    # Bắt đầu chuẩn bị phiên mới ở nền nếu lượt vừa rồi làm ngữ cảnh vượt ngưỡng;
+                    # phiên đã đóng được đổi ở câu lệnh Gemini tiếp theo
+                    gemini_client = gemini.gemini_pool.rotate(gemini_client)
+
+                print("Số hành động đã gửi từ Gemini:", dispatched)
+                if unavailable is not None:
+                    print(f"Gemini không khả dụng: {unavailable}")
+                    await client_out.send_text(codec.dumps({
+                        "error": f"{unavailable}. Hiện chỉ hỗ trợ các câu lệnh đơn giản",
+                        "robot_id": robot_id
+                    }))
+                elif dispatched == 0:
+                    await client_out.send_text(codec.dumps({
+                        "error": "Không phân tích được lệnh",
+                        "robot_id": robot_id
+                    }))
+                continue
 
             print("Phân tích được các hành động:", actions)
             if (len(actions) == 0):
-                await websocket.send_text(json.dumps({
+                await client_out.send_text(codec.dumps({
                     "error": "Không phân tích được lệnh",
                     "robot_id": robot_id
-                }, ensure_ascii=False))
+                }))
                 continue
             
-            action_sequence = []
-            for action_item in actions:
-                action_data = Action(
-                    action_id=str(uuid.uuid4()),
-                    intent=action_item["intent"],
-                    params=action_item["params"],
-                )
-                action_sequence.append(action_data)
+            action_sequence = optimize_plan([_build_action(item, i) for i, item in enumerate(actions)])
             
-            first_action_to_send = pending_manager.create_action_sequence(robot_id, action_sequence)
+            await _cancel_robot_actions(robot_id, robot)
+            actions_to_send = pending_manager.create_action_sequence(robot_id, action_sequence)
             
-            if first_action_to_send:
-                await robot.send_text(json.dumps(first_action_to_send.to_dict()))
+            if not action_sequence:
+                # Các bước triệt tiêu nhau (vd. rẽ trái 90 rồi rẽ phải 90): robot không cần làm gì
+                await client_out.send_text(codec.dumps({
+                    "message": "Chuỗi hành động không làm robot thay đổi vị trí, bỏ qua",
+                    "robot_id": robot_id
+                }))
+            elif actions_to_send:
+                for action_to_send in actions_to_send:
+                    if not await _send_action(robot_id, robot, action_to_send):
+                        break
+                COMMAND_DISPATCH_SECONDS.observe(time.perf_counter() - received_at, source)
             else:
-                await websocket.send_text(json.dumps({
+                await client_out.send_text(codec.dumps({
                     "error": "Không thể tạo chuỗi hành động",
                     "robot_id": robot_id
-                }), ensure_ascii=False)
+                }))
+
+    except WebSocketDisconnect as e:
+        # Server tắt để khởi động lại: giữ chuỗi hành động trong journal để robot làm tiếp
+        if e.code != CLOSE_SERVICE_RESTART:
+            await _cancel_robot_actions(robot_id, robot)
+        unregister_client(client_out)
+        if robot and get_robot_wire_format(robot_id) == wire.WIRE_JSON: # Kiểm tra robot trước khi gửi tin nhắn
+            await robot.send_text(f"Client disconnected from {robot_id}", control=True)
+    finally:
+        for task in list(voice_tasks):
+            task.cancel()
+            try:
+                await task
+            except BaseException:
+                pass
+        if progress:
+            _progress_robots.discard(robot_id)
+        unregister_client(client_out)
+        await client_out.aclose()
+        if gemini_client: # Trả phiên về pool, pool sẽ đóng và thay phiên mới ở nền
+            await gemini.gemini_pool.release(gemini_client)
+
+@router.websocket("/subscribe/{robot_id}")
+async def subscribe_ws(websocket: WebSocket, robot_id: str, token: str, max_rate: float = TELEMETRY_MAX_RATE):
+    """Người quan sát chỉ đọc: nhận mọi frame robot gửi lên, không điều khiển được robot."""
+    token_result = await verify_firebase_token_async(token)
+    if not token_result['success']:
+        await websocket.close(code=1008, reason=f"Invalid token: {token_result.get('error', 'Unknown error')}")
+        return
+
+    if not max_rate > 0:
+        await websocket.close(code=1008, reason="max_rate phải lớn hơn 0")
+        return
+
+    # Frame của robot chỉ được phát lại ở worker giữ kết nối robot
+    if not is_robot_local(robot_id):
+        await websocket.close(code=1008, reason=f"Robot {robot_id} không khả dụng")
+        return
 
+    await websocket.accept()
+    subscriber_out = OutboundQueue(websocket, f"subscriber:{robot_id}", max_size=TELEMETRY_QUEUE_SIZE)
+    subscriber_out.start()
+    telemetry_hub.subscribe(robot_id, subscriber_out, max_rate)
+    try:
+        while True:
+            # Bỏ qua mọi tin subscriber gửi lên, chỉ chờ ngắt kết nối
+            await websocket.receive_text()
     except WebSocketDisconnect:
-        if gemini_client: # Chỉ ngắt kết nối nếu gemini_client đã được khởi tạo
-            await gemini_client.disconnect()
-        pending_manager.cancel_robot_actions(robot_id)
-        unregister_client(websocket)
-        if robot: # Kiểm tra robot trước khi gửi tin nhắn
-            await robot.send_text(f"Client disconnected from {robot_id}")
+        pass
+    finally:
+        telemetry_hub.unsubscribe(robot_id, subscriber_out)
+        await subscriber_out.aclose()
+
+@router.websocket("/fleet")
+async def fleet_ws(websocket: WebSocket, token: str, since: Optional[int] = None):
+    """
+    Feed trạng thái fleet: gửi snapshot khi kết nối (hoặc khi version `since` đã quá cũ),
+    sau đó chỉ gửi các thay đổi (delta) kèm bộ đếm theo trạng thái.
+    """
+    token_result = await verify_firebase_token_async(token)
+    if not token_result['success']:
+        await websocket.close(code=1008, reason=f"Invalid token: {token_result.get('error', 'Unknown error')}")
+        return
+
+    await websocket.accept()
+    # Delta không được bỏ: người theo dõi không đọc kịp sẽ bị ngắt và kết nối lại để lấy snapshot
+    fleet_out = OutboundQueue(websocket, "fleet", policy=POLICY_DISCONNECT)
+    fleet_out.start()
+    fleet = get_fleet_status()
+    version = since if since is not None else -1
+    reader = asyncio.create_task(_wait_disconnect(websocket))
+    try:
+        while not reader.done() and not fleet_out.closed:
+            deltas = fleet.deltas_since(version) if version >= 0 else None
+            if deltas is None:
+                version = fleet.version
+                fleet_out.enqueue_text(codec.dumps({
+                    "type": "snapshot",
+                    "version": version,
+                    "robots": fleet.snapshot(),
+                    "counts": fleet.counts(),
+                }))
+            elif deltas:
+                version = deltas[-1][0]
+                fleet_out.enqueue_text(codec.dumps({
+                    "type": "delta",
+                    "version": version,
+                    "changes": [{"robot_id": robot_id, "status": status} for _, robot_id, status in deltas],
+                    "counts": fleet.counts(),
+                }))
+            changed = asyncio.create_task(fleet.wait_for_change(version, FLEET_FEED_KEEPALIVE))
+            await asyncio.wait({reader, changed}, return_when=asyncio.FIRST_COMPLETED)
+            changed.cancel()
+    finally:
+        reader.cancel()
+        await fleet_out.aclose()
+
+async def _wait_disconnect(websocket: WebSocket):
+    """Bỏ qua mọi tin gửi lên, kết thúc khi kết nối đóng."""
+    try:
+        while True:
+            await websocket.receive_text()
+    except (WebSocketDisconnect, RuntimeError):
+        pass